@@ -0,0 +1,163 @@
+# ai_cache.py
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from candle_store import RESOLUTION_SECONDS, next_bar_boundary
+
+logger = logging.getLogger(__name__)
+
+Fingerprint = Tuple[Any, ...]
+
+
+def _bucket(value: Optional[float], width: float) -> Optional[int]:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return int(value // width)
+
+
+def _sign(value: Optional[float]) -> Optional[int]:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return (value > 0) - (value < 0)
+
+
+def band_position(price: Optional[float], indicators: Dict[str, Any], bins: int = 4) -> Optional[int]:
+    """
+    Narxning Bollinger kanalidagi o'rni: -1 pastki chiziqdan past, 0..bins-1 kanal ichida,
+    bins yuqori chiziqdan yuqori.
+    """
+    upper, lower = indicators.get("bb_upper"), indicators.get("bb_lower")
+    if price is None or upper is None or lower is None or upper <= lower:
+        return None
+    if price < lower:
+        return -1
+    if price > upper:
+        return bins
+    return min(bins - 1, int((price - lower) / (upper - lower) * bins))
+
+
+def decision_fingerprint(asset: str, direction: str, indicators: Dict[str, Any],
+                         prices: Optional[Dict[str, float]] = None, rsi_width: float = 5.0) -> Fingerprint:
+    """
+    (aktiv, yo'nalish, RSI bucketi, MACD ishorasi, Bollinger o'rni). Yaqin bozor holatlari
+    bitta kalitga tushadi, shuning uchun AI qarori qayta ishlatiladi.
+    """
+    macd_hist = indicators.get("macd_hist")
+    if macd_hist is None and indicators.get("macd") is not None and indicators.get("macd_signal") is not None:
+        macd_hist = indicators["macd"] - indicators["macd_signal"]
+    price = None
+    if prices and prices.get("buy") and prices.get("sell"):
+        price = (prices["buy"] + prices["sell"]) / 2
+    return (
+        asset,
+        direction.upper(),
+        _bucket(indicators.get("rsi"), rsi_width),
+        _sign(macd_hist),
+        band_position(price, indicators),
+    )
+
+
+class AIDecisionCache:
+    """
+    AI qarorlari uchun LRU kesh; kalit — decision_fingerprint.
+      - yozuv signal resolutionidagi joriy bar yopilguncha yashaydi (noma'lum resolutionda default_ttl)
+      - bir kalit uchun bir vaqtdagi so'rovlar bitta AI chaqiruvini kutadi (coalescing)
+      - xato bilan qaytgan qarorlar ({"error": True}) keshlanmaydi
+      - force=True yoki invalidate() bilan majburiy yangilash; hits / misses / refreshes hisoblagichlari
+    """
+
+    def __init__(self, max_entries: int = 512, default_ttl: float = 600.0,
+                 clock: Callable[[], float] = time.time):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._clock = clock
+        self._entries: "OrderedDict[Fingerprint, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._inflight: Dict[Fingerprint, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+
+    def _expiry(self, resolution: Optional[str], now: float) -> float:
+        if resolution in RESOLUTION_SECONDS:
+            return next_bar_boundary(resolution, now)
+        return now + self.default_ttl
+
+    async def get_or_fetch(
+        self,
+        key: Fingerprint,
+        fetch: Callable[[], Awaitable[Dict[str, Any]]],
+        resolution: Optional[str] = None,
+        force: bool = False,
+    ) -> Dict[str, Any]:
+        now = self._clock()
+        entry = self._entries.get(key)
+        if entry and not force and now < entry[0]:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return {**entry[1], "cached": True}
+        if force:
+            self.refreshes += 1
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(key, fetch, resolution))
+            self._inflight[key] = task
+        # shield: birinchi chaqiruvchi bekor qilinsa ham boshqalar natijani oladi
+        return await asyncio.shield(task)
+
+    def peek(self, key: Fingerprint) -> Optional[Dict[str, Any]]:
+        """Amal qilayotgan yozuvni qaytaradi (AI chaqirmaydi); yo'q bo'lsa None."""
+        entry = self._entries.get(key)
+        if entry and self._clock() < entry[0]:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return {**entry[1], "cached": True}
+        self.misses += 1
+        return None
+
+    def put(self, key: Fingerprint, decision: Dict[str, Any], resolution: Optional[str] = None):
+        """Tashqarida olingan qarorni (masalan, batch javobidan) saqlaydi; xato qarorlar saqlanmaydi."""
+        if not decision or decision.get("error"):
+            return
+        self._entries[key] = (self._expiry(resolution, self._clock()), decision)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _load(self, key: Fingerprint, fetch, resolution: Optional[str]) -> Dict[str, Any]:
+        try:
+            decision = await fetch()
+            self.put(key, decision, resolution)
+            return decision
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate(self, asset: Optional[str] = None):
+        """Hammasini yoki bitta aktiv qarorlarini o'chiradi (keyingi so'rov AI ga boradi)."""
+        if asset is None:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries if key[0] == asset]:
+            del self._entries[key]
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "refreshes": self.refreshes,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "size": len(self._entries),
+        }
+
+
+shared_ai_cache = AIDecisionCache()
@@ -0,0 +1,295 @@
+# ai_client.py
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+import aiohttp
+
+from config import (
+    GEMINI_API_KEY, GEMINI_API_URL, GEMINI_REQUESTS_PER_MINUTE, GEMINI_MAX_CONCURRENCY,
+    GEMINI_BREAKER_WINDOW, GEMINI_BREAKER_ERROR_RATE, GEMINI_BREAKER_SLOW_SECONDS, GEMINI_BREAKER_OPEN_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(value: Optional[str], now: Optional[float] = None) -> float:
+    """
+    Retry-After sarlavhasi (soniyalar yoki HTTP-sana) -> kutish soniyalari. Sarlavha yo'q yoki
+    o'qib bo'lmasa 0: token bucket baribir bitta token oralig'i kutadi.
+    """
+    if not value:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logger.warning(f"Retry-After sarlavhasini o'qib bo'lmadi: {value!r}")
+        return 0.0
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, retry_at.timestamp() - (time.time() if now is None else now))
+
+
+class AIClientError(Exception):
+    """Gemini so'rovi bajarilmadi (status 0 — tarmoq/deadline, 429 — kvota)."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class CircuitOpenError(AIClientError):
+    """Circuit breaker ochiq: so'rov Gemini ga yuborilmadi."""
+
+    def __init__(self, message: str):
+        super().__init__(503, message)
+
+
+class CircuitBreaker:
+    """
+    Gemini uchun circuit breaker:
+      - closed: oxirgi `window` chaqiruvning kamida `min_calls` tasi bo'lsa va xatolar yoki
+        `slow_seconds` dan sekin javoblar ulushi `error_rate` ga yetsa — open
+      - open: `open_seconds` davomida so'rovlar darhol rad etiladi
+      - half_open: bitta sinov so'rovi o'tkaziladi; muvaffaqiyatli va tez bo'lsa closed, aks holda yana open
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, window: int = GEMINI_BREAKER_WINDOW, min_calls: int = 5,
+                 error_rate: float = GEMINI_BREAKER_ERROR_RATE, slow_seconds: float = GEMINI_BREAKER_SLOW_SECONDS,
+                 open_seconds: float = GEMINI_BREAKER_OPEN_SECONDS, clock: Callable[[], float] = time.monotonic):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.open_seconds = open_seconds
+        self._clock = clock
+        self._results: Deque[Tuple[bool, bool]] = deque(maxlen=window)  # (xato, sekin)
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probing = False
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and self._clock() - self._opened_at >= self.open_seconds:
+            self._state = self.HALF_OPEN
+            self._probing = False
+        return self._state
+
+    def available(self) -> bool:
+        """So'rov o'tishi mumkinmi (sinov so'rovi band qilinmaydi)."""
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and not self._probing)
+
+    def allow(self) -> bool:
+        """So'rov yuborishdan oldin chaqiriladi; half_open da bitta sinov so'rovini band qiladi."""
+        if not self.available():
+            self.rejected += 1
+            return False
+        if self._state == self.HALF_OPEN:
+            self._probing = True
+        return True
+
+    def record(self, ok: bool, latency: float):
+        slow = latency > self.slow_seconds
+        if self._state == self.HALF_OPEN:
+            self._probing = False
+            if ok and not slow:
+                logger.info("Gemini circuit breaker yopildi (sinov so'rovi muvaffaqiyatli)")
+                self._state = self.CLOSED
+                self._results.clear()
+            else:
+                self._trip("sinov so'rovi muvaffaqiyatsiz")
+            return
+        self._results.append((not ok, slow))
+        if self._state != self.CLOSED or len(self._results) < self.min_calls:
+            return
+        errors = sum(1 for failed, _ in self._results if failed)
+        slow_calls = sum(1 for _, is_slow in self._results if is_slow)
+        if errors / len(self._results) >= self.error_rate:
+            self._trip(f"xatolar {errors}/{len(self._results)}")
+        elif slow_calls / len(self._results) >= self.error_rate:
+            self._trip(f"sekin javoblar {slow_calls}/{len(self._results)} (> {self.slow_seconds:.0f} s)")
+
+    def _trip(self, reason: str):
+        logger.warning(f"Gemini circuit breaker ochildi: {reason}; {self.open_seconds:.0f} s so'rovlar yuborilmaydi")
+        self._state = self.OPEN
+        self._opened_at = self._clock()
+        self._results.clear()
+        self.trips += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "trips": self.trips, "rejected": self.rejected}
+
+
+class TokenBucket:
+    """Token bucket: `rate` token/soniya, ko'pi bilan `capacity` token yig'iladi."""
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, deadline: float) -> float:
+        """Bitta token oladi; kutilgan vaqtni qaytaradi. Deadline gacha token bo'lmasa AIClientError."""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+                if self._clock() + wait > deadline:
+                    raise AIClientError(429, f"Rate limit: {wait:.1f} s kutish deadline dan oshadi")
+                await asyncio.sleep(wait)
+                waited += wait
+
+    def drain(self, seconds: float = 0.0):
+        """429 kelganda: tokenlarni nollaydi va yana `seconds` soniya kuttiradi."""
+        self._refill()
+        self._tokens = -seconds * self.rate
+
+
+class GeminiClient:
+    """
+    Barcha Gemini chaqiruvlari uchun yagona klient:
+      - doimiy aiohttp sessiya (keep-alive)
+      - global semaphore (bir vaqtda max_concurrency ta so'rov)
+      - kvotaga mos token bucket; 429 da Retry-After bo'yicha bucket bo'shatiladi
+      - har bir chaqiruv uchun deadline (navbat + so'rov birgalikda)
+      - circuit breaker: Gemini sekin yoki ishlamayotgan bo'lsa so'rovlar darhol CircuitOpenError bilan tugaydi
+    """
+
+    def __init__(
+        self,
+        api_key: str = GEMINI_API_KEY,
+        model_url: str = GEMINI_API_URL,
+        requests_per_minute: float = GEMINI_REQUESTS_PER_MINUTE,
+        max_concurrency: int = GEMINI_MAX_CONCURRENCY,
+        default_deadline: float = 30.0,
+    ):
+        self.api_key = api_key
+        self.model_url = model_url
+        self.default_deadline = default_deadline
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._bucket = TokenBucket(requests_per_minute / 60.0, capacity=max(1.0, float(max_concurrency)))
+        self.breaker = CircuitBreaker()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.calls = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.timeouts = 0
+        self.throttled_seconds = 0.0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60),
+                headers={"Content-Type": "application/json"},
+            )
+        return self._session
+
+    def available(self) -> bool:
+        """Circuit breaker so'rovlarni o'tkazadimi (AI chaqiruvidan oldin tayyorgarlikni tejash uchun)."""
+        return self.breaker.available()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def generate(self, prompt: str, generation_config: Optional[Dict[str, Any]] = None,
+                       deadline: Optional[float] = None) -> str:
+        """Prompt yuboradi va birinchi nomzod matnini qaytaradi. Xato bo'lsa AIClientError."""
+        if not self.api_key:
+            raise AIClientError(401, "GEMINI_API_KEY topilmadi")
+        payload: Dict[str, Any] = {"contents": [{"parts": [{"text": prompt}]}]}
+        if generation_config:
+            payload["generationConfig"] = generation_config
+        result = await self.request(payload, deadline)
+        try:
+            return result["candidates"][0]["content"]["parts"][0]["text"].strip()
+        except (KeyError, IndexError, TypeError) as e:
+            self.errors += 1
+            raise AIClientError(500, f"Gemini javobini o'qishda xato: {e}")
+
+    async def request(self, payload: Dict[str, Any], deadline: Optional[float] = None) -> Dict[str, Any]:
+        """generateContent ga xom payload yuboradi va JSON javobni qaytaradi."""
+        if not self.breaker.available():
+            self.breaker.rejected += 1
+            raise CircuitOpenError("Gemini circuit breaker ochiq, so'rov yuborilmadi")
+        budget = deadline if deadline is not None else self.default_deadline
+        end = time.monotonic() + budget
+        self.calls += 1
+        try:
+            return await asyncio.wait_for(self._request(payload, end), timeout=budget)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise AIClientError(0, f"Gemini so'rovi {budget:.0f} s deadline ichida tugamadi")
+        except aiohttp.ClientError as e:
+            self.errors += 1
+            raise AIClientError(0, f"Gemini tarmoq xatosi: {e}")
+
+    async def _request(self, payload: Dict[str, Any], end: float) -> Dict[str, Any]:
+        async with self._semaphore:
+            try:
+                self.throttled_seconds += await self._bucket.acquire(end)
+            except AIClientError:
+                self.rate_limited += 1
+                raise
+            # navbatda kutish paytida breaker ochilgan yoki half_open sinovi band bo'lishi mumkin
+            if not self.breaker.allow():
+                raise CircuitOpenError("Gemini circuit breaker ochiq, so'rov yuborilmadi")
+            started = time.monotonic()
+            ok = False
+            try:
+                session = self._get_session()
+                async with session.post(self.model_url, json=payload, headers={"X-goog-api-key": self.api_key}) as resp:
+                    if resp.status == 429:
+                        self.rate_limited += 1
+                        retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+                        self._bucket.drain(retry_after)
+                        raise AIClientError(429, f"Gemini kvotasi tugadi (Retry-After: {retry_after:.0f} s)")
+                    if resp.status != 200:
+                        self.errors += 1
+                        raise AIClientError(resp.status, f"Gemini HTTP xato: {resp.status}, {await resp.text()}")
+                    result = await resp.json()
+                    ok = True
+                    return result
+            finally:
+                # deadline tufayli bekor qilingan so'rov ham muvaffaqiyatsiz deb hisoblanadi
+                self.breaker.record(ok, time.monotonic() - started)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "rate_limited": self.rate_limited,
+            "timeouts": self.timeouts,
+            "throttled_seconds": round(self.throttled_seconds, 1),
+            "breaker": self.breaker.stats(),
+        }
+
+
+shared_ai_client = GeminiClient()
@@ -0,0 +1,183 @@
+# bar_builder.py
+import logging
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from candle_store import COLUMNS, COLUMN_INDEX, RESOLUTION_SECONDS, Candles
+
+logger = logging.getLogger(__name__)
+
+# Websocket kotirovkalaridan lokal quriladigan resolutionlar
+BUILT_RESOLUTIONS = ("MINUTE", "MINUTE_5", "MINUTE_15", "HOUR", "HOUR_4")
+
+_OB, _OA = COLUMN_INDEX["open_bid"], COLUMN_INDEX["open_ask"]
+_HB, _HA = COLUMN_INDEX["high_bid"], COLUMN_INDEX["high_ask"]
+_LB, _LA = COLUMN_INDEX["low_bid"], COLUMN_INDEX["low_ask"]
+_CB, _CA = COLUMN_INDEX["close_bid"], COLUMN_INDEX["close_ask"]
+_VOL = COLUMN_INDEX["volume"]
+
+BarCloseListener = Callable[[str, str, int], None]
+
+
+class _BarRing:
+    """Bitta (epic, resolution) uchun oldindan ajratilgan halqa bufer. Oxirgi element — shakllanayotgan bar."""
+
+    __slots__ = ("capacity", "ts", "values", "start", "count", "ready", "last_quote_ms")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.ts = np.zeros(capacity, dtype=np.int64)
+        self.values = np.full((len(COLUMNS), capacity), np.nan, dtype=np.float64)
+        self.start = 0
+        self.count = 0
+        # REST bilan to'ldirilgan va o'shandan beri uzilish bo'lmagan
+        self.ready = False
+        # oxirgi kotirovka vaqti (ms); seed dan keyin kotirovka kelmagan bo'lsa None
+        self.last_quote_ms: Optional[int] = None
+
+    def last_pos(self) -> int:
+        return (self.start + self.count - 1) % self.capacity
+
+    def append(self, ts: int) -> int:
+        if self.count < self.capacity:
+            pos = (self.start + self.count) % self.capacity
+            self.count += 1
+        else:
+            pos = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.ts[pos] = ts
+        return pos
+
+    def reset(self, candles: Candles):
+        n = min(len(candles), self.capacity)
+        self.start = 0
+        self.count = n
+        if n:
+            self.ts[:n] = candles.ts[-n:]
+            self.values[:, :n] = candles.values[:, -n:]
+
+    def snapshot(self, n: int) -> Candles:
+        n = min(n, self.count)
+        idx = (self.start + np.arange(self.count - n, self.count)) % self.capacity
+        return Candles(self.ts[idx], self.values[:, idx])
+
+
+class BarBuilder:
+    """
+    Websocket kotirovkalaridan (bid/ofr) MINUTE ... HOUR_4 bid/ask OHLC barlarini
+    inkremental quradi. Har bir (epic, resolution) uchun halqa bufer ishlatiladi.
+    Lokal barlarda hajm (volume) NaN bo'ladi — kotirovka oqimida hajm yo'q, hajmga tayanadigan
+    indikatorlar REST barlaridan hisoblanishi kerak.
+    Lokal barlar faqat obuna bo'lingan epic uchun va oxirgi kotirovka bir bardan eski bo'lmasa
+    beriladi; aks holda get() None qaytaradi va chaqiruvchi REST dan qayta to'ldiradi.
+    """
+
+    def __init__(self, capacity: int = 1000, resolutions: Tuple[str, ...] = BUILT_RESOLUTIONS,
+                 clock: Callable[[], float] = time.time):
+        self.capacity = capacity
+        self.resolutions = resolutions
+        self._clock = clock
+        self._bar_ms = {res: RESOLUTION_SECONDS[res] * 1000 for res in resolutions}
+        self._rings: Dict[Tuple[str, str], _BarRing] = {}
+        self._listeners: List[BarCloseListener] = []
+        self._subscribed: Set[str] = set()
+
+    def add_listener(self, callback: BarCloseListener):
+        """Bar yopilganda callback(epic, resolution, bar_ts_ms) chaqiriladi."""
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback: BarCloseListener):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def set_subscribed(self, epics: Iterable[str]):
+        """Websocket obunasiga qo'shilgan epiclar (faqat ular uchun lokal barlar ishonchli)."""
+        self._subscribed.update(epics)
+
+    def streaming(self, epic: str) -> bool:
+        return epic in self._subscribed
+
+    def _ring(self, epic: str, resolution: str) -> _BarRing:
+        key = (epic, resolution)
+        ring = self._rings.get(key)
+        if ring is None:
+            ring = self._rings[key] = _BarRing(self.capacity)
+        return ring
+
+    def on_quote(self, epic: str, bid: float, ask: float, ts_ms: int):
+        for res in self.resolutions:
+            bar_ms = self._bar_ms[res]
+            bar_ts = ts_ms - ts_ms % bar_ms
+            ring = self._ring(epic, res)
+            v = ring.values
+
+            # kotirovkalar orasida bir bardan uzoq tanaffus — oradagi barlar REST dan qayta olinadi
+            if ring.last_quote_ms is not None and ts_ms - ring.last_quote_ms > bar_ms:
+                ring.ready = False
+            if ts_ms > (ring.last_quote_ms or 0):
+                ring.last_quote_ms = ts_ms
+
+            if ring.count:
+                pos = ring.last_pos()
+                last_ts = int(ring.ts[pos])
+                if bar_ts == last_ts:
+                    if bid > v[_HB, pos]:
+                        v[_HB, pos] = bid
+                    if ask > v[_HA, pos]:
+                        v[_HA, pos] = ask
+                    if bid < v[_LB, pos]:
+                        v[_LB, pos] = bid
+                    if ask < v[_LA, pos]:
+                        v[_LA, pos] = ask
+                    v[_CB, pos] = bid
+                    v[_CA, pos] = ask
+                    continue
+                if bar_ts < last_ts:
+                    # kechikkan kotirovka — yopilgan barni o'zgartirmaymiz
+                    continue
+                self._emit(epic, res, last_ts)
+
+            pos = ring.append(bar_ts)
+            v[_OB, pos] = v[_HB, pos] = v[_LB, pos] = v[_CB, pos] = bid
+            v[_OA, pos] = v[_HA, pos] = v[_LA, pos] = v[_CA, pos] = ask
+            v[_VOL, pos] = np.nan
+
+    def _emit(self, epic: str, resolution: str, bar_ts: int):
+        for callback in self._listeners:
+            try:
+                callback(epic, resolution, bar_ts)
+            except Exception as e:
+                logger.error(f"Bar yopilish listenerida xato: {e}")
+
+    def seed(self, epic: str, resolution: str, candles: Candles):
+        """REST dan olingan tarix bilan buferni to'ldiradi (startup yoki uzilishdan keyin)."""
+        if resolution not in self._bar_ms:
+            return
+        ring = self._ring(epic, resolution)
+        ring.reset(candles)
+        ring.ready = True
+        ring.last_quote_ms = None
+
+    def mark_stale(self, epic: Optional[str] = None):
+        """Oqim uzilganda chaqiriladi: keyingi so'rov REST backfill qiladi (obunalar ham qayta tiklanadi)."""
+        if epic is None:
+            self._subscribed.clear()
+        for (ring_epic, _), ring in self._rings.items():
+            if epic is None or ring_epic == epic:
+                ring.ready = False
+
+    def get(self, epic: str, resolution: str, num_points: int) -> Optional[Candles]:
+        """
+        Lokal barlar yetarli va ishonchli bo'lsa oxirgi num_points barni qaytaradi, aks holda None:
+        epic obuna qilinmagan, seed dan keyin kotirovka kelmagan yoki oxirgi kotirovka bir bardan eski.
+        """
+        if resolution not in self._bar_ms or epic not in self._subscribed:
+            return None
+        ring = self._rings.get((epic, resolution))
+        if ring is None or not ring.ready or ring.count < num_points or ring.last_quote_ms is None:
+            return None
+        if self._clock() * 1000 - ring.last_quote_ms > self._bar_ms[resolution]:
+            return None
+        return ring.snapshot(num_points)
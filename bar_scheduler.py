@@ -0,0 +1,131 @@
+# bar_scheduler.py
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+from candle_store import RESOLUTION_SECONDS, next_bar_boundary
+
+logger = logging.getLogger(__name__)
+
+
+class BarCloseScheduler:
+    """
+    Signal baholashini bar yopilishiga bog'laydi: har bir epic bitta bar uchun bir marta baholanadi.
+    Epic "navbatga" uch yo'l bilan tushadi:
+      - bar chegarasi o'tdi (soat bo'yicha, grace soniya kechikish bilan — REST yopilgan barni bersin)
+      - bar builder yopilgan barni e'lon qildi (on_bar_close)
+      - bar ichidagi narx triggeri ishladi (set_price_trigger + on_quote)
+    Eski 10 soniyalik polling bilan solishtirganda o'tkazib yuborilgan baholashlar `skipped` da.
+    """
+
+    def __init__(self, grace: float = 2.0, poll_interval: float = 10.0,
+                 clock: Callable[[], float] = time.time):
+        self.grace = grace
+        self.poll_interval = poll_interval
+        self._clock = clock
+        self.resolution = "HOUR"
+        # epic -> oxirgi baholangan bar boshlanishi (epoch soniya)
+        self._evaluated_bar: Dict[str, float] = {}
+        # navbatdagi epic -> u qaysi bar uchun navbatga tushgan (bar yopilishi bo'yicha), aks holda -inf
+        self._pending: Dict[str, float] = {}
+        self._triggers: Dict[str, Dict[str, Optional[float]]] = {}
+        self._wakeup = asyncio.Event()
+        self._last_wake: Optional[float] = None
+        self.evaluations = 0
+        self.skipped = 0
+        self.wakeups = {"boundary": 0, "bar_close": 0, "intrabar": 0, "deferred": 0}
+
+    def _bar_start(self, now: float) -> float:
+        return next_bar_boundary(self.resolution, now) - RESOLUTION_SECONDS[self.resolution]
+
+    # --- hodisalar (websocket handler ichidan, sinxron) ---
+
+    def on_bar_close(self, epic: str, resolution: str, bar_ts_ms: int):
+        """BarBuilder listeneri: yopilgan bar kuzatilayotgan resolutionda bo'lsa epic navbatga tushadi."""
+        if resolution != self.resolution:
+            return
+        new_bar = bar_ts_ms / 1000 + RESOLUTION_SECONDS[resolution]
+        if self._evaluated_bar.get(epic, float("-inf")) < new_bar and self._pending.get(epic, float("-inf")) < new_bar:
+            self._pending[epic] = new_bar
+            self.wakeups["bar_close"] += 1
+            self._wakeup.set()
+
+    def set_price_trigger(self, epic: str, above: Optional[float] = None, below: Optional[float] = None):
+        """Bir martalik bar ichidagi trigger: o'rta narx above dan oshsa yoki below dan tushsa baholash."""
+        if above is None and below is None:
+            self._triggers.pop(epic, None)
+        else:
+            self._triggers[epic] = {"above": above, "below": below}
+
+    def on_quote(self, epic: str, bid: float, ask: float):
+        trigger = self._triggers.get(epic)
+        if not trigger:
+            return
+        mid = (bid + ask) / 2
+        above, below = trigger["above"], trigger["below"]
+        if (above is not None and mid >= above) or (below is not None and mid <= below):
+            del self._triggers[epic]
+            logger.info(f"[{epic}] bar ichidagi trigger ishladi: narx={mid}")
+            self._pending.setdefault(epic, float("-inf"))
+            self.wakeups["intrabar"] += 1
+            self._wakeup.set()
+
+    # --- aylanma uchun ---
+
+    def defer(self, epics: Iterable[str]):
+        """Baholanmagan (masalan, limit tufayli) epiclarni keyingi uyg'onishga qoldiradi."""
+        epics = set(epics)
+        for epic in epics:
+            self._pending.setdefault(epic, float("-inf"))
+        self.evaluations -= len(epics)
+        if epics:
+            self.wakeups["deferred"] += 1
+
+    async def wait_due(self, epics: Iterable[str], resolution: str) -> Set[str]:
+        """Kamida bitta epic baholanishi kerak bo'lguncha kutadi va ularni qaytaradi."""
+        epics = list(epics)
+        if resolution != self.resolution and resolution in RESOLUTION_SECONDS:
+            # resolution o'zgardi — barcha epiclar yangi bar bo'yicha qayta baholanadi
+            self.resolution = resolution
+            self._evaluated_bar.clear()
+
+        while True:
+            now = self._clock()
+            bar_start = self._bar_start(now - self.grace)
+            boundary_due = {e for e in epics if self._evaluated_bar.get(e, float("-inf")) < bar_start}
+            due = boundary_due | (self._pending.keys() & set(epics))
+            if due:
+                if boundary_due - self._pending.keys() and self._last_wake is not None:
+                    self.wakeups["boundary"] += 1
+                for epic in due:
+                    self._evaluated_bar[epic] = max(
+                        self._evaluated_bar.get(epic, float("-inf")), bar_start, self._pending.pop(epic, float("-inf"))
+                    )
+                self._count(now, len(epics), len(due))
+                return due
+
+            self._wakeup.clear()
+            timeout = max(0.0, bar_start + RESOLUTION_SECONDS[self.resolution] + self.grace - now)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _count(self, now: float, total: int, due: int):
+        self.evaluations += due
+        if self._last_wake is not None:
+            # shu oraliqda 10 soniyalik polling qilgan bo'lardi: polls * total baholash
+            polls = int((now - self._last_wake) // self.poll_interval)
+            self.skipped += max(0, polls * total - due)
+        self._last_wake = now
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "resolution": self.resolution,
+            "evaluations": self.evaluations,
+            "skipped": self.skipped,
+            "wakeups": dict(self.wakeups),
+            "pending": len(self._pending),
+            "triggers": len(self._triggers),
+        }
@@ -0,0 +1,75 @@
+# bench_indicators.py
+"""
+indicators.py (TA-Lib, butun seriya qayta hisoblanadi) va incremental_indicators.py
+(har bir yangi bar uchun O(1)) ni tezlik va aniqlik bo'yicha solishtiradi.
+
+    python bench_indicators.py [--bars 2000] [--history 500]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import talib
+
+from indicators import calculate_bollinger_bands, calculate_ema, calculate_macd, calculate_rsi
+from incremental_indicators import IndicatorSet
+
+
+def full_recompute(closes: pd.Series) -> dict:
+    macd = calculate_macd(closes)
+    bb = calculate_bollinger_bands(closes, 20)
+    return {
+        "rsi": calculate_rsi(closes, 14),
+        "ema20": calculate_ema(closes, 20),
+        "ema50": calculate_ema(closes, 50),
+        "macd": macd["macd"],
+        "macd_signal": macd["signal"],
+        "macd_hist": macd["hist"],
+        "bb_upper": bb["upper"],
+        "bb_middle": bb["middle"],
+        "bb_lower": bb["lower"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bars", type=int, default=2000, help="yangi barlar soni")
+    parser.add_argument("--history", type=int, default=500, help="warmup tarixi (barlar)")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    total = args.history + args.bars
+    closes = np.cumsum(rng.normal(0, 1, total)) + 1000.0
+    volumes = rng.integers(1, 1000, total).astype(np.float64)
+
+    # 1) eski usul: har bir yangi barda oxirgi `history` bar bo'yicha to'liq qayta hisoblash
+    start = time.perf_counter()
+    for end in range(args.history + 1, total + 1):
+        full_recompute(pd.Series(closes[end - args.history:end]))
+    full_time = time.perf_counter() - start
+
+    # 2) inkremental: bir marta warmup, keyin har bir barda update()
+    start = time.perf_counter()
+    indicator_set = IndicatorSet()
+    indicator_set.warmup(closes[:args.history], volumes[:args.history])
+    for i in range(args.history, total):
+        indicator_set.update(float(closes[i]), float(volumes[i]))
+        indicator_set.values()
+    inc_time = time.perf_counter() - start
+
+    # aniqlik: bir xil kirish (butun seriya) bo'yicha TA-Lib bilan solishtirish
+    reference = full_recompute(pd.Series(closes))
+    reference["obv"] = talib.OBV(closes, volumes)[-1]
+    got = indicator_set.values()
+    max_err = max(abs(got[k] - v) / max(1.0, abs(v)) for k, v in reference.items())
+
+    print(f"barlar: {args.bars}, tarix: {args.history}")
+    print(f"to'liq qayta hisoblash : {full_time * 1e6 / args.bars:10.1f} us/bar")
+    print(f"inkremental            : {inc_time * 1e6 / args.bars:10.1f} us/bar")
+    print(f"tezlanish              : {full_time / inc_time:10.1f}x")
+    print(f"maks. nisbiy farq      : {max_err:.3e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# candle_cache.py
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from candle_store import Candles, RESOLUTION_SECONDS, next_bar_boundary
+
+CandleLoader = Callable[[str, str, int], Awaitable[Candles]]
+
+
+class CandleCache:
+    """
+    Jarayon bo'yicha umumiy (epic, resolution) sham keshi.
+      - yozuv shu resolutionning keyingi bari yopilganda eskiradi (qat'iy TTL emas)
+      - bir kalit uchun bir vaqtdagi so'rovlar bitta yuklashni kutadi (single-flight)
+      - bar davomida barcha iste'molchilar bir xil, faqat o'qiladigan massivni oladi
+      - so'ralganidan kam bar qaytgan natija (bo'sh yoki vaqtinchalik REST xatosi) keshlanmaydi
+    """
+
+    def __init__(self):
+        self._entries: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # kalit -> (yuklash vazifasi, so'ralgan bar soni)
+        self._inflight: Dict[Tuple[str, str], Tuple[asyncio.Task, int]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, epic: str, resolution: str, num_points: int, loader: CandleLoader) -> Candles:
+        key = (epic, resolution)
+        while True:
+            entry = self._entries.get(key)
+            if entry and time.time() < entry["expires_at"] and num_points <= entry["num_points"]:
+                self.hits += 1
+                return entry["candles"].tail(num_points)
+
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                self.misses += 1
+                task = asyncio.ensure_future(self._load(key, num_points, loader))
+                self._inflight[key] = (task, num_points)
+                return (await asyncio.shield(task)).tail(num_points)
+
+            task, loading_points = inflight
+            candles = await asyncio.shield(task)
+            if loading_points >= num_points:
+                # kesh hiti emas: boshqa so'rovning yuklashi kutildi (alohida hisoblanadi)
+                self.coalesced += 1
+                return candles.tail(num_points)
+            # boshqa so'rov kamroq bar yuklagan — keyingi aylanishda o'zimiz yuklaymiz
+
+    async def _load(self, key: Tuple[str, str], num_points: int, loader: CandleLoader) -> Candles:
+        epic, resolution = key
+        try:
+            candles = (await loader(epic, resolution, num_points)).freeze()
+            if resolution in RESOLUTION_SECONDS and len(candles) >= num_points:
+                self._entries[key] = {
+                    "candles": candles,
+                    "num_points": num_points,
+                    "expires_at": next_bar_boundary(resolution, time.time()),
+                }
+            return candles
+        finally:
+            self._inflight.pop(key, None)
+
+    def invalidate(self, epic: str = None, resolution: str = None):
+        for key in list(self._entries):
+            if (epic is None or key[0] == epic) and (resolution is None or key[1] == resolution):
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self._entries),
+        }
+
+
+# Barcha CapitalComAPI obyektlari uchun umumiy kesh
+shared_candle_cache = CandleCache()
@@ -0,0 +1,253 @@
+# candle_store.py
+import json
+import logging
+import os
+import re
+import tempfile
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Sham ustunlari (ts alohida saqlanadi). Tartib o'zgarsa diskdagi fayllar yaroqsiz bo'ladi.
+COLUMNS = (
+    "open_bid", "open_ask",
+    "high_bid", "high_ask",
+    "low_bid", "low_ask",
+    "close_bid", "close_ask",
+    "volume",
+)
+COLUMN_INDEX = {name: i for i, name in enumerate(COLUMNS)}
+
+# Capital.com resolution -> bar uzunligi (soniya)
+RESOLUTION_SECONDS = {
+    "MINUTE": 60,
+    "MINUTE_5": 300,
+    "MINUTE_15": 900,
+    "MINUTE_30": 1800,
+    "HOUR": 3600,
+    "HOUR_4": 14400,
+    "DAY": 86400,
+    "WEEK": 604800,
+}
+
+# Haftalik barlar dushanba 00:00 UTC dan boshlanadi (1970-01-01 payshanba edi)
+_WEEK_OFFSET_SECONDS = 4 * 86400
+
+
+def next_bar_boundary(resolution: str, now: float) -> float:
+    """Berilgan vaqtdan keyingi bar yopilish vaqti (UTC epoch soniya)."""
+    bar = RESOLUTION_SECONDS[resolution]
+    offset = _WEEK_OFFSET_SECONDS if resolution == "WEEK" else 0
+    return ((now - offset) // bar + 1) * bar + offset
+
+
+class Candles:
+    """
+    Shamlar ketma-ketligi (ustunli ko'rinishda):
+      ts     — int64, bar ochilish vaqti (UTC, millisekund)
+      values — float64, shape (len(COLUMNS), n); har bir qator bitta ustun
+    """
+
+    __slots__ = ("ts", "values")
+
+    def __init__(self, ts: np.ndarray, values: np.ndarray):
+        self.ts = ts
+        self.values = values
+
+    @classmethod
+    def empty(cls) -> "Candles":
+        return cls(np.empty(0, dtype=np.int64), np.empty((len(COLUMNS), 0), dtype=np.float64))
+
+    def __len__(self) -> int:
+        return int(self.ts.shape[0])
+
+    def column(self, name: str) -> np.ndarray:
+        return self.values[COLUMN_INDEX[name]]
+
+    @property
+    def close_bid(self) -> np.ndarray:
+        return self.values[COLUMN_INDEX["close_bid"]]
+
+    @property
+    def close_ask(self) -> np.ndarray:
+        return self.values[COLUMN_INDEX["close_ask"]]
+
+    @property
+    def volume(self) -> np.ndarray:
+        return self.values[COLUMN_INDEX["volume"]]
+
+    def freeze(self) -> "Candles":
+        """Massivlarni faqat o'qish uchun qiladi (keshda bo'lishiladigan nusxa)."""
+        self.ts.flags.writeable = False
+        if self.values.flags.writeable:
+            self.values.flags.writeable = False
+        return self
+
+    def tail(self, n: int) -> "Candles":
+        if n >= len(self):
+            return self
+        return Candles(self.ts[-n:], self.values[:, -n:])
+
+    def to_prices(self) -> List[Dict[str, Any]]:
+        """/api/v1/prices javobidagi 'prices' formatiga qaytaradi (eski chaqiruvchilar uchun)."""
+        v = self.values.tolist()
+        out = []
+        for i, ts in enumerate(self.ts.tolist()):
+            out.append({
+                "snapshotTimeUTC": ms_to_iso(ts),
+                "openPrice": {"bid": v[0][i], "ask": v[1][i]},
+                "highPrice": {"bid": v[2][i], "ask": v[3][i]},
+                "lowPrice": {"bid": v[4][i], "ask": v[5][i]},
+                "closePrice": {"bid": v[6][i], "ask": v[7][i]},
+                "lastTradedVolume": v[8][i],
+            })
+        return out
+
+
+def ms_to_iso(ms: int) -> str:
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def parse_ts(item: Dict[str, Any]) -> Optional[int]:
+    raw = item.get("snapshotTimeUTC") or item.get("snapshotTime")
+    if not raw:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(raw).replace("/", "-").replace(" ", "T").replace("Z", ""))
+    except ValueError:
+        return None
+    return int(dt.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+_PRICE_FIELDS = ("openPrice", "highPrice", "lowPrice", "closePrice")
+_EMPTY: Dict[str, Any] = {}
+# vaqti parse qilinmagan elementlar uchun belgi
+_NO_TS = np.iinfo(np.int64).min
+
+
+def decode_prices(prices: List[Dict[str, Any]]) -> Candles:
+    """
+    /api/v1/prices 'prices' ro'yxatini bitta o'tishda Candles ga aylantiradi.
+    Raqamlar bitta tekis ro'yxatga yig'iladi va bitta np.array chaqiruvida float64 ga o'tadi
+    (None -> NaN); vaqtlar datetime64 bilan vektorli parse qilinadi. Bid yoki ask yo'q
+    bo'lsa ikkinchisi ishlatiladi; vaqtsiz elementlar tashlanadi.
+    """
+    times: List[Any] = []
+    flat: List[Any] = []
+    append_time = times.append
+    extend = flat.extend
+    for item in prices or ():
+        if not isinstance(item, dict):
+            continue
+        ts = item.get("snapshotTimeUTC") or item.get("snapshotTime")
+        if not ts:
+            continue
+        append_time(ts)
+        for field in _PRICE_FIELDS:
+            side = item.get(field) or _EMPTY
+            extend((side.get("bid"), side.get("ask")))
+        flat.append(item.get("lastTradedVolume") or 0.0)
+    if not times:
+        return Candles.empty()
+
+    values = np.array(flat, dtype=np.float64).reshape(len(times), len(COLUMNS)).T.copy()
+    bids, asks = values[0:8:2], values[1:8:2]
+    np.copyto(bids, asks, where=np.isnan(bids))
+    np.copyto(asks, bids, where=np.isnan(asks))
+
+    ts_ms = _parse_times(times)
+    keep = ts_ms != _NO_TS
+    if not keep.all():
+        return Candles(ts_ms[keep], values[:, keep])
+    return Candles(ts_ms, values)
+
+
+def _parse_times(times: List[Any]) -> np.ndarray:
+    """ISO vaqtlar -> UTC millisekund (int64). Vektorli yo'l ishlamasa har birini alohida parse qiladi."""
+    try:
+        return np.array(times, dtype="datetime64[ms]").astype(np.int64)
+    except (ValueError, TypeError):
+        out = np.empty(len(times), dtype=np.int64)
+        for i, raw in enumerate(times):
+            ts = parse_ts({"snapshotTimeUTC": raw})
+            out[i] = _NO_TS if ts is None else ts
+        return out
+
+
+def decode_prices_bytes(raw: bytes) -> Candles:
+    """/api/v1/prices javob tanasini (bytes) to'g'ridan-to'g'ri Candles ga aylantiradi."""
+    if not raw:
+        return Candles.empty()
+    data = json.loads(raw)
+    prices = data.get("prices") if isinstance(data, dict) else None
+    return decode_prices(prices or [])
+
+
+def merge_candles(old: Candles, new: Candles) -> Candles:
+    """Ikki ketma-ketlikni birlashtiradi: vaqt bo'yicha tartiblaydi, bir xil ts da yangisini qoldiradi."""
+    if not len(old):
+        return new
+    if not len(new):
+        return old
+    ts = np.concatenate([old.ts, new.ts])
+    values = np.concatenate([old.values, new.values], axis=1)
+    # oxirgi uchraganini saqlash uchun teskari tartibda unique olamiz
+    _, rev_idx = np.unique(ts[::-1], return_index=True)
+    idx = len(ts) - 1 - rev_idx
+    return Candles(ts[idx], values[:, idx])
+
+
+class CandleStore:
+    """
+    (epic, resolution) bo'yicha shamlarni diskda saqlaydi.
+    Har bir kalit bitta .npy fayl: shape (1 + len(COLUMNS), n) float64, birinchi qator ts.
+    Fayllar mmap orqali o'qiladi, yozish esa vaqtinchalik fayl + os.replace bilan atomar.
+    """
+
+    def __init__(self, root_dir: str, max_bars: int = 2000):
+        self.root_dir = root_dir
+        self.max_bars = max_bars
+        self._loaded: Dict[Tuple[str, str], Candles] = {}
+        os.makedirs(root_dir, exist_ok=True)
+
+    def _path(self, epic: str, resolution: str) -> str:
+        safe_epic = re.sub(r"[^A-Za-z0-9_.-]", "_", epic)
+        return os.path.join(self.root_dir, f"{safe_epic}_{resolution}.npy")
+
+    def load(self, epic: str, resolution: str) -> Candles:
+        key = (epic, resolution)
+        if key in self._loaded:
+            return self._loaded[key]
+        path = self._path(epic, resolution)
+        candles = Candles.empty()
+        if os.path.exists(path):
+            try:
+                data = np.load(path, mmap_mode="r")
+                if data.ndim == 2 and data.shape[0] == 1 + len(COLUMNS):
+                    candles = Candles(np.asarray(data[0], dtype=np.int64), data[1:])
+                else:
+                    logger.warning(f"Sham fayli formati noto'g'ri, e'tiborsiz qoldirildi: {path}")
+            except Exception as e:
+                logger.warning(f"Sham faylini o'qishda xato ({path}): {e}")
+        self._loaded[key] = candles
+        return candles
+
+    def save(self, epic: str, resolution: str, candles: Candles):
+        candles = candles.tail(self.max_bars)
+        path = self._path(epic, resolution)
+        data = np.vstack([candles.ts.astype(np.float64)[None, :], candles.values])
+        # har bir yozuv uchun noyob vaqtinchalik fayl: parallel saqlashlar bir-birini buzmaydi
+        with tempfile.NamedTemporaryFile(dir=self.root_dir, prefix=os.path.basename(path), suffix=".tmp",
+                                         delete=False) as f:
+            tmp_path = f.name
+            try:
+                np.save(f, data)
+            except BaseException:
+                f.close()
+                os.unlink(tmp_path)
+                raise
+        os.replace(tmp_path, path)
+        self._loaded[(epic, resolution)] = candles
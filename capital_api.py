@@ -6,13 +6,22 @@ import websockets
 import ssl
 import certifi
 import asyncio
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Callable, List, Optional, Tuple, TypedDict
 import base64
+import time
 
 from Cryptodome.Cipher import PKCS1_v1_5
 from Cryptodome.PublicKey import RSA
 from datetime import datetime
 
+from market_cache import MarketInfoCache
+from bar_builder import BarBuilder
+from position_book import OpenPosition, PositionBook
+from candle_cache import CandleCache, shared_candle_cache
+from candle_store import (
+    CandleStore, Candles, RESOLUTION_SECONDS, decode_prices_bytes, merge_candles, ms_to_iso,
+)
+
 # Relative import — loyihangiz strukturasiga mos holda config.py ichidagi o'zgaruvchilar
 from config import (
     CAPITAL_COM_DEMO_API_KEY,
@@ -22,6 +31,7 @@ from config import (
     CAPITAL_COM_REAL_API_KEY,
     CAPITAL_COM_DEMO_API_KEY_PASSWORD,
     CAPITAL_COM_REAL_API_KEY_PASSWORD,
+    CANDLE_STORE_DIR,
 )
 
 # (Ixtiyoriy) agar kod boshqa joylarda tahlil va indikatorlar uchun pandas/talib/np ishlatsa,
@@ -51,6 +61,17 @@ class CapitalAPIError(Exception):
         self.data = data or {}
 
 
+class MarketSnapshot(TypedDict):
+    """get_markets_snapshot natijasidagi bitta instrument holati."""
+    epic: str
+    bid: Optional[float]
+    offer: Optional[float]
+    status: str
+    min_size: float
+    size_step: float
+    max_size: Optional[float]
+
+
 # =====================================================================================
 # Capital.com API Class
 # =====================================================================================
@@ -61,11 +82,25 @@ class CapitalComAPI:
       CapitalComAPI(username, password,
                     demo_api_key=None, real_api_key=None,
                     demo_api_key_password=None, real_api_key_password=None,
-                    account_type='demo')
+                    account_type='demo',
+                    connector_limit=20, dns_cache_ttl=300,
+                    keepalive_timeout=60.0, request_timeout=30.0,
+                    market_cache_size=128, market_static_ttl=21600,
+                    market_dynamic_ttl=30.0, quote_max_age=5.0,
+                    candle_store=None, candle_cache=None)
+
+    Barcha REST so'rovlar bitta uzoq yashovchi (keep-alive) aiohttp sessiyasi
+    orqali yuboriladi. Ishlatib bo'lgach ``await api.close()`` chaqiring yoki
+    ``async with CapitalComAPI(...) as api:`` shaklida foydalaning.
     """
 
     current_prices: Dict[str, Dict[str, float]] = {}
 
+    # /api/v1/markets?epics=... bitta so'rovda qabul qiladigan maksimal epic soni
+    MARKETS_EPICS_LIMIT = 50
+    # /api/v1/prices 'max' parametrining yuqori chegarasi
+    PRICES_MAX_POINTS = 1000
+
     def __init__(
         self,
         username: str,
@@ -75,6 +110,16 @@ class CapitalComAPI:
         demo_api_key_password: Optional[str] = None,
         real_api_key_password: Optional[str] = None,
         account_type: str = "demo",
+        connector_limit: int = 20,
+        dns_cache_ttl: int = 300,
+        keepalive_timeout: float = 60.0,
+        request_timeout: float = 30.0,
+        market_cache_size: int = 128,
+        market_static_ttl: float = 6 * 3600,
+        market_dynamic_ttl: float = 30.0,
+        quote_max_age: float = 5.0,
+        candle_store: Optional[CandleStore] = None,
+        candle_cache: Optional[CandleCache] = None,
     ):
         self.username = username
         self.password = password
@@ -93,6 +138,38 @@ class CapitalComAPI:
         self.cst_token: Optional[str] = None
         self.websocket_connection = None
 
+        # HTTP connection pool sozlamalari (sessiya birinchi so'rovda yaratiladi)
+        self.connector_limit = connector_limit
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+        # Websocket kotirovkasi shu soniyadan eski bo'lsa REST narxiga o'tiladi
+        self.quote_max_age = quote_max_age
+
+        # Tarixiy shamlar diskda saqlanadi, har so'rovda faqat yangi barlar olinadi
+        self.candle_store = candle_store or CandleStore(CANDLE_STORE_DIR)
+        self._candle_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        # Bar yopilguncha amal qiladigan umumiy xotira keshi (barcha API obyektlari uchun bitta)
+        self.candle_cache = candle_cache or shared_candle_cache
+        # Websocket kotirovkalaridan lokal quriladigan OHLC barlar
+        self.bar_builder = BarBuilder()
+        # Har bir websocket kotirovkasida chaqiriladi: callback(epic, bid, ask)
+        self._quote_listeners: List[Callable[[str, float, float], None]] = []
+
+        # Ochiq pozitsiyalar daftari (xotirada; REST bilan davriy solishtiriladi)
+        self.position_book = PositionBook()
+        self._book_lock = asyncio.Lock()
+
+        # Instrument metadata keshi (dealSize, lot step, currency uzoq; marketStatus qisqa)
+        self.market_cache = MarketInfoCache(
+            self._get_market_info,
+            max_entries=market_cache_size,
+            static_ttl=market_static_ttl,
+            dynamic_ttl=market_dynamic_ttl,
+        )
+
         # set base according to account_type
         if self.account_type == "real":
             self.api_key = self.real_api_key
@@ -113,6 +190,7 @@ class CapitalComAPI:
             "positions": "/api/v1/positions",
             "open_position": "/api/v1/positions",
             "close_position": "/api/v1/positions/",  # append deal id
+            "confirms": "/api/v1/confirms/",  # append dealReference
             "markets": "/api/v1/markets",
             "prices": "/api/v1/prices",
         }
@@ -135,26 +213,43 @@ class CapitalComAPI:
         if self.session_token:
             headers["X-SECURITY-TOKEN"] = self.session_token
         return headers
-    async def get_cached_market_info(self, epic: str) -> Dict[str, Any]:
-        """Keshlangan bozor ma'lumotlarini olish"""
-        current_time = time.time()
-        
-        # Agar ma'lumot keshlangan va vaqti o'tmagan bo'lsa
-        if (
-            epic in self.market_cache
-            and epic in self.cache_expiry
-            and current_time < self.cache_expiry[epic]
-        ):
-            return self.market_cache[epic]
-        
-        # Yangi ma'lumot olish
-        market_info = await self._get_market_info(epic)
-        
-        if market_info:
-            self.market_cache[epic] = market_info
-            self.cache_expiry[epic] = current_time + self.cache_duration
-        
-        return market_info
+
+    # -------------------------
+    # HTTP session (connection pool)
+    # -------------------------
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Umumiy keep-alive sessiyani qaytaradi, yopilgan bo'lsa qayta yaratadi."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.connector_limit,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.request_timeout),
+            )
+        return self._session
+
+    async def close(self):
+        """HTTP sessiyani va undagi barcha ulanishlarni yopadi."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self) -> "CapitalComAPI":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def get_cached_market_info(self, epic: str, include_dynamic: bool = False,
+                                     max_dynamic_age: Optional[float] = None) -> Dict[str, Any]:
+        """Keshlangan bozor ma'lumotlarini olish.
+        include_dynamic=True bo'lsa marketStatus/bid/offer ham yangi bo'lishi kafolatlanadi
+        (max_dynamic_age berilsa — shu soniyadan eski bo'lmagan).
+        """
+        return await self.market_cache.get(epic, include_dynamic=include_dynamic, max_dynamic_age=max_dynamic_age)
 
     def _full_url(self, path_or_url: str) -> str:
         """Return full URL if path given, otherwise return as-is."""
@@ -182,25 +277,28 @@ class CapitalComAPI:
     # Low-level HTTP helpers
     # -------------------------
     async def _get_json(self, url_or_path: str, params: Dict[str, Any] = None) -> Dict[str, Any]:
+        body = await self._get_bytes(url_or_path, params=params)
+        return json.loads(body) if body else {}
+
+    async def _get_bytes(self, url_or_path: str, params: Dict[str, Any] = None) -> bytes:
+        """GET javob tanasini xom holda qaytaradi (tana bir marta o'qiladi, parse chaqiruvchida)."""
         # _full_url metodidan foydalanish
         url = self._full_url(url_or_path)
         try:
-            async with aiohttp.ClientSession(headers=self.headers) as session:
-                async with session.get(url, params=params) as resp:
-                    text = await resp.text()
-                    if not resp.ok:
-                        # try parse body for more info
-                        try:
-                            data = json.loads(text)
-                        except Exception:
-                            data = text
-                        msg = f"GET {url} returned {resp.status}: {data}"
-                        logger.error(msg)
-                        raise CapitalAPIError(resp.status, msg, {"body": data})
-                    if text:
-                        return await resp.json()
-                    return {}
-        except aiohttp.ClientError as e:
+            session = self._get_session()
+            async with session.get(url, params=params, headers=self.headers) as resp:
+                body = await resp.read()
+                if not resp.ok:
+                    # try parse body for more info
+                    try:
+                        data = json.loads(body)
+                    except Exception:
+                        data = body.decode("utf-8", errors="replace")
+                    msg = f"GET {url} returned {resp.status}: {data}"
+                    logger.error(msg)
+                    raise CapitalAPIError(resp.status, msg, {"body": data})
+                return body
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error("HTTP GET error: %s", e)
             raise CapitalAPIError(500, f"HTTP GET error: {e}")
 
@@ -208,21 +306,21 @@ class CapitalComAPI:
         # _full_url metodidan foydalanish
         url = self._full_url(url_or_path)
         try:
-            async with aiohttp.ClientSession(headers=self.headers) as session:
-                async with session.post(url, data=json.dumps(payload)) as resp:
-                    text = await resp.text()
-                    if not resp.ok:
-                        try:
-                            data = json.loads(text)
-                        except Exception:
-                            data = text
-                        msg = f"POST {url} returned {resp.status}: {data}"
-                        logger.error(msg)
-                        raise CapitalAPIError(resp.status, msg, {"body": data})
-                    if text:
-                        return await resp.json()
-                    return {}
-        except aiohttp.ClientError as e:
+            session = self._get_session()
+            async with session.post(url, data=json.dumps(payload), headers=self.headers) as resp:
+                text = await resp.text()
+                if not resp.ok:
+                    try:
+                        data = json.loads(text)
+                    except Exception:
+                        data = text
+                    msg = f"POST {url} returned {resp.status}: {data}"
+                    logger.error(msg)
+                    raise CapitalAPIError(resp.status, msg, {"body": data})
+                if text:
+                    return await resp.json()
+                return {}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error("HTTP POST error: %s", e)
             raise CapitalAPIError(500, f"HTTP POST error: {e}")
 
@@ -233,21 +331,21 @@ class CapitalComAPI:
         # _full_url metodidan foydalanish
         url = self._full_url(path)
         try:
-            async with aiohttp.ClientSession(headers=self.headers) as session:
-                async with session.request(method, url, **kwargs) as response:
-                    text = await response.text()
-                    if not response.ok:
-                        try:
-                            data = json.loads(text)
-                        except Exception:
-                            data = text
-                        error_message = f"Request error: {method} {url} | Status: {response.status} | Message: {data}"
-                        logger.error(error_message)
-                        raise CapitalAPIError(response.status, error_message, {"body": data})
-                    if text:
-                        return await response.json()
-                    return {}
-        except aiohttp.ClientError as e:
+            session = self._get_session()
+            async with session.request(method, url, headers=self.headers, **kwargs) as response:
+                text = await response.text()
+                if not response.ok:
+                    try:
+                        data = json.loads(text)
+                    except Exception:
+                        data = text
+                    error_message = f"Request error: {method} {url} | Status: {response.status} | Message: {data}"
+                    logger.error(error_message)
+                    raise CapitalAPIError(response.status, error_message, {"body": data})
+                if text:
+                    return await response.json()
+                return {}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error(f"HTTP request error occurred: {e}")
             raise CapitalAPIError(500, f"HTTP request error occurred: {e}")
 
@@ -264,19 +362,19 @@ class CapitalComAPI:
         url = self._full_url(path)
         
         try:
-            async with aiohttp.ClientSession(headers=headers) as session:
-                async with session.get(url) as response:
-                    text = await response.text()
-                    if not response.ok:
-                        try:
-                            data = json.loads(text)
-                        except Exception:
-                            data = text
-                        msg = f"Encryption key GET returned {response.status}: {data}"
-                        logger.error(msg)
-                        raise CapitalAPIError(response.status, msg, {"body": data})
-                    return await response.json()
-        except aiohttp.ClientError as e:
+            session = self._get_session()
+            async with session.get(url, headers=headers) as response:
+                text = await response.text()
+                if not response.ok:
+                    try:
+                        data = json.loads(text)
+                    except Exception:
+                        data = text
+                    msg = f"Encryption key GET returned {response.status}: {data}"
+                    logger.error(msg)
+                    raise CapitalAPIError(response.status, msg, {"body": data})
+                return await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error("Failed to get encryption key: %s", e)
             raise CapitalAPIError(500, f"Failed to get encryption key: {e}")
 
@@ -341,36 +439,36 @@ class CapitalComAPI:
         url = self._full_url(path)
 
         try:
-            async with aiohttp.ClientSession(headers=headers) as session:
-                async with session.post(url, data=json.dumps(payload)) as resp:
-                    text = await resp.text()
-                    if not resp.ok:
-                        try:
-                            data = json.loads(text)
-                        except Exception:
-                            data = text
-                        msg = f"Login failed {resp.status}: {data}"
-                        logger.error(msg)
-                        return {"success": False, "message": msg}
-
-                    # on success, tokens are in headers
-                    self.cst_token = resp.headers.get("CST")
-                    self.session_token = resp.headers.get("X-SECURITY-TOKEN")
-
-                    if not self.cst_token or not self.session_token:
-                        # sometimes tokens may be in body as well; try to parse body for debugging
-                        try:
-                            body = await resp.json()
-                        except Exception:
-                            body = text
-                        msg = f"Login succeeded but tokens missing; body: {body}"
-                        logger.error(msg)
-                        return {"success": False, "message": msg}
-
-                    logger.info("Login successful, tokens stored.")
-                    return {"success": True, "message": "Login successful."}
-
-        except aiohttp.ClientError as e:
+            session = self._get_session()
+            async with session.post(url, data=json.dumps(payload), headers=headers) as resp:
+                text = await resp.text()
+                if not resp.ok:
+                    try:
+                        data = json.loads(text)
+                    except Exception:
+                        data = text
+                    msg = f"Login failed {resp.status}: {data}"
+                    logger.error(msg)
+                    return {"success": False, "message": msg}
+
+                # on success, tokens are in headers
+                self.cst_token = resp.headers.get("CST")
+                self.session_token = resp.headers.get("X-SECURITY-TOKEN")
+
+                if not self.cst_token or not self.session_token:
+                    # sometimes tokens may be in body as well; try to parse body for debugging
+                    try:
+                        body = await resp.json()
+                    except Exception:
+                        body = text
+                    msg = f"Login succeeded but tokens missing; body: {body}"
+                    logger.error(msg)
+                    return {"success": False, "message": msg}
+
+                logger.info("Login successful, tokens stored.")
+                return {"success": True, "message": "Login successful."}
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             logger.error("Login request error: %s", e)
             return {"success": False, "message": f"Login request error: {e}"}
 
@@ -534,6 +632,9 @@ class CapitalComAPI:
             if not prices:
                 return None
             last = prices[-1]
+            close = last.get("closePrice")
+            if isinstance(close, dict) and close.get("bid") is not None and close.get("ask") is not None:
+                return (float(close["bid"]) + float(close["ask"])) / 2.0
             bid = last.get("bid") or last.get("bidPrice") or last.get("bid_level")
             ask = last.get("ask") or last.get("askPrice") or last.get("offer")
             if bid is not None and ask is not None:
@@ -546,12 +647,69 @@ class CapitalComAPI:
             logger.warning("Cannot fetch last price for %s: %s", epic, e)
             return None
 
+    async def get_quote(self, epic: str, max_age: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Narx manbai abstraksiyasi: avval websocket (stream) kotirovkasi, agar u yo'q
+        yoki max_age soniyadan eski bo'lsa — REST (market snapshot, keyin oxirgi sham). REST snapshot
+        ham max_age dan eski bo'lmasligi kerak, aks holda /markets/{epic} qayta so'raladi.
+        Natija: {"buy", "sell", "mid", "source": "stream"|"rest"|"none", "age"}
+        """
+        max_age = self.quote_max_age if max_age is None else max_age
+        quote = self.current_prices.get(epic)
+        if quote and quote.get("received_at") is not None:
+            age = time.monotonic() - quote["received_at"]
+            buy, sell = quote.get("buy") or 0.0, quote.get("sell") or 0.0
+            if age <= max_age and buy > 0 and sell > 0:
+                return {"buy": buy, "sell": sell, "mid": (buy + sell) / 2.0, "source": "stream", "age": age}
+
+        mkt = await self.get_cached_market_info(epic, include_dynamic=True, max_dynamic_age=max_age)
+        snap = mkt.get("snapshot") or {}
+        try:
+            buy, sell = float(snap.get("bid") or 0), float(snap.get("offer") or 0)
+        except (TypeError, ValueError):
+            buy, sell = 0.0, 0.0
+        if buy > 0 and sell > 0:
+            return {"buy": buy, "sell": sell, "mid": (buy + sell) / 2.0, "source": "rest", "age": None}
+
+        mid = await self._get_last_price(epic)
+        if mid and mid > 0:
+            return {"buy": None, "sell": None, "mid": mid, "source": "rest", "age": None}
+        return {"buy": None, "sell": None, "mid": None, "source": "none", "age": None}
+
     def _round_to_step(self, value: float, step: float) -> float:
         if step <= 0:
             return value
         # floor to step
         return (value // step) * step
 
+    @staticmethod
+    def _parse_deal_size(mkt: Dict[str, Any]) -> Tuple[float, float, Optional[float]]:
+        """Market javobidan (min, step, max) kontrakt hajmi chegaralarini ajratadi."""
+        min_size, size_step, max_size = 1.0, 1.0, None
+        try:
+            if "dealSize" in mkt:
+                min_size = float(mkt["dealSize"].get("min", min_size))
+                size_step = float(mkt["dealSize"].get("step", size_step))
+                max_size = float(mkt["dealSize"].get("max", 0)) or None
+            elif "dealSizeConfiguration" in mkt:
+                cfg = mkt["dealSizeConfiguration"]
+                min_size = float(cfg.get("min", min_size))
+                size_step = float(cfg.get("step", size_step))
+                max_size = float(cfg.get("max", 0)) or None
+            elif "minDealSize" in mkt:
+                min_size = float(mkt.get("minDealSize", min_size))
+            elif isinstance(mkt.get("dealingRules"), dict):
+                # /api/v1/markets/{epic} va ?epics= javoblaridagi format
+                rules = mkt["dealingRules"]
+                min_size = float((rules.get("minDealSize") or {}).get("value", min_size))
+                size_step = float((rules.get("minSizeIncrement") or {}).get("value", size_step))
+                max_size = float((rules.get("maxDealSize") or {}).get("value", 0)) or None
+            if "maxDealSize" in mkt:
+                max_size = float(mkt.get("maxDealSize", 0)) or max_size
+        except Exception:
+            pass
+        return min_size, size_step, max_size
+
     async def _resolve_epic(self, currency_pair: str) -> str:
         # Try mapping from ACTIVE_INSTRUMENTS imported from config
         try:
@@ -586,30 +744,17 @@ class CapitalComAPI:
         # EPIC topamiz (masalan: Tesla -> TSLA)
         epic = await self._resolve_epic(currency_pair)
 
-        # Bozor ma'lumotlari
-        mkt = await self._get_market_info(epic)
-        min_size, size_step, max_size = 1.0, 1.0, None
-        try:
-            if "dealSize" in mkt:
-                min_size = float(mkt["dealSize"].get("min", min_size))
-                size_step = float(mkt["dealSize"].get("step", size_step))
-                max_size = float(mkt["dealSize"].get("max", 0)) or None
-            elif "dealSizeConfiguration" in mkt:
-                cfg = mkt["dealSizeConfiguration"]
-                min_size = float(cfg.get("min", min_size))
-                size_step = float(cfg.get("step", size_step))
-                max_size = float(cfg.get("max", 0)) or None
-            elif "minDealSize" in mkt:
-                min_size = float(mkt.get("minDealSize", min_size))
-            if "maxDealSize" in mkt:
-                max_size = float(mkt.get("maxDealSize", 0)) or max_size
-        except Exception:
-            pass
+        # Bozor ma'lumotlari (dealSize statik — keshdan)
+        mkt = await self.get_cached_market_info(epic)
+        min_size, size_step, max_size = self._parse_deal_size(mkt)
 
         # Agar size yo'q bo'lsa — amount asosida hisoblaymiz
+        price_source = None
         if size is None:
             if amount and amount > 0:
-                last_price = await self._get_last_price(epic)
+                quote = await self.get_quote(epic)
+                price_source = quote["source"]
+                last_price = quote["mid"]
                 if last_price and last_price > 0:
                     raw = amount / last_price
                     size = self._round_to_step(raw, size_step)
@@ -636,8 +781,9 @@ class CapitalComAPI:
         try:
             resp = await self._make_request("POST", self.endpoints["open_position"], data=json.dumps(payload))
             deal_ref = resp.get("dealReference") or resp.get("dealId")
-            logger.info("Pozitsiya ochildi: %s %s size=%s deal=%s", epic, direction_u, size, deal_ref)
-            return {"success": True, "deal_id": deal_ref, "details": resp}
+            logger.info("Pozitsiya ochildi: %s %s size=%s deal=%s price_source=%s", epic, direction_u, size, deal_ref, price_source)
+            self.position_book.note_opened(deal_ref, epic, direction_u, float(size))
+            return {"success": True, "deal_id": deal_ref, "details": resp, "price_source": price_source}
         except Exception as e:
             logger.error("Pozitsiya ochishda xato: %s", e)
             return {"success": False, "error": str(e)}
@@ -661,8 +807,19 @@ class CapitalComAPI:
         deal_ref = resp.get("dealReference") or resp.get("dealId")
         if not deal_ref:
             raise CapitalAPIError(500, f"Error opening trade: {resp}")
+        self.position_book.note_opened(deal_ref, instrument_id, direction, amount)
         return {"success": True, "deal_id": deal_ref}
 
+    async def get_deal_confirmation(self, deal_reference: str) -> Dict[str, Any]:
+        """
+        GET /api/v1/confirms/{dealReference}: buyurtma holati (dealStatus, dealId, level, ...).
+        Xato bo'lsa CapitalAPIError (tarmoq/timeout — 500).
+        """
+        if not self.cst_token or not self.session_token:
+            raise CapitalAPIError(401, "Authentication tokens are missing.")
+        data = await self._make_request("GET", f"{self.endpoints['confirms']}{deal_reference}")
+        return data if isinstance(data, dict) else {}
+
     async def close_position(self, deal_id: Optional[str] = None, position_id: Optional[str] = None, direction: Optional[str] = None, epic: Optional[str] = None, size: Optional[float] = None) -> Dict[str, Any]:
         """
         Close a position. Accepts either deal_id or position_id param (both same).
@@ -699,6 +856,7 @@ class CapitalComAPI:
             # still treat as success if no error thrown (API varia)
             logger.warning("Close response did not include explicit reference: %s", resp)
         logger.info("Position %s closed (response: %s)", deal_id, resp)
+        self.position_book.note_closed(deal_id)
         return {"success": True, "details": resp}
 
     # -------------------------
@@ -707,37 +865,7 @@ class CapitalComAPI:
     async def get_open_positions(self, account_type: str = None) -> List[Dict[str, Any]]:
         """Ochiq pozitsiyalarni olish."""
         try:
-            endpoint = "/api/v1/positions"
-            result = await self._make_request("GET", endpoint)
-
-            # API javobini tahlil qilish
-            if isinstance(result, dict):
-                if "positions" in result:
-                    positions_list = []
-                    for position_item in result["positions"]:
-                        if "position" in position_item and "market" in position_item:
-                            # 🔥 Position va Market ni birlashtirib qaytaramiz
-                            merged = {
-                                **position_item["position"],   # barcha position fieldlari
-                                **position_item["market"]      # barcha market fieldlari
-                            }
-                            positions_list.append(merged)
-                        elif "position" in position_item:
-                            positions_list.append(position_item["position"])
-                        else:
-                            positions_list.append(position_item)
-                    return positions_list
-
-                elif "errorCode" in result:
-                    logger.error(f"API xatosi: {result.get('errorCode')} - {result.get('errorMessage', '')}")
-                    return []
-
-            elif isinstance(result, list):
-                return result
-
-            logger.warning(f"Noma'lum data formati: {type(result)} - {result}")
-            return []
-
+            return await self._fetch_open_positions()
         except CapitalAPIError as e:
             logger.error(f"CapitalAPIError in get_open_positions: {e}")
             return []
@@ -745,6 +873,92 @@ class CapitalComAPI:
             logger.error(f"get_open_positions xatosi: {e}")
             return []
 
+    async def _fetch_open_positions(self) -> List[Dict[str, Any]]:
+        """/api/v1/positions javobini tekis ro'yxatga aylantiradi. Xatolar yuqoriga chiqariladi."""
+        result = await self._make_request("GET", "/api/v1/positions")
+
+        # API javobini tahlil qilish
+        if isinstance(result, list):
+            return result
+        if not isinstance(result, dict):
+            raise CapitalAPIError(500, f"Noma'lum data formati: {type(result)}")
+        if "errorCode" in result:
+            raise CapitalAPIError(500, f"API xatosi: {result.get('errorCode')} - {result.get('errorMessage', '')}", result)
+
+        positions_list = []
+        for position_item in result.get("positions", []):
+            if "position" in position_item and "market" in position_item:
+                # 🔥 Position va Market ni birlashtirib qaytaramiz
+                positions_list.append({
+                    **position_item["position"],   # barcha position fieldlari
+                    **position_item["market"]      # barcha market fieldlari
+                })
+            elif "position" in position_item:
+                positions_list.append(position_item["position"])
+            else:
+                positions_list.append(position_item)
+        return positions_list
+
+    @staticmethod
+    def _parse_open_position(item: Dict[str, Any]) -> Optional[OpenPosition]:
+        """get_open_positions elementini (birlashtirilgan position + market) OpenPosition ga aylantiradi."""
+        if not isinstance(item, dict):
+            return None
+        deal_id = item.get("dealId") or item.get("positionId")
+        if not deal_id:
+            return None
+
+        def _num(value, default=None):
+            try:
+                return float(value) if value is not None else default
+            except (TypeError, ValueError):
+                return default
+
+        return OpenPosition(
+            deal_id=str(deal_id),
+            deal_reference=item.get("dealReference"),
+            epic=item.get("epic"),
+            instrument_name=item.get("instrumentName") or item.get("epic") or "Noma'lum",
+            direction=str(item.get("direction") or item.get("dealType") or "").upper(),
+            level=_num(item.get("level") or item.get("openPrice"), 0.0),
+            size=_num(item.get("size") or item.get("dealSize"), 0.0),
+            upl=_num(item.get("upl"), 0.0),
+            leverage=_num(item.get("leverage")),
+            created_date_utc=item.get("createdDateUTC") or item.get("createdDate"),
+            bid=_num(item.get("bid")),
+            offer=_num(item.get("offer")),
+        )
+
+    async def get_position_snapshot(self) -> List[OpenPosition]:
+        """
+        Barcha ochiq pozitsiyalar bitta /api/v1/positions so'rovi bilan (pozitsiya bo'yicha
+        get_position_details chaqirilmaydi). Natija pozitsiyalar daftariga ham yoziladi;
+        so'rov muvaffaqiyatsiz bo'lsa daftardagi oxirgi holat qaytariladi.
+        """
+        try:
+            positions = await self._fetch_open_positions()
+        except Exception as e:
+            logger.error(f"Ochiq pozitsiyalarni olishda xato, daftardagi holat ishlatiladi: {e}")
+            return self.position_book.positions()
+        snapshot = []
+        for item in positions:
+            parsed = self._parse_open_position(item)
+            if parsed:
+                snapshot.append(parsed)
+        self.position_book.reconcile(snapshot)
+        return snapshot
+
+    async def get_book_positions(self) -> List[OpenPosition]:
+        """
+        Ochiq pozitsiyalar xotiradagi daftardan. Daftar eskirgan bo'lsa (max_age o'tgan yoki
+        o'zimiz pozitsiya ochganmiz) avval REST bilan solishtiriladi — bir vaqtda bitta so'rov.
+        """
+        if self.position_book.fresh():
+            return self.position_book.positions()
+        async with self._book_lock:
+            if self.position_book.fresh():
+                return self.position_book.positions()
+            return await self.get_position_snapshot()
 
     async def debug_positions(self):
         """API javobini debug qilish"""
@@ -779,16 +993,21 @@ class CapitalComAPI:
 
                     ping_payload = {"destination": "ping", "cst": self.cst_token, "securityToken": self.session_token}
 
-                    while True:
-                        try:
-                            message = await asyncio.wait_for(ws.recv(), timeout=600)
-                            self.handle_websocket_message(message)
-                        except asyncio.TimeoutError:
-                            await ws.send(json.dumps(ping_payload))
-                            logger.info("Sent websocket ping.")
-                        except websockets.exceptions.ConnectionClosed as e:
-                            logger.error("Websocket closed: %s", e)
-                            break
+                    try:
+                        while True:
+                            try:
+                                message = await asyncio.wait_for(ws.recv(), timeout=600)
+                                self.handle_websocket_message(message)
+                            except asyncio.TimeoutError:
+                                await ws.send(json.dumps(ping_payload))
+                                logger.info("Sent websocket ping.")
+                            except websockets.exceptions.ConnectionClosed as e:
+                                logger.error("Websocket closed: %s", e)
+                                break
+                    finally:
+                        # uzilish davridagi kotirovkalar yo'qoldi — lokal barlar qayta to'ldirilishi kerak
+                        self.websocket_connection = None
+                        self.bar_builder.mark_stale()
             except Exception as e:
                 logger.error("Websocket connection error: %s. Reconnecting in 5s...", e)
                 await asyncio.sleep(5)
@@ -799,10 +1018,20 @@ class CapitalComAPI:
         subscribe_payload = {"destination": "marketData.subscribe", "cst": self.cst_token, "securityToken": self.session_token, "payload": {"epics": epics}}
         try:
             await self.websocket_connection.send(json.dumps(subscribe_payload))
+            self.bar_builder.set_subscribed(epics)
             logger.info("Subscribed to: %s", epics)
         except Exception as e:
             logger.error("Error sending websocket subscribe: %s", e)
 
+    def add_quote_listener(self, callback: Callable[[str, float, float], None]):
+        """Websocket kotirovkalariga obuna: callback(epic, bid, ask)."""
+        if callback not in self._quote_listeners:
+            self._quote_listeners.append(callback)
+
+    def remove_quote_listener(self, callback: Callable[[str, float, float], None]):
+        if callback in self._quote_listeners:
+            self._quote_listeners.remove(callback)
+
     def handle_websocket_message(self, message: str):
         try:
             data = json.loads(message)
@@ -818,8 +1047,18 @@ class CapitalComAPI:
                     self.current_prices[epic] = {
     "buy": float(buy),
     "sell": float(sell),
-    "timestamp": datetime.utcnow().isoformat() + "Z"
+    "timestamp": datetime.utcnow().isoformat() + "Z",
+    "received_at": time.monotonic(),
 }
+                    ts_ms = payload.get("timestamp")
+                    ts_ms = int(ts_ms) if ts_ms else int(time.time() * 1000)
+                    self.bar_builder.on_quote(epic, float(buy), float(sell), ts_ms)
+                    self.position_book.on_quote(epic, float(buy), float(sell))
+                    for callback in self._quote_listeners:
+                        try:
+                            callback(epic, float(buy), float(sell))
+                        except Exception as e:
+                            logger.error(f"Kotirovka listenerida xato: {e}")
                     logger.debug("Price update %s buy=%s sell=%s", epic, buy, sell)
         except json.JSONDecodeError:
             logger.error("Websocket JSON decode error.")
@@ -933,32 +1172,83 @@ class CapitalComAPI:
 
 
     async def get_historical_prices(self, epic: str, resolution: str, num_points: int) -> List[Dict[str, Any]]:
-        """Tarixiy narxlarni olish - REKURSIYASIZ soddalashtirilgan versiya"""
+        """Tarixiy narxlarni olish (diskdagi sham ombori + faqat yangi barlarni yuklash)."""
         try:
-            # FAQAT bitta EPIC formatini ishlatish (alternative larsiz)
-            path = f"/api/v1/prices/{epic}"
-            params = {
-                "resolution": resolution,
-                "max": num_points,
-            }
-            
             logger.debug(f"Historical prices so'rovi: {epic}, {resolution}, {num_points}")
-            
-            # ✅ TO'GRIDAN-TO'G'RI aiohttp dan foydalaning, ichki funksiyalarsiz
-            url = self._full_url(path)
-            async with aiohttp.ClientSession(headers=self.headers) as session:
-                async with session.get(url, params=params) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data.get("prices", [])
-                    else:
-                        logger.error(f"HTTP {response.status}: {await response.text()}")
-                        return []
-                
+            candles = await self.get_candles(epic, resolution, num_points)
+            return candles.to_prices()
         except Exception as e:
             logger.error(f"Historical prices error for {epic}: {e}")
             return []
 
+    async def get_candles(self, epic: str, resolution: str, num_points: int) -> Candles:
+        """
+        Oxirgi num_points shamni Candles ko'rinishida qaytaradi.
+        Websocket ulangan bo'lsa obuna qilingan va kotirovkasi yangi epiclar uchun MINUTE..HOUR_4
+        barlar lokal bar builderdan olinadi (REST faqat backfill / qayta to'ldirish uchun). Aks holda bar davomida takroriy so'rovlar
+        xotira keshidan (HTTP siz) beriladi; kesh massivlari faqat o'qish uchun.
+        """
+        if (self.websocket_connection is not None and resolution in self.bar_builder.resolutions
+                and self.bar_builder.streaming(epic)):
+            local = self.bar_builder.get(epic, resolution, num_points)
+            if local is not None:
+                return local
+            # startup, uzilish yoki kotirovkalar tanaffusidan keyin: REST (bar davomida keshdan) bilan
+            # to'ldirib, keyin lokal barlar bilan davom etamiz
+            candles = await self.candle_cache.get(epic, resolution, num_points, self._fetch_candles)
+            self.bar_builder.seed(epic, resolution, candles)
+            return candles
+        return await self.candle_cache.get(epic, resolution, num_points, self._fetch_candles)
+
+    async def _fetch_candles(self, epic: str, resolution: str, num_points: int) -> Candles:
+        """
+        (epic, resolution) shamlarini diskdagi ombordan oladi va oxirgi saqlangan bardan
+        keyingi barlarni from/to bilan yuklab birlashtiradi. Ombor bo'sh, qisqa yoki
+        uzilish katta bo'lsa — to'liq oyna (max=num_points) yuklanadi.
+        """
+        lock = self._candle_locks.setdefault((epic, resolution), asyncio.Lock())
+        async with lock:
+            stored = self.candle_store.load(epic, resolution)
+            bar_ms = RESOLUTION_SECONDS.get(resolution, 0) * 1000
+            now_ms = int(time.time() * 1000)
+            window = min(num_points, self.PRICES_MAX_POINTS)
+            incremental = bool(
+                bar_ms
+                and len(stored) >= num_points
+                and now_ms - int(stored.ts[-1]) < window * bar_ms
+            )
+
+            path = f"{self.endpoints['prices']}/{epic}"
+            if incremental:
+                # oxirgi (ehtimol hali yopilmagan) bar ham qayta olinadi va yangilanadi
+                params = {
+                    "resolution": resolution,
+                    "max": self.PRICES_MAX_POINTS,
+                    "from": ms_to_iso(int(stored.ts[-1])),
+                    "to": ms_to_iso(now_ms),
+                }
+            else:
+                params = {"resolution": resolution, "max": window}
+
+            try:
+                body = await self._get_bytes(path, params=params)
+            except CapitalAPIError as e:
+                if incremental and e.status in (400, 404):
+                    # oraliqda yangi bar yo'q
+                    return stored.tail(num_points)
+                raise
+
+            fresh = decode_prices_bytes(body)
+            if not len(fresh):
+                return stored.tail(num_points)
+            if not incremental and len(stored) and fresh.ts[0] > stored.ts[-1]:
+                # eski tarix bilan orada bo'shliq bor — ularni ulamaymiz
+                stored = Candles.empty()
+
+            merged = merge_candles(stored, fresh)
+            await asyncio.to_thread(self.candle_store.save, epic, resolution, merged)
+            return merged.tail(num_points)
+
 
 
     async def search_markets(self, search_term: Optional[str] = None, epics: Optional[List[str]] = None) -> Dict[str, Any]:
@@ -977,6 +1267,66 @@ class CapitalComAPI:
             logger.error(f"Market qidirishda xato: {e}")
             return {}
 
+    async def get_markets_snapshot(self, epics: List[str]) -> Dict[str, MarketSnapshot]:
+        """
+        Bir nechta instrumentning joriy holatini bitta (yoki parallel bir nechta)
+        /api/v1/markets?epics=... so'rovi bilan oladi.
+        Natija: {epic: MarketSnapshot}. Javobda bo'lmagan epic'lar natijaga kirmaydi.
+        """
+        unique_epics = list(dict.fromkeys(e for e in epics if e))
+        if not unique_epics:
+            return {}
+
+        limit = self.MARKETS_EPICS_LIMIT
+        chunks = [unique_epics[i:i + limit] for i in range(0, len(unique_epics), limit)]
+        responses = await asyncio.gather(
+            *(self.search_markets(epics=chunk) for chunk in chunks),
+            return_exceptions=True,
+        )
+
+        snapshot: Dict[str, MarketSnapshot] = {}
+        for resp in responses:
+            if isinstance(resp, Exception):
+                logger.error(f"Market snapshot so'rovida xato: {resp}")
+                continue
+            if not isinstance(resp, dict):
+                continue
+            items = resp.get("marketDetails") or resp.get("markets") or []
+            for item in items:
+                parsed = self._parse_market_snapshot(item)
+                if parsed:
+                    snapshot[parsed["epic"]] = parsed
+                    if "dealingRules" in item:
+                        self.market_cache.prime(parsed["epic"], item)
+        return snapshot
+
+    def _parse_market_snapshot(self, item: Dict[str, Any]) -> Optional[MarketSnapshot]:
+        """marketDetails (instrument/snapshot/dealingRules) yoki tekis markets elementini o'qiydi."""
+        if not isinstance(item, dict):
+            return None
+        instrument = item.get("instrument") or {}
+        snap = item.get("snapshot") or item
+        epic = instrument.get("epic") or item.get("epic")
+        if not epic:
+            return None
+
+        def _to_float(value) -> Optional[float]:
+            try:
+                return float(value) if value is not None else None
+            except (TypeError, ValueError):
+                return None
+
+        min_size, size_step, max_size = self._parse_deal_size(item)
+        return MarketSnapshot(
+            epic=epic,
+            bid=_to_float(snap.get("bid")),
+            offer=_to_float(snap.get("offer", snap.get("ofr"))),
+            status=snap.get("marketStatus") or "UNKNOWN",
+            min_size=min_size,
+            size_step=size_step,
+            max_size=max_size,
+        )
+
     async def get_market_details(self, epic: str) -> Dict[str, Any]:
         """
         maxsus bozor haqida batafsil ma'lumot olish
@@ -1004,14 +1354,14 @@ class CapitalComAPI:
 
             # Aks holda aiohttp orqali so'rov yuboramiz
             url = self._full_url(path)
-            async with aiohttp.ClientSession(headers=self.headers) as session:
-                async with session.get(url, params=params) as resp:
-                    if not resp.ok:
-                        text = await resp.text()
-                        logger.error(f"fetch_historical_prices returned {resp.status}: {text}")
-                        return None
-                    data = await resp.json()
-                    return data
+            session = self._get_session()
+            async with session.get(url, params=params, headers=self.headers) as resp:
+                if not resp.ok:
+                    text = await resp.text()
+                    logger.error(f"fetch_historical_prices returned {resp.status}: {text}")
+                    return None
+                data = await resp.json()
+                return data
 
         except Exception as e:
             logger.error(f"fetch_historical_prices error for {node_id}: {e}")
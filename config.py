@@ -18,7 +18,25 @@ CHAT_ID = int(os.getenv("CHAT_ID"))
 # YANGI O'ZGARISH: API kalitlari uchun maxsus parollar
 CAPITAL_COM_DEMO_API_KEY_PASSWORD = os.getenv("CAPITAL_COM_DEMO_API_KEY_PASSWORD")
 CAPITAL_COM_REAL_API_KEY_PASSWORD = os.getenv("CAPITAL_COM_REAL_API_KEY_PASSWORD")
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash-latest:generateContent"
+GEMINI_API_URL = os.getenv(
+    "GEMINI_API_URL",
+    "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent",
+)
+# Gemini kvotasi (bepul tarif: daqiqasiga 15 so'rov) va bir vaqtdagi so'rovlar chegarasi
+GEMINI_REQUESTS_PER_MINUTE = float(os.getenv("GEMINI_REQUESTS_PER_MINUTE", "15"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+# Circuit breaker: oxirgi N chaqiruvdagi xato / sekin chaqiruvlar ulushi va ochiq turish vaqti
+GEMINI_BREAKER_WINDOW = int(os.getenv("GEMINI_BREAKER_WINDOW", "20"))
+GEMINI_BREAKER_ERROR_RATE = float(os.getenv("GEMINI_BREAKER_ERROR_RATE", "0.5"))
+GEMINI_BREAKER_SLOW_SECONDS = float(os.getenv("GEMINI_BREAKER_SLOW_SECONDS", "8"))
+GEMINI_BREAKER_OPEN_SECONDS = float(os.getenv("GEMINI_BREAKER_OPEN_SECONDS", "60"))
+
+# Tarixiy shamlar (numpy .npy) saqlanadigan papka
+CANDLE_STORE_DIR = os.getenv("CANDLE_STORE_DIR", "candles")
+# Signal funksiyalari uchun epic bo'yicha o'rganilgan resolution afzalliklari
+RESOLUTION_PREFS_FILE = os.getenv("RESOLUTION_PREFS_FILE", "resolution_prefs.json")
+# Buyurtmalar bajarilishi yozuvlari (JSONL, har qatorda bitta FillRecord)
+FILLS_LOG_FILE = os.getenv("FILLS_LOG_FILE", "fills.jsonl")
 
 ALLOWED_USER_ID = 252935510
 
@@ -129,6 +147,13 @@ DEFAULT_SETTINGS = {
     
     # YANGI: Auto savdo sozlamalari
     "auto_trading_enabled": True,
+    "evaluation_concurrency": 4,      # bir vaqtda baholanadigan aktivlar soni
+    "asset_eval_timeout": 30,         # bitta aktivni baholash uchun maksimal vaqt (s)
+    "ai_cache_enabled": True,         # AI tasdiqlari bozor holati bo'yicha keshlanadi (False — har safar yangi so'rov)
+    "ai_batch_enabled": True,         # bir aylanmadagi AI tasdiqlari bitta Gemini so'rovida (JSON massiv)
+    "ai_batch_size": 8,               # bitta batch so'rovdagi maksimal aktivlar soni
+    "ai_latency_budget": 8,           # bitta AI chaqiruvi uchun qat'iy vaqt chegarasi (s)
+    "ai_fallback_policy": "reject",   # AI ishlamasa: "skip" — signal o'tkaziladi, "rules" — faqat qoidalar, "reject" — rad
     "current_trades_per_asset": {
         asset: 0 for asset in ACTIVE_INSTRUMENTS.keys()
     }
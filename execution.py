@@ -0,0 +1,211 @@
+# execution.py
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, TypedDict
+
+from capital_api import CapitalAPIError
+
+logger = logging.getLogger(__name__)
+
+
+class FillRecord(TypedDict):
+    """Bitta buyurtmaning bajarilish yozuvi (fills JSONL faylidagi bitta qator)."""
+    source: str                    # "auto" / "manual"
+    asset: Optional[str]
+    epic: str
+    direction: str
+    size: float
+    deal_reference: Optional[str]
+    deal_id: Optional[str]
+    status: str                    # ACCEPTED / REJECTED / UNCONFIRMED / SUBMIT_FAILED
+    reason: Optional[str]
+    quote_price: Optional[float]   # kirish kotirovkasi (BUY — offer, SELL — bid)
+    fill_level: Optional[float]
+    slippage: Optional[float]      # narx birligida, musbat — biz uchun yomonroq
+    slippage_bps: Optional[float]
+    signal_ts: Optional[float]     # epoch soniya
+    submit_ts: float
+    ack_ts: Optional[float]
+    confirm_ts: Optional[float]
+    signal_to_submit_ms: Optional[float]
+    submit_to_ack_ms: Optional[float]
+    ack_to_confirm_ms: Optional[float]
+
+
+def entry_quote(direction: str, prices: Dict[str, Any]) -> Optional[float]:
+    """
+    Slippage o'lchanadigan kirish narxi: BUY offer ("sell") bo'yicha, SELL bid ("buy") bo'yicha bajariladi.
+    """
+    price = prices.get("sell") if direction.upper() == "BUY" else prices.get("buy")
+    return float(price) if price else None
+
+
+def _retryable(error: CapitalAPIError) -> bool:
+    """Faqat server xatosi (5xx) yoki tarmoq/timeout (capital_api ularni 500 qiladi) qayta so'raladi."""
+    return error.status >= 500
+
+
+def _ms(start: Optional[float], end: Optional[float]) -> Optional[float]:
+    if start is None or end is None:
+        return None
+    return round((end - start) * 1000, 1)
+
+
+class OrderExecutor:
+    """
+    Buyurtmalarni yuboradi va /api/v1/confirms/{dealReference} orqali tasdiqlanishini kutadi:
+      - submit: POST javobi (ack) -> dealReference
+      - confirm: tasdiq eksponensial backoff bilan so'raladi (confirm_timeout gacha)
+      - natija FillRecord: bajarilgan narx, sizing narxiga nisbatan slippage va
+        signal->submit, submit->ack, ack->confirm kechikishlari; JSONL faylga yoziladi
+    Rad etilgan buyurtma pozitsiyalar daftaridan darhol olib tashlanadi.
+    """
+
+    def __init__(self, api, log_path: Optional[str] = None, confirm_timeout: float = 10.0,
+                 base_delay: float = 0.2, max_delay: float = 2.0):
+        self.api = api
+        self.log_path = log_path
+        self.confirm_timeout = confirm_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.counts = {"ACCEPTED": 0, "REJECTED": 0, "UNCONFIRMED": 0, "SUBMIT_FAILED": 0}
+        self._latency_sums = {"signal_to_submit_ms": 0.0, "submit_to_ack_ms": 0.0, "ack_to_confirm_ms": 0.0}
+        self._latency_counts = {key: 0 for key in self._latency_sums}
+        self._slippage_bps_sum = 0.0
+        self._slippage_count = 0
+
+    async def confirm(self, deal_reference: str) -> Optional[Dict[str, Any]]:
+        """
+        dealStatus li tasdiqni qaytaradi; confirm_timeout ichida kelmasa None.
+        Faqat 5xx / timeout qayta so'raladi, qolgan xatolar (401/403/404, ...) CapitalAPIError bo'lib chiqadi.
+        """
+        deadline = time.monotonic() + self.confirm_timeout
+        delay = self.base_delay
+        while True:
+            try:
+                data = await self.api.get_deal_confirmation(deal_reference)
+                if data.get("dealStatus"):
+                    return data
+            except CapitalAPIError as e:
+                if not _retryable(e):
+                    raise
+                logger.debug(f"[{deal_reference}] tasdiq so'rovida vaqtinchalik xato: {e.status}")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, self.max_delay)
+
+    async def submit(
+        self,
+        epic: str,
+        direction: str,
+        size: float,
+        quote_price: Optional[float] = None,
+        asset: Optional[str] = None,
+        signal_ts: Optional[float] = None,
+        source: str = "auto",
+        send: Optional[Callable[[], Awaitable[Dict[str, Any]]]] = None,
+    ) -> FillRecord:
+        """
+        Buyurtmani yuboradi (standart: api.open_position; manual savdo o'z `send` ini beradi)
+        va tasdiqni kutadi.
+        """
+        direction = direction.upper()
+        submit_ts = time.time()
+        ack_ts = confirm_ts = None
+        deal_reference = deal_id = fill_level = reason = None
+        status = "SUBMIT_FAILED"
+
+        try:
+            response = await (send() if send else self.api.open_position(epic, direction, size))
+            ack_ts = time.time()
+            if response.get("success"):
+                deal_reference = response.get("deal_id")
+            else:
+                reason = response.get("error") or str(response)
+        except Exception as e:
+            ack_ts = time.time()
+            reason = str(e)
+
+        if deal_reference:
+            try:
+                confirmation = await self.confirm(deal_reference)
+            except CapitalAPIError as e:
+                confirmation = None
+                reason = f"tasdiq so'rovi xatosi: {e.status}"
+            confirm_ts = time.time()
+            if confirmation is None:
+                status = "UNCONFIRMED"
+                reason = reason or f"{self.confirm_timeout:.0f} s ichida tasdiq kelmadi"
+            else:
+                status = str(confirmation.get("dealStatus")).upper()
+                affected = confirmation.get("affectedDeals") or [{}]
+                deal_id = confirmation.get("dealId") or affected[0].get("dealId")
+                fill_level = confirmation.get("level")
+                size = confirmation.get("size") or size
+                reason = confirmation.get("reason") or confirmation.get("rejectReason")
+                if status == "ACCEPTED":
+                    self.api.position_book.note_confirmed(deal_reference, deal_id)
+                else:
+                    self.api.position_book.note_rejected(deal_reference)
+
+        slippage = slippage_bps = None
+        if fill_level is not None and quote_price:
+            fill_level = float(fill_level)
+            slippage = fill_level - quote_price if direction == "BUY" else quote_price - fill_level
+            slippage_bps = round(slippage / quote_price * 10000, 2)
+
+        record = FillRecord(
+            source=source, asset=asset, epic=epic, direction=direction, size=float(size),
+            deal_reference=deal_reference, deal_id=deal_id, status=status, reason=reason,
+            quote_price=quote_price, fill_level=fill_level, slippage=slippage, slippage_bps=slippage_bps,
+            signal_ts=signal_ts, submit_ts=submit_ts, ack_ts=ack_ts, confirm_ts=confirm_ts,
+            signal_to_submit_ms=_ms(signal_ts, submit_ts),
+            submit_to_ack_ms=_ms(submit_ts, ack_ts),
+            ack_to_confirm_ms=_ms(ack_ts, confirm_ts) if deal_reference else None,
+        )
+        self._account(record)
+        logger.info(
+            f"[{epic}] {direction} {status} | fill={fill_level} quote={quote_price} slippage_bps={slippage_bps} | "
+            f"signal->submit {record['signal_to_submit_ms']} ms, submit->ack {record['submit_to_ack_ms']} ms, "
+            f"ack->confirm {record['ack_to_confirm_ms']} ms"
+        )
+        await self._write(record)
+        return record
+
+    def _account(self, record: FillRecord):
+        self.counts[record["status"]] = self.counts.get(record["status"], 0) + 1
+        for key in self._latency_sums:
+            if record[key] is not None:
+                self._latency_sums[key] += record[key]
+                self._latency_counts[key] += 1
+        if record["slippage_bps"] is not None:
+            self._slippage_bps_sum += record["slippage_bps"]
+            self._slippage_count += 1
+
+    def _append(self, line: str):
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    async def _write(self, record: FillRecord):
+        if not self.log_path:
+            return
+        try:
+            await asyncio.to_thread(self._append, json.dumps(record, ensure_ascii=False))
+        except Exception as e:
+            logger.warning(f"Fill yozuvini saqlashda xato ({self.log_path}): {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        averages = {
+            f"avg_{key}": round(self._latency_sums[key] / self._latency_counts[key], 1)
+            if self._latency_counts[key] else None
+            for key in self._latency_sums
+        }
+        return {
+            **self.counts,
+            **averages,
+            "avg_slippage_bps": round(self._slippage_bps_sum / self._slippage_count, 2) if self._slippage_count else None,
+        }
@@ -1,85 +1,256 @@
-import aiohttp
+import json
 import logging
-import os
+from typing import Any, Callable, Dict, List, Optional
+
+from ai_client import AIClientError, CircuitOpenError, shared_ai_client
 
 logger = logging.getLogger(__name__)
 
-# API konfiguratsiyasi (API KEY va URL)
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "YOUR_GEMINI_API_KEY")  # O'zgartiring yoki .env orqali o'zgartiring
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+# --- Qaror turlari uchun JSON sxemalar (Gemini responseSchema formati) ---
+
+ENTRY_SCHEMA: Dict[str, Any] = {
+    "type": "OBJECT",
+    "properties": {
+        "decision": {"type": "STRING", "enum": ["APPROVE", "REJECT"]},
+        "reason": {"type": "STRING"},
+    },
+    "required": ["decision", "reason"],
+}
+
+BATCH_ITEM_SCHEMA: Dict[str, Any] = {
+    "type": "OBJECT",
+    "properties": {
+        "id": {"type": "INTEGER"},
+        **ENTRY_SCHEMA["properties"],
+    },
+    "required": ["id", "decision", "reason"],
+}
+
+BATCH_SCHEMA: Dict[str, Any] = {"type": "ARRAY", "items": BATCH_ITEM_SCHEMA}
+
+TRAILING_SCHEMA: Dict[str, Any] = {
+    "type": "OBJECT",
+    "properties": {
+        "action": {"type": "STRING", "enum": ["CLOSE", "HOLD"]},
+        "net_take_profit_percent": {"type": "NUMBER"},
+        "confidence": {"type": "NUMBER"},
+        "reason": {"type": "STRING"},
+    },
+    "required": ["action", "reason"],
+}
+
+
+def compile_schema(schema: Dict[str, Any]) -> Callable[[Any], Any]:
+    """
+    Sxemadan validator yasaydi (bir marta, import paytida). Validator qiymatni tekshiradi va
+    normallashtiradi (enum katta harfga, sxemada yo'q maydonlar tashlanadi); mos kelmasa ValueError.
+    """
+    kind = schema["type"]
+    if kind == "OBJECT":
+        fields = [(name, compile_schema(sub)) for name, sub in schema["properties"].items()]
+        required = frozenset(schema.get("required", ()))
+
+        def check_object(value):
+            if not isinstance(value, dict):
+                raise ValueError(f"object kutilgan, {type(value).__name__} keldi")
+            result = {}
+            for name, check in fields:
+                if name in value and value[name] is not None:
+                    result[name] = check(value[name])
+                elif name in required:
+                    raise ValueError(f"'{name}' maydoni yo'q")
+            return result
+        return check_object
+
+    if kind == "ARRAY":
+        check_item = compile_schema(schema["items"])
+
+        def check_array(value):
+            if not isinstance(value, list):
+                raise ValueError(f"array kutilgan, {type(value).__name__} keldi")
+            return [check_item(item) for item in value]
+        return check_array
+
+    if kind == "STRING":
+        enum = frozenset(schema.get("enum", ()))
+
+        def check_string(value):
+            if not isinstance(value, str):
+                raise ValueError(f"string kutilgan, {type(value).__name__} keldi")
+            if enum:
+                value = value.strip().upper()
+                if value not in enum:
+                    raise ValueError(f"'{value}' ruxsat etilmagan qiymat")
+            return value
+        return check_string
+
+    if kind in ("NUMBER", "INTEGER"):
+        types = (int,) if kind == "INTEGER" else (int, float)
+
+        def check_number(value):
+            if isinstance(value, bool) or not isinstance(value, types):
+                raise ValueError(f"{kind.lower()} kutilgan, {type(value).__name__} keldi")
+            return value
+        return check_number
+
+    raise ValueError(f"Qo'llab-quvvatlanmaydigan sxema turi: {kind}")
+
+
+# qaror turi -> (responseSchema, validator)
+DECISION_SCHEMAS: Dict[str, Any] = {
+    "entry": (ENTRY_SCHEMA, compile_schema(ENTRY_SCHEMA)),
+    "batch": (BATCH_SCHEMA, compile_schema(BATCH_SCHEMA)),
+    "trailing": (TRAILING_SCHEMA, compile_schema(TRAILING_SCHEMA)),
+}
+_check_batch_item = compile_schema(BATCH_ITEM_SCHEMA)
+
+
+def parse_decision(kind: str, text: str) -> Any:
+    """JSON-mode javobini `kind` sxemasi bo'yicha o'qiydi va tekshiradi. Yaroqsiz bo'lsa ValueError."""
+    return DECISION_SCHEMAS[kind][1](json.loads(text))
+
+
+async def request_decision(kind: str, prompt: str, deadline: float = 30) -> str:
+    """
+    Promptni JSON rejimida (responseMimeType + responseSchema) yuboradi va xom JSON matnni qaytaradi.
+    Xato bo'lsa AIClientError.
+    """
+    generation_config = {
+        "responseMimeType": "application/json",
+        "responseSchema": DECISION_SCHEMAS[kind][0],
+        "temperature": 0.1,
+    }
+    return await shared_ai_client.generate(prompt, generation_config=generation_config, deadline=deadline)
+
+
+def _unavailable(e: AIClientError) -> str:
+    if isinstance(e, CircuitOpenError):
+        return e.message
+    logger.error(f"Gemini API so'rovda xato: {e.message}")
+    return f"AI so'rovi bajarilmadi: {e.message}"
+
 
-async def get_ai_approval(asset, direction, prices, indicators, news=None, market_condition=None, sentiment=None):
+async def get_ai_approval(asset, direction, prices, indicators, news=None, market_condition=None, sentiment=None,
+                          deadline=30, prompt=None):
     """
     AI'dan savdo uchun signalni tasdiqlash (APPROVE/REJECT) va sababini olish.
     Barcha kerakli kontekstlarni (aktiv, yo'nalish, narxlar, indikatorlar, yangiliklar, bozor holati, sentiment) yuborish mumkin.
+    prompt berilsa aynan u yuboriladi. Javob ENTRY_SCHEMA bo'yicha JSON.
+    deadline — so'rov uchun qat'iy vaqt chegarasi (s); oshsa yoki circuit breaker ochiq bo'lsa error=True qaytadi.
     """
     # Promptni tuzamiz
-    prompt = (
-        f"Savdo uchun signal.\n"
-        f"Aktiv: {asset}\n"
-        f"Yo'nalish: {direction}\n"
-        f"Narxlar: {prices}\n"
-        f"Indikatorlar: {indicators}\n"
-    )
-    if news:
-        prompt += f"So‘nggi yangiliklar: {news}\n"
-    if market_condition:
-        prompt += f"Bozor holati: {market_condition}\n"
-    if sentiment:
-        prompt += f"Sentiment: {sentiment}\n"
-    prompt += (
-        'Iltimos, faqat "APPROVE: ..." yoki "REJECT: ..." deb javob bering va sababini qisqacha izohlang.'
-    )
+    if prompt is None:
+        prompt = (
+            f"Savdo uchun signal.\n"
+            f"Aktiv: {asset}\n"
+            f"Yo'nalish: {direction}\n"
+            f"Narxlar: {prices}\n"
+            f"Indikatorlar: {indicators}\n"
+        )
+        if news:
+            prompt += f"So‘nggi yangiliklar: {news}\n"
+        if market_condition:
+            prompt += f"Bozor holati: {market_condition}\n"
+        if sentiment:
+            prompt += f"Sentiment: {sentiment}\n"
+        prompt += 'Signalni tasdiqlang ("APPROVE") yoki rad eting ("REJECT") va sababini qisqacha izohlang.'
 
     logger.debug(f"AI'ga yuborilayotgan ma'lumotlar: {prompt}")
 
-    # Google Gemini API uchun so'rov tuzish
-    data = {
-        "contents": [
-            {
-                "parts": [
-                    {"text": prompt}
-                ]
-            }
-        ]
-    }
-    headers = {
-        "Content-Type": "application/json",
-        "X-goog-api-key": GEMINI_API_KEY
-    }
+    # Umumiy Gemini klienti orqali (doimiy sessiya, semaphore, rate limit, deadline), JSON rejimida
+    try:
+        response_text = await request_decision("entry", prompt, deadline=deadline)
+        logger.debug(f"Gemini javobi: {response_text}")
+    except AIClientError as e:
+        return {"decision": "REJECT", "reason": _unavailable(e), "error": True}
+
+    try:
+        return parse_decision("entry", response_text)
+    except ValueError as e:
+        # error=True: yaroqsiz javob keshlanmaydi
+        logger.warning(f"[{asset}] AI javobi sxemaga mos emas: {e} | {response_text[:200]}")
+        return {"decision": "REJECT", "reason": f"AI javobi yaroqsiz: {e}", "error": True}
+
+
+async def get_ai_trailing_decision(prompt: str, deadline: float = 30) -> Dict[str, Any]:
+    """
+    Trailing qarori (TRAILING_SCHEMA): {"action": "CLOSE"/"HOLD", "reason", ixtiyoriy
+    "net_take_profit_percent" va "confidence"}. AI javob bermasa {"action": "UNAVAILABLE", "error": True}.
+    """
+    logger.debug(f"AI'ga yuborilayotgan trailing so'rovi: {prompt}")
+    try:
+        response_text = await request_decision("trailing", prompt, deadline=deadline)
+        logger.debug(f"Gemini trailing javobi: {response_text}")
+    except AIClientError as e:
+        return {"action": "UNAVAILABLE", "reason": _unavailable(e), "error": True}
+
+    try:
+        return parse_decision("trailing", response_text)
+    except ValueError as e:
+        logger.warning(f"AI trailing javobi sxemaga mos emas: {e} | {response_text[:200]}")
+        return {"action": "UNAVAILABLE", "reason": f"AI javobi yaroqsiz: {e}", "error": True}
+
+
+def _parse_batch_response(text: str, count: int) -> List[Optional[Dict[str, Any]]]:
+    """
+    JSON massivdagi qarorlarni id bo'yicha nomzodlarga moslaydi. Sxemaga mos kelmagan yoki yo'q
+    elementlar o'rnida None qoladi (ular alohida so'rov bilan qayta tekshiriladi).
+    """
+    decisions: List[Optional[Dict[str, Any]]] = [None] * count
+    try:
+        items = json.loads(text)
+    except ValueError:
+        return decisions
+    if not isinstance(items, list):
+        return decisions
+    for item in items:
+        try:
+            decision = _check_batch_item(item)
+        except ValueError:
+            continue
+        idx = decision.pop("id")
+        if 0 <= idx < count and decisions[idx] is None:
+            decisions[idx] = decision
+    return decisions
+
+
+async def get_ai_batch_approval(candidates: List[Dict[str, Any]], deadline: float = 30) -> List[Optional[Dict[str, Any]]]:
+    """
+    Bir nechta signalni (asset, direction, prices, indicators) bitta so'rovda tasdiqlatadi.
+    Elementda "context" berilsa (alohida so'rovdagi to'liq signal konteksti) narx/indikatorlar
+    o'rniga aynan u yuboriladi. Natija nomzodlar tartibida: qaror dict yoki javobdan ajratib bo'lmagan element uchun None.
+    So'rovning o'zi bajarilmasa barcha elementlar uchun error=True li REJECT qaytadi.
+    """
+    if not candidates:
+        return []
+    prompt = "Savdo signallari ro'yxati. Har bir signalni alohida baholang.\n\n"
+    for idx, candidate in enumerate(candidates):
+        prompt += f"id={idx}\n"
+        if candidate.get("context"):
+            prompt += f"{candidate['context'].strip()}\n\n"
+            continue
+        prompt += (
+            f"Aktiv: {candidate['asset']}\n"
+            f"Yo'nalish: {candidate['direction']}\n"
+            f"Narxlar: {candidate['prices']}\n"
+            f"Indikatorlar: {candidate['indicators']}\n\n"
+        )
+    prompt += (
+        "Har bir signal uchun bitta element qaytaring: id, decision (\"APPROVE\" yoki \"REJECT\") "
+        "va reason (qisqa izoh)."
+    )
+
+    logger.debug(f"AI'ga yuborilayotgan batch ({len(candidates)} ta signal): {prompt}")
 
-    # Asinxron POST so'rov
-    response_text = ""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(GEMINI_API_URL, json=data, headers=headers, timeout=30) as resp:
-                if resp.status == 200:
-                    result = await resp.json()
-                    logger.debug(f"Gemini javobi: {result}")
-                    # Gemini javobidan matnni ajratib olish
-                    try:
-                        response_text = (
-                            result["candidates"][0]
-                            ["content"]["parts"][0]["text"]
-                        ).strip()
-                    except Exception as e:
-                        logger.error(f"Gemini javobini o'qishda xato: {e}")
-                        response_text = ""
-                else:
-                    logger.error(f"HTTP so'rovda xato: {resp.status}, {await resp.text()}")
-    except Exception as e:
-        logger.error(f"Gemini API so'rovda xato: {e}")
-
-    # Javobni tahlil qilish
-    if response_text:
-        text = response_text.strip()
-        if text.upper().startswith("APPROVE"):
-            reason = text[8:].strip(": ").strip()
-            return {"decision": "APPROVE", "reason": reason}
-        elif text.upper().startswith("REJECT"):
-            reason = text[7:].strip(": ").strip()
-            return {"decision": "REJECT", "reason": reason}
-        else:
-            return {"decision": "REJECT", "reason": text}
-    else:
-        return {"decision": "REJECT", "reason": "AI'dan bo'sh javob keldi."}
\ No newline at end of file
+        response_text = await request_decision("batch", prompt, deadline=deadline)
+        logger.debug(f"Gemini batch javobi: {response_text}")
+    except AIClientError as e:
+        reason = _unavailable(e)
+        return [{"decision": "REJECT", "reason": reason, "error": True} for _ in candidates]
+
+    decisions = _parse_batch_response(response_text or "", len(candidates))
+    missing = sum(1 for decision in decisions if decision is None)
+    if missing:
+        logger.warning(f"AI batch javobida {missing}/{len(candidates)} ta qaror ajratib olinmadi")
+    return decisions
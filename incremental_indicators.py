@@ -0,0 +1,374 @@
+# incremental_indicators.py
+"""
+Holatli (stateful) indikatorlar: har bir yangi bar uchun O(1) yangilanadi.
+
+Har bir obyekt:
+  - warmup(values)  — tarix massividan holatni tiklaydi, oxirgi qiymatni qaytaradi
+  - update(x)       — yopilgan barni qo'shadi (holat o'zgaradi)
+  - peek(x)         — shakllanayotgan bar uchun qiymat, holat o'zgarmaydi
+  - value           — oxirgi yopilgan bar bo'yicha qiymat (warmup tugamagan bo'lsa None)
+
+Natijalar TA-Lib (EMA, RSI, MACD, BBANDS nbdev=2, OBV) bilan bir xil seed va formulalardan
+foydalanadi, shuning uchun bir xil kirishda farq faqat suzuvchi nuqta xatosi darajasida.
+"""
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EMA:
+    """TA-Lib EMA: birinchi qiymat — dastlabki `period` ta narxning SMA si, keyin k = 2 / (period + 1)."""
+
+    __slots__ = ("period", "k", "value", "_seed_sum", "_seed_count")
+
+    def __init__(self, period: int):
+        self.period = period
+        self.k = 2.0 / (period + 1)
+        self.value: Optional[float] = None
+        self._seed_sum = 0.0
+        self._seed_count = 0
+
+    def warmup(self, values: Sequence[float]) -> Optional[float]:
+        for x in values:
+            self.update(float(x))
+        return self.value
+
+    def update(self, x: float) -> Optional[float]:
+        if self.value is None:
+            self._seed_sum += x
+            self._seed_count += 1
+            if self._seed_count == self.period:
+                self.value = self._seed_sum / self.period
+            return self.value
+        self.value = (x - self.value) * self.k + self.value
+        return self.value
+
+    def peek(self, x: float) -> Optional[float]:
+        if self.value is None:
+            if self._seed_count + 1 == self.period:
+                return (self._seed_sum + x) / self.period
+            return None
+        return (x - self.value) * self.k + self.value
+
+
+class RSI:
+    """Wilder RSI (TA-Lib): birinchi qiymat `period` ta o'zgarishdan keyin, so'ng Wilder silliqlashi."""
+
+    __slots__ = ("period", "value", "_prev", "_avg_gain", "_avg_loss", "_count")
+
+    def __init__(self, period: int = 14):
+        self.period = period
+        self.value: Optional[float] = None
+        self._prev: Optional[float] = None
+        self._avg_gain = 0.0
+        self._avg_loss = 0.0
+        self._count = 0
+
+    def warmup(self, values: Sequence[float]) -> Optional[float]:
+        for x in values:
+            self.update(float(x))
+        return self.value
+
+    def _step(self, x: float):
+        """Yangi holatni (avg_gain, avg_loss, count) hisoblaydi, lekin saqlamaydi."""
+        diff = x - self._prev
+        gain = diff if diff > 0 else 0.0
+        loss = -diff if diff < 0 else 0.0
+        count = self._count + 1
+        p = self.period
+        if count < p:
+            return self._avg_gain + gain, self._avg_loss + loss, count
+        if count == p:
+            return (self._avg_gain + gain) / p, (self._avg_loss + loss) / p, count
+        return (self._avg_gain * (p - 1) + gain) / p, (self._avg_loss * (p - 1) + loss) / p, count
+
+    @staticmethod
+    def _rsi(avg_gain: float, avg_loss: float) -> float:
+        total = avg_gain + avg_loss
+        return 100.0 * (avg_gain / total) if total > 1e-14 else 0.0
+
+    def update(self, x: float) -> Optional[float]:
+        if self._prev is None:
+            self._prev = x
+            return None
+        self._avg_gain, self._avg_loss, self._count = self._step(x)
+        self._prev = x
+        if self._count >= self.period:
+            self.value = self._rsi(self._avg_gain, self._avg_loss)
+        return self.value
+
+    def peek(self, x: float) -> Optional[float]:
+        if self._prev is None:
+            return None
+        avg_gain, avg_loss, count = self._step(x)
+        return self._rsi(avg_gain, avg_loss) if count >= self.period else None
+
+
+class MACD:
+    """
+    TA-Lib MACD: tez va sekin EMA ikkalasi ham `slow` ta bar to'lganda SMA bilan seed qilinadi
+    (tez EMA oxirgi `fast` ta bar bo'yicha), signal — MACD chizig'ining EMA si.
+    """
+
+    __slots__ = ("fast", "slow", "signal_period", "_closes", "_fast", "_slow", "_signal", "value")
+
+    def __init__(self, fast: int = 12, slow: int = 26, signal: int = 9):
+        self.fast = fast
+        self.slow = slow
+        self.signal_period = signal
+        # seed uchun faqat dastlabki `slow` ta narx kerak
+        self._closes: Optional[List[float]] = []
+        self._fast = EMA(fast)
+        self._slow = EMA(slow)
+        self._signal = EMA(signal)
+        self.value: Optional[Dict[str, float]] = None
+
+    def warmup(self, values: Sequence[float]) -> Optional[Dict[str, float]]:
+        for x in values:
+            self.update(float(x))
+        return self.value
+
+    def _seed(self, closes: List[float]):
+        fast, slow = EMA(self.fast), EMA(self.slow)
+        fast.warmup(closes[-self.fast:])
+        slow.warmup(closes)
+        return fast, slow
+
+    @staticmethod
+    def _result(macd: float, signal: Optional[float]) -> Optional[Dict[str, float]]:
+        if signal is None:
+            return None
+        return {"macd": macd, "signal": signal, "hist": macd - signal}
+
+    def update(self, x: float) -> Optional[Dict[str, float]]:
+        if self._closes is not None:
+            self._closes.append(x)
+            if len(self._closes) < self.slow:
+                return None
+            self._fast, self._slow = self._seed(self._closes)
+            self._closes = None
+        else:
+            self._fast.update(x)
+            self._slow.update(x)
+        macd = self._fast.value - self._slow.value
+        self.value = self._result(macd, self._signal.update(macd))
+        return self.value
+
+    def peek(self, x: float) -> Optional[Dict[str, float]]:
+        if self._closes is not None:
+            if len(self._closes) + 1 < self.slow:
+                return None
+            fast, slow = self._seed(self._closes + [x])
+            macd = fast.value - slow.value
+        else:
+            macd = self._fast.peek(x) - self._slow.peek(x)
+        return self._result(macd, self._signal.peek(macd))
+
+
+class BollingerBands:
+    """TA-Lib BBANDS (SMA, populyatsiya std, nbdev=2): oyna yig'indisi va kvadratlar yig'indisi bilan."""
+
+    __slots__ = ("period", "nbdev", "_window", "_pos", "_count", "_sum", "_sum_sq", "_updates", "value")
+
+    # suzuvchi nuqta xatosi to'planmasligi uchun yig'indilar vaqti-vaqti bilan qayta hisoblanadi
+    RESUM_EVERY = 1024
+
+    def __init__(self, period: int = 20, nbdev: float = 2.0):
+        self.period = period
+        self.nbdev = nbdev
+        self._window = np.zeros(period, dtype=np.float64)
+        self._pos = 0
+        self._count = 0
+        self._sum = 0.0
+        self._sum_sq = 0.0
+        self._updates = 0
+        self.value: Optional[Dict[str, float]] = None
+
+    def warmup(self, values: Sequence[float]) -> Optional[Dict[str, float]]:
+        values = np.asarray(values, dtype=np.float64)[-self.period:]
+        for x in values:
+            self.update(float(x))
+        return self.value
+
+    def _bands(self, total: float, total_sq: float) -> Dict[str, float]:
+        mean = total / self.period
+        var = total_sq / self.period - mean * mean
+        dev = self.nbdev * (var ** 0.5 if var > 0 else 0.0)
+        return {"upper": mean + dev, "middle": mean, "lower": mean - dev}
+
+    def update(self, x: float) -> Optional[Dict[str, float]]:
+        old = self._window[self._pos] if self._count >= self.period else 0.0
+        self._window[self._pos] = x
+        self._pos = (self._pos + 1) % self.period
+        self._count = min(self._count + 1, self.period)
+        self._sum += x - old
+        self._sum_sq += x * x - old * old
+        self._updates += 1
+        if self._updates % self.RESUM_EVERY == 0:
+            window = self._window[:self._count]
+            self._sum = float(window.sum())
+            self._sum_sq = float((window * window).sum())
+        if self._count == self.period:
+            self.value = self._bands(self._sum, self._sum_sq)
+        return self.value
+
+    def peek(self, x: float) -> Optional[Dict[str, float]]:
+        if self._count + 1 < self.period:
+            return None
+        old = self._window[self._pos] if self._count >= self.period else 0.0
+        return self._bands(self._sum + x - old, self._sum_sq + x * x - old * old)
+
+
+class OBV:
+    """TA-Lib OBV: birinchi qiymat birinchi barning hajmi."""
+
+    __slots__ = ("value", "_prev")
+
+    def __init__(self):
+        self.value: Optional[float] = None
+        self._prev: Optional[float] = None
+
+    def warmup(self, closes: Sequence[float], volumes: Sequence[float]) -> Optional[float]:
+        for x, v in zip(closes, volumes):
+            self.update(float(x), float(v))
+        return self.value
+
+    def _step(self, x: float, volume: float) -> float:
+        if self._prev is None:
+            return volume
+        if x > self._prev:
+            return self.value + volume
+        if x < self._prev:
+            return self.value - volume
+        return self.value
+
+    def update(self, x: float, volume: float) -> float:
+        self.value = self._step(x, volume)
+        self._prev = x
+        return self.value
+
+    def peek(self, x: float, volume: float) -> float:
+        return self._step(x, volume)
+
+
+class IndicatorSet:
+    """
+    calculate_indicators() dagi to'plam (rsi, ema20, ema50, macd, bb) + OBV, bitta seriya uchun.
+    Natija kalitlari calculate_indicators() bilan bir xil.
+    """
+
+    def __init__(self):
+        self.rsi = RSI(14)
+        self.ema20 = EMA(20)
+        self.ema50 = EMA(50)
+        self.macd = MACD(12, 26, 9)
+        self.bb = BollingerBands(20)
+        self.obv = OBV()
+        self.bars = 0
+
+    def warmup(self, closes: Sequence[float], volumes: Optional[Sequence[float]] = None):
+        closes = np.asarray(closes, dtype=np.float64)
+        if volumes is None:
+            volumes = np.zeros(len(closes))
+        for x, v in zip(closes.tolist(), np.asarray(volumes, dtype=np.float64).tolist()):
+            self.update(x, v)
+
+    def update(self, close: float, volume: float = 0.0):
+        self.rsi.update(close)
+        self.ema20.update(close)
+        self.ema50.update(close)
+        self.macd.update(close)
+        self.bb.update(close)
+        self.obv.update(close, volume)
+        self.bars += 1
+
+    @staticmethod
+    def _pack(rsi, ema20, ema50, macd, bb, obv) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"rsi": rsi, "ema20": ema20, "ema50": ema50, "obv": obv}
+        macd = macd or {}
+        out["macd"] = macd.get("macd")
+        out["macd_signal"] = macd.get("signal")
+        out["macd_hist"] = macd.get("hist")
+        bb = bb or {}
+        out["bb_upper"] = bb.get("upper")
+        out["bb_middle"] = bb.get("middle")
+        out["bb_lower"] = bb.get("lower")
+        return out
+
+    def values(self) -> Dict[str, Any]:
+        return self._pack(self.rsi.value, self.ema20.value, self.ema50.value,
+                          self.macd.value, self.bb.value, self.obv.value)
+
+    def peek(self, close: float, volume: float = 0.0) -> Dict[str, Any]:
+        return self._pack(self.rsi.peek(close), self.ema20.peek(close), self.ema50.peek(close),
+                          self.macd.peek(close), self.bb.peek(close), self.obv.peek(close, volume))
+
+
+class IndicatorBook:
+    """
+    Kalit (odatda (epic, resolution)) bo'yicha IndicatorSet lar.
+    compute() har safar butun seriyani emas, faqat oxirgi chaqiruvdan keyin yopilgan barlarni qo'shadi.
+    Oxirgi bar shakllanayotgan deb hisoblanadi va peek() bilan baholanadi.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Dict[str, Any]]" = OrderedDict()
+        self.warmups = 0
+        self.incremental = 0
+
+    def compute(self, key: Hashable, ts: Sequence[int], closes: Sequence[float],
+                volumes: Optional[Sequence[float]] = None) -> Dict[str, Any]:
+        ts = np.asarray(ts, dtype=np.int64)
+        closes = np.asarray(closes, dtype=np.float64)
+        volumes = np.zeros(len(closes)) if volumes is None else np.asarray(volumes, dtype=np.float64)
+        if not len(closes):
+            return {}
+
+        entry = self._entries.get(key)
+        # yopilgan barlar: oxirgisidan tashqari hammasi
+        closed_ts = ts[:-1]
+        start = None
+        if entry is not None:
+            last_ts = entry["last_ts"]
+            if last_ts is None or (len(closed_ts) and closed_ts[0] <= last_ts):
+                pos = int(np.searchsorted(closed_ts, last_ts, side="right")) if last_ts is not None else 0
+                if last_ts is None or (pos and closed_ts[pos - 1] == last_ts):
+                    start = pos
+
+        if start is None:
+            # yangi kalit yoki tarixda uzilish — to'liq warmup
+            indicator_set = IndicatorSet()
+            indicator_set.warmup(closes[:-1], volumes[:-1])
+            entry = {"set": indicator_set}
+            self.warmups += 1
+        else:
+            indicator_set = entry["set"]
+            for x, v in zip(closes[start:-1].tolist(), volumes[start:-1].tolist()):
+                indicator_set.update(x, v)
+            self.incremental += 1
+
+        entry["last_ts"] = int(closed_ts[-1]) if len(closed_ts) else None
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        return indicator_set.peek(float(closes[-1]), float(volumes[-1]))
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"warmups": self.warmups, "incremental": self.incremental, "size": len(self._entries)}
+
+
+# Jarayon bo'yicha umumiy kitob (calculate_indicators key= bilan chaqirilganda)
+shared_indicator_book = IndicatorBook()
@@ -40,15 +40,18 @@ from config import (
 )
 from trading_logic import (
     refresh_positions, 
-    close_profitable_positions_loop, 
+    risk_monitor_loop, 
     set_global_instances,
     start_trading_loops,
     trading_logic_loop, 
     calculate_mnl_signals,
     send_hourly_report,
+    trade_limit_reason,
+    get_order_executor,
 )
 from db import InMemoryDB
 from capital_api import CapitalComAPI, CapitalAPIError
+from execution import entry_quote
 from datetime import timedelta
 from functools import wraps
 from apscheduler.schedulers.asyncio import AsyncIOScheduler 
@@ -517,6 +520,12 @@ async def handle_account_type_selection(update: Update, context: ContextTypes.DE
     text = update.message.text
     db = context.user_data.get('db')
 
+    # Eski API obyektining HTTP sessiyasini yopamiz (yangisi o'z pool'ini ochadi)
+    if text in ("Demo Hisob", "Real Hisob", "Tekshiruv"):
+        old_api = context.user_data.get('capital_api')
+        if old_api:
+            await old_api.close()
+
     if text == "Demo Hisob":
         api = CapitalComAPI(
             CAPITAL_COM_USERNAME,
@@ -933,10 +942,8 @@ async def get_trading_status(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Iltimos, avval /start buyrug'i bilan botni qayta ishga tushiring.")
         return MAIN_MENU
 
-    # Pozitsiyalarni yangilash
-    await refresh_positions(context)
-    settings = await db.get_settings()
-    positions = settings.get("positions", {})
+    # Pozitsiyalarni yangilash (bitta so'rov, pozitsiya bo'yicha qo'shimcha so'rov yo'q)
+    positions = await refresh_positions(context)
 
     if not positions:
         await update.message.reply_text("Hozirda faol savdolar mavjud emas.", reply_markup=main_menu_keyboard)
@@ -945,26 +952,15 @@ async def get_trading_status(update: Update, context: ContextTypes.DEFAULT_TYPE)
     message = "<b>Faol savdolar ro'yxati:</b>\n\n"
     keyboard_buttons = []
 
-    # Har bir pozitsiya uchun alohida so‘rov yuboriladi
-    tasks = []
-    for position_id, position_info in positions.items():
-        deal_id = position_info.get('deal_id', position_id)
-        tasks.append(api.get_position_details(deal_id))
-
-    details_list = await asyncio.gather(*tasks)
-
-    for detail in details_list:
-        position = detail.get("position", {})
-        market = detail.get("market", {})
-
-        asset_name = market.get("instrumentName", "Noma'lum")
-        epic = market.get("epic", "")
-        direction = position.get("direction", "Noma'lum")
-        open_price = position.get("level", "Noma'lum")
-        leverage = position.get("leverage", "Noma'lum")
-        open_time_utc = position.get("createdDateUTC") or position.get("createdDate") or ""
-        profit_loss = position.get("upl", "Noma'lum")
-        deal_id = position.get("dealId") or position.get("dealReference") or ""
+    for pos in positions:
+        asset_name = pos["instrument_name"]
+        epic = pos["epic"] or ""
+        direction = pos["direction"] or "Noma'lum"
+        open_price = pos["level"]
+        leverage = pos["leverage"] if pos["leverage"] is not None else "Noma'lum"
+        open_time_utc = pos["created_date_utc"] or ""
+        profit_loss = pos["upl"]
+        deal_id = pos["deal_id"]
 
         # Vaqtni chiroyli formatlash
         if open_time_utc:
@@ -1676,9 +1672,7 @@ async def setup_bot_tasks(context: ContextTypes.DEFAULT_TYPE):
     instruments_to_subscribe = [details["id"] for details in ACTIVE_INSTRUMENTS.values()]
 
     if api and instruments_to_subscribe:
-        # ... trading_task_instance va boshqalar ...
-        context.user_data['trading_task_instance'] = asyncio.create_task(trading_logic_loop(context))
-        context.user_data['closing_task_instance'] = asyncio.create_task(close_profitable_positions_loop(context))
+        # eski vazifalar avval bekor qilinadi (ular api dagi listenerlarini finally da olib tashlaydi)
         for task_name in ['trading_task_instance', 'closing_task_instance', 'websocket_task_instance']:
             if task_name in context.user_data and context.user_data[task_name]:
                 try:
@@ -1690,7 +1684,7 @@ async def setup_bot_tasks(context: ContextTypes.DEFAULT_TYPE):
                     context.user_data[task_name] = None
         
         context.user_data['trading_task_instance'] = asyncio.create_task(trading_logic_loop(context))
-        context.user_data['closing_task_instance'] = asyncio.create_task(close_profitable_positions_loop(context))
+        context.user_data['closing_task_instance'] = asyncio.create_task(risk_monitor_loop(context))
         context.user_data['websocket_task_instance'] = asyncio.create_task(run_websocket_task(api, instruments_to_subscribe))
 
         logger.info("Savdo, pozitsiyalarni yopish va websocket vazifalari ishga tushirildi.")
@@ -1757,14 +1751,10 @@ async def execute_manual_trade(update: Update, context: ContextTypes.DEFAULT_TYP
     # ensure positions dict exists
     if settings.get("positions") is None:
         settings["positions"] = {}
-    max_trades = settings.get("max_trades_per_asset", {}).get(asset_name, float('inf'))
 
-    open_positions = settings.get("positions", {})
-    open_positions_count_for_asset = sum(
-        1 for pos in open_positions.values() if pos.get('asset_name') == asset_name
-    )
-
-    if open_positions_count_for_asset >= max_trades:
+    # Aktiv bo'yicha limit pozitsiyalar daftaridan (eskirgan bo'lsa REST bilan solishtiriladi)
+    await api.get_book_positions()
+    if trade_limit_reason(api, asset_name, settings, check_total=False):
         await message.reply_text(
             "❌ Ushbu aktiv bo'yicha maksimal savdolar soniga yetdingiz.",
             reply_markup=main_menu_keyboard
@@ -1777,9 +1767,9 @@ async def execute_manual_trade(update: Update, context: ContextTypes.DEFAULT_TYP
 
     # IMPORTANT: Miqdorni to'g'ri hisoblash
     try:
-        # Narxni olish (Capital API dan)
-        price_info = await api.get_prices(asset_id)
-        if not price_info:
+        # Narxni olish: yangi websocket kotirovkasi, eskirgan bo'lsa REST
+        price_info = await api.get_quote(asset_id)
+        if price_info["source"] == "none":
             await message.reply_text("❌ Narxni olishda muammo.")
             return MAIN_MENU
 
@@ -1788,9 +1778,10 @@ async def execute_manual_trade(update: Update, context: ContextTypes.DEFAULT_TYP
 
         # deal_type ga qarab narxni tanlash
         if deal_type.lower() == "buy":
-            price = buy_price
+            price = buy_price or price_info["mid"]
         else:
-            price = sell_price
+            price = sell_price or price_info["mid"]
+        logger.info(f"Manual savdo narxi manbasi: {price_info['source']} ({asset_id})")
 
         if not price or price <= 0:
             await message.reply_text("❌ Narx aniqlanmadi.")
@@ -1799,11 +1790,15 @@ async def execute_manual_trade(update: Update, context: ContextTypes.DEFAULT_TYP
         # USD summadan lot hisoblash
         size = trade_amount / price
 
-        # ✅ Savdoni amalga oshirish (YANGILANDI)
-        result = await api.create_position(
-            currency_pair=asset_id,
-            direction=deal_type,
-            size=size  # ✅ Lot miqdori to'g'ridan-to'g'ri yuboriladi
+        # ✅ Savdoni amalga oshirish va tasdiqni kutish (fill yozuvi saqlanadi)
+        fill = await get_order_executor(api).submit(
+            asset_id, deal_type, size, quote_price=entry_quote(deal_type, price_info) or price,
+            asset=asset_name, source="manual",
+            send=lambda: api.create_position(
+                currency_pair=asset_id,
+                direction=deal_type,
+                size=size  # ✅ Lot miqdori to'g'ridan-to'g'ri yuboriladi
+            ),
         )
 
     except Exception as e:
@@ -1814,25 +1809,11 @@ async def execute_manual_trade(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return MAIN_MENU
 
-    if result.get("success"):
-        # get deal reference (deal_id / dealReference)
-        deal_ref = (
-            result.get("deal_id") or result.get("position_id")
-            or (result.get("details") or {}).get("dealReference")
-            or (result.get("details") or {}).get("dealId")
-        )
-        if not deal_ref:
-            # agar API hech qanday id qaytarmagan bo'lsa, details ichini matn sifatida saqlaymiz
-            deal_ref = str((result.get("details") or result))[:64]
-
-        open_price = None
-        try:
-            open_price = (
-                (result.get("details") or {}).get("level")
-                or (result.get("details") or {}).get("openPrice")
-            )
-        except Exception:
-            open_price = None
+    if fill["status"] in ("ACCEPTED", "UNCONFIRMED"):
+        # tasdiqlangan dealId, tasdiq kelmagan bo'lsa dealReference
+        deal_ref = fill["deal_id"] or fill["deal_reference"]
+        open_price = fill["fill_level"]
+        size = fill["size"]
 
         # Saqlash: positions exist bo'lishi kerak
         if settings.get("positions") is None:
@@ -1860,7 +1841,7 @@ async def execute_manual_trade(update: Update, context: ContextTypes.DEFAULT_TYP
         await message.reply_html(success_message)
         await message.reply_text("Asosiy menyu.", reply_markup=main_menu_keyboard)
     else:
-        err = result.get("error") or result.get("message") or str(result)
+        err = fill["reason"] or fill["status"]
         error_message = f"""
 ❌ <b>{asset_name}</b> bo'yicha savdoni ochishda xato:
 {err}
@@ -2119,6 +2100,28 @@ async def back_to_manual_trade_menu(update: Update, context: ContextTypes.DEFAUL
 
 
 
+async def close_api_sessions(app: Application):
+    """Bot to'xtaganda barcha CapitalComAPI va Gemini HTTP sessiyalarini yopadi."""
+    from trading_logic import get_global_instances
+    from ai_client import shared_ai_client
+    _, global_api = get_global_instances()
+    apis = {id(global_api): global_api} if global_api else {}
+    for user_data in app.user_data.values():
+        api = user_data.get('capital_api')
+        if api:
+            apis[id(api)] = api
+    for api in apis.values():
+        try:
+            await api.close()
+        except Exception as e:
+            logger.warning(f"API sessiyasini yopishda xato: {e}")
+    try:
+        await shared_ai_client.close()
+    except Exception as e:
+        logger.warning(f"Gemini sessiyasini yopishda xato: {e}")
+    logger.info("✅ API HTTP sessiyalari yopildi")
+
+
 def setup_graceful_shutdown(app):
     """Graceful shutdown sozlash"""
     def shutdown_handler():
@@ -2146,7 +2149,7 @@ async def check_scheduler_status(update: Update, context: ContextTypes.DEFAULT_T
 
 def start_bot():
     """Botni boshlaydi."""
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = Application.builder().token(TELEGRAM_TOKEN).post_shutdown(close_api_sessions).build()
     
     # ✅ GRACEFUL SHUTDOWN SOZLASH
     setup_graceful_shutdown(application)
@@ -0,0 +1,124 @@
+# market_cache.py
+import asyncio
+import copy
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# Tez eskiradigan (bozor holati, narx) maydonlar. Qolganlari (instrument,
+# dealingRules, dealSize, currency, ...) statik hisoblanadi.
+DYNAMIC_FIELDS = frozenset({
+    "snapshot", "marketStatus", "bid", "offer", "ofr",
+    "high", "low", "netChange", "percentageChange", "updateTime", "updateTimeUTC",
+})
+
+
+class MarketInfoCache:
+    """
+    Instrument metadata uchun cheklangan LRU kesh.
+      - statik maydonlar uzoq (static_ttl), dinamik maydonlar qisqa (dynamic_ttl) yashaydi
+      - bir epic uchun bir vaqtdagi bir nechta miss bitta so'rovni kutadi (coalescing)
+      - hits / misses / coalesced hisoblagichlari
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[str], Awaitable[Dict[str, Any]]],
+        max_entries: int = 128,
+        static_ttl: float = 6 * 3600,
+        dynamic_ttl: float = 30.0,
+    ):
+        self._loader = loader
+        self.max_entries = max_entries
+        self.static_ttl = static_ttl
+        self.dynamic_ttl = dynamic_ttl
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, epic: str, include_dynamic: bool = False,
+                  max_dynamic_age: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Epic bo'yicha market ma'lumotini qaytaradi.
+        include_dynamic=False bo'lsa faqat statik maydonlar kerak deb hisoblanadi va
+        dinamik qism eskirgan bo'lsa ham so'rov yuborilmaydi (javobga ham kirmaydi).
+        max_dynamic_age berilsa dinamik qism dynamic_ttl dan tashqari shu soniyadan eski bo'lmasligi kerak.
+        """
+        now = time.monotonic()
+        entry = self._entries.get(epic)
+        if entry and now < entry["static_expiry"]:
+            dynamic_fresh = now < entry["dynamic_expiry"] and (
+                max_dynamic_age is None or now - entry["stored_at"] <= max_dynamic_age
+            )
+            if dynamic_fresh or not include_dynamic:
+                self._entries.move_to_end(epic)
+                self.hits += 1
+                return self._view(entry, include_dynamic and dynamic_fresh)
+
+        task = self._inflight.get(epic)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._load(epic))
+            self._inflight[epic] = task
+        # shield: birinchi chaqiruvchi bekor qilinsa ham boshqalar natijani oladi
+        data = await asyncio.shield(task)
+        if not data:
+            return {}
+        entry = self._entries.get(epic)
+        return self._view(entry, include_dynamic) if entry else copy.deepcopy(data)
+
+    def prime(self, epic: str, data: Dict[str, Any]):
+        """Boshqa so'rovdan (masalan, markets snapshot) kelgan to'liq ma'lumotni keshga yozadi."""
+        if epic and data:
+            self._store(epic, data)
+
+    def invalidate(self, epic: Optional[str] = None):
+        if epic is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(epic, None)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "size": len(self._entries),
+        }
+
+    async def _load(self, epic: str) -> Dict[str, Any]:
+        try:
+            data = await self._loader(epic)
+            if data:
+                self._store(epic, data)
+            return data
+        finally:
+            self._inflight.pop(epic, None)
+
+    def _store(self, epic: str, data: Dict[str, Any]):
+        now = time.monotonic()
+        static = {k: v for k, v in data.items() if k not in DYNAMIC_FIELDS}
+        dynamic = {k: v for k, v in data.items() if k in DYNAMIC_FIELDS}
+        self._entries[epic] = {
+            "static": static,
+            "dynamic": dynamic,
+            "stored_at": now,
+            "static_expiry": now + self.static_ttl,
+            "dynamic_expiry": now + self.dynamic_ttl,
+        }
+        self._entries.move_to_end(epic)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    @staticmethod
+    def _view(entry: Dict[str, Any], include_dynamic: bool) -> Dict[str, Any]:
+        # chuqur nusxa: chaqiruvchi ichki dictlarni (instrument, dealingRules, snapshot) o'zgartirsa ham kesh buzilmaydi
+        if include_dynamic:
+            return copy.deepcopy({**entry["static"], **entry["dynamic"]})
+        return copy.deepcopy(entry["static"])
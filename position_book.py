@@ -0,0 +1,243 @@
+# position_book.py
+import itertools
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, TypedDict
+
+logger = logging.getLogger(__name__)
+
+
+class OpenPosition(TypedDict):
+    """Bitta ochiq pozitsiya (/api/v1/positions dagi position + market birlashtirilgan)."""
+    deal_id: str
+    deal_reference: Optional[str]
+    epic: Optional[str]
+    instrument_name: str
+    direction: str                 # "BUY" / "SELL"
+    level: float                   # ochilish narxi
+    size: float
+    upl: float                     # realizatsiya qilinmagan foyda/zarar
+    leverage: Optional[float]
+    created_date_utc: Optional[str]
+    bid: Optional[float]
+    offer: Optional[float]
+
+
+class PositionBook:
+    """
+    Ochiq pozitsiyalarning xotiradagi daftari: son, ekspozitsiya va P/L REST so'rovisiz o'qiladi.
+      - indekslar: deal id, epic va (epic, yo'nalish) bo'yicha; sonlar va ekspozitsiya O(1)
+      - REST snapshot (reconcile) daftarni to'liq almashtiradi — haqiqat manbai
+      - o'zimiz yuborgan ochish/yopish natijalari darhol qo'llanadi (note_opened / note_closed);
+        ochilgan pozitsiya REST snapshotida ko'ringuncha (yoki `pending_timeout` o'tguncha)
+        "kutilayotgan" sifatida sanaladi; yopilgan deal esa REST uni ro'yxatdan chiqarmaguncha
+        (yoki `pending_timeout` o'tguncha) snapshotga qaytarilmaydi
+      - websocket kotirovkalari upl, bid va offer ni jonli yangilaydi
+    Daftar `max_age` soniyadan eski yoki eskirgan deb belgilangan bo'lsa fresh() False qaytaradi.
+    Maksimal savdolar tekshiruvi (limit_reason) avto va manual savdo uchun yagona manba.
+    """
+
+    def __init__(self, max_age: float = 60.0, pending_timeout: float = 120.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_age = max_age
+        self.pending_timeout = pending_timeout
+        self._clock = clock
+        self._positions: Dict[str, OpenPosition] = {}
+        self._by_epic: Dict[str, Dict[str, OpenPosition]] = {}
+        # dealReference -> {"epic", "direction", "size", "at", "deal_id" (tasdiqdan keyin)}
+        self._pending_opens: Dict[str, Dict[str, Any]] = {}
+        # dealReference siz ochilishlar uchun noyob kalit (len() asosidagi kalit takrorlanishi mumkin edi)
+        self._pending_seq = itertools.count(1)
+        # yopish so'rovi muvaffaqiyatli, lekin REST hali ro'yxatda ko'rsatishi mumkin: deal_id -> vaqt
+        self._closing: Dict[str, float] = {}
+        # ochiq + kutilayotgan pozitsiyalar bo'yicha hisoblagichlar
+        self._epic_counts: Dict[str, int] = {}
+        self._side_counts: Dict[Tuple[str, str], int] = {}
+        self._exposure: Dict[Tuple[str, str], float] = {}
+        self._synced_at: Optional[float] = None
+        self._dirty = True
+        self.reconciles = 0
+        self.memory_reads = 0
+        self.drift = 0
+
+    # --- indekslar ---
+
+    def _count(self, epic: Optional[str], direction: str, size: float, sign: int):
+        epic = epic or ""
+        self._epic_counts[epic] = self._epic_counts.get(epic, 0) + sign
+        side = (epic, direction)
+        self._side_counts[side] = self._side_counts.get(side, 0) + sign
+        self._exposure[side] = self._exposure.get(side, 0.0) + sign * size
+        if not self._epic_counts[epic]:
+            del self._epic_counts[epic]
+        if not self._side_counts[side]:
+            del self._side_counts[side]
+            del self._exposure[side]
+
+    def _add(self, pos: OpenPosition):
+        self._positions[pos["deal_id"]] = pos
+        self._by_epic.setdefault(pos["epic"] or "", {})[pos["deal_id"]] = pos
+        self._count(pos["epic"], pos["direction"], pos["size"], 1)
+
+    def _remove(self, deal_id: str) -> Optional[OpenPosition]:
+        pos = self._positions.pop(deal_id, None)
+        if pos is None:
+            return None
+        deals = self._by_epic.get(pos["epic"] or "", {})
+        deals.pop(deal_id, None)
+        if not deals:
+            self._by_epic.pop(pos["epic"] or "", None)
+        self._count(pos["epic"], pos["direction"], pos["size"], -1)
+        return pos
+
+    # --- yangilanishlar ---
+
+    def reconcile(self, positions: List[OpenPosition]):
+        """
+        REST snapshotini qo'llaydi; farqlar (drift) hisoblanadi.
+        Yopilayotgan deallar REST ularni ko'rsatmay qo'ygunicha chiqarib tashlanadi; kutilayotgan
+        ochilishlar snapshotda mos deal paydo bo'lguncha sanalishda qoladi.
+        """
+        now = self._clock()
+        listed = {pos["deal_id"] for pos in positions}
+        for deal_id, at in list(self._closing.items()):
+            if deal_id not in listed:
+                del self._closing[deal_id]          # yopilish REST da tasdiqlandi
+            elif now - at > self.pending_timeout:
+                logger.warning(f"[{deal_id}] yopilgan deb belgilangan pozitsiya REST da hali ochiq, qaytarildi")
+                del self._closing[deal_id]
+        positions = [pos for pos in positions if pos["deal_id"] not in self._closing]
+        new_ids = {pos["deal_id"] for pos in positions}
+        known_ids = set(self._positions)
+        if self._synced_at is not None and not self._dirty:
+            drift = len(new_ids ^ known_ids)
+            if drift:
+                logger.info(f"Pozitsiyalar daftari REST bilan farq qildi: {drift} ta pozitsiya")
+                self.drift += drift
+
+        self._positions, self._by_epic = {}, {}
+        self._epic_counts, self._side_counts, self._exposure = {}, {}, {}
+        for pos in positions:
+            self._add(pos)
+        self._match_pending_opens(positions, known_ids, now)
+        self._synced_at = now
+        self.reconciles += 1
+
+    def _match_pending_opens(self, positions: List[OpenPosition], known_ids, now: float):
+        """Snapshotda paydo bo'lgan (yoki muddati o'tgan) kutilayotgan ochilishlarni chiqaradi."""
+        by_id = {pos["deal_id"]: pos for pos in positions}
+        by_ref = {pos["deal_reference"]: pos for pos in positions if pos["deal_reference"]}
+        # dealId/dealReference bo'yicha mos kelmaganlar uchun: shu snapshotda yangi paydo bo'lgan deallar
+        unclaimed = [pos for pos in positions if pos["deal_id"] not in known_ids]
+        claimed = set()
+        for ref, pending in list(self._pending_opens.items()):
+            pos = by_id.get(pending.get("deal_id")) or by_ref.get(ref)
+            if pos is None:
+                pos = next((p for p in unclaimed if p["deal_id"] not in claimed
+                            and p["epic"] == pending["epic"] and p["direction"] == pending["direction"]), None)
+            if pos is not None:
+                claimed.add(pos["deal_id"])
+            elif now - pending["at"] <= self.pending_timeout:
+                self._count(pending["epic"], pending["direction"], pending["size"], 1)
+                continue
+            else:
+                logger.warning(f"[{ref}] kutilayotgan pozitsiya {self.pending_timeout:.0f} s ichida REST da ko'rinmadi")
+            del self._pending_opens[ref]
+        if self._pending_opens:
+            # hali ko'rinmagan ochilishlar bor — keyingi o'qishda REST qayta so'raladi
+            self._dirty = True
+            return
+        self._dirty = False
+
+    def note_opened(self, deal_reference: Optional[str], epic: str, direction: str, size: float):
+        key = deal_reference or f"pending-{next(self._pending_seq)}"
+        if key in self._pending_opens:
+            return
+        pending = {"epic": epic, "direction": direction.upper(), "size": float(size or 0), "at": self._clock()}
+        self._pending_opens[key] = pending
+        self._count(epic, pending["direction"], pending["size"], 1)
+        self._dirty = True
+
+    def note_confirmed(self, deal_reference: str, deal_id: Optional[str]):
+        """Tasdiqlangan ochilish dealId si — keyingi reconcile da aniq moslash uchun."""
+        pending = self._pending_opens.get(deal_reference)
+        if pending is not None and deal_id:
+            pending["deal_id"] = deal_id
+
+    def note_rejected(self, deal_reference: str):
+        """Rad etilgan buyurtma kutilayotganlar ro'yxatidan chiqariladi."""
+        pending = self._pending_opens.pop(deal_reference, None)
+        if pending:
+            self._count(pending["epic"], pending["direction"], pending["size"], -1)
+
+    def note_closed(self, deal_id: str):
+        self._remove(deal_id)
+        self._closing[deal_id] = self._clock()
+
+    def closing_ids(self) -> Set[str]:
+        """Yopilgan, lekin REST hali ro'yxatdan chiqarmagan bo'lishi mumkin bo'lgan deallar."""
+        return set(self._closing)
+
+    def mark_stale(self):
+        self._dirty = True
+
+    def on_quote(self, epic: str, bid: float, ask: float):
+        for pos in self._by_epic.get(epic, {}).values():
+            pos["bid"], pos["offer"] = bid, ask
+            if pos["direction"] == "BUY":
+                pos["upl"] = (bid - pos["level"]) * pos["size"]
+            elif pos["direction"] == "SELL":
+                pos["upl"] = (pos["level"] - ask) * pos["size"]
+
+    # --- o'qish ---
+
+    def fresh(self) -> bool:
+        return (not self._dirty and self._synced_at is not None
+                and self._clock() - self._synced_at <= self.max_age)
+
+    def positions(self) -> List[OpenPosition]:
+        self.memory_reads += 1
+        return list(self._positions.values())
+
+    def get(self, deal_id: str) -> Optional[OpenPosition]:
+        return self._positions.get(deal_id)
+
+    def for_epic(self, epic: str) -> List[OpenPosition]:
+        return list(self._by_epic.get(epic, {}).values())
+
+    def count(self) -> int:
+        """Ochiq va hali tasdiqlanmagan (kutilayotgan) pozitsiyalar soni."""
+        return len(self._positions) + len(self._pending_opens)
+
+    def count_for(self, epic: str, direction: Optional[str] = None) -> int:
+        if direction is None:
+            return self._epic_counts.get(epic, 0)
+        return self._side_counts.get((epic, direction.upper()), 0)
+
+    def exposure(self, epic: str) -> Dict[str, float]:
+        """Aktiv bo'yicha umumiy hajm: long, short va net (long - short)."""
+        long_size = self._exposure.get((epic, "BUY"), 0.0)
+        short_size = self._exposure.get((epic, "SELL"), 0.0)
+        return {"long": long_size, "short": short_size, "net": long_size - short_size}
+
+    def limit_reason(self, epic: str, max_total: Optional[int] = None,
+                     max_for_epic: Optional[float] = None) -> Optional[str]:
+        """Yangi pozitsiya ochish limitlardan oshsa sababni qaytaradi, aks holda None."""
+        if max_total is not None and self.count() >= max_total:
+            return f"Maksimal savdolar soniga yetildi ({self.count()}/{max_total})"
+        if max_for_epic is not None and self.count_for(epic) >= max_for_epic:
+            return f"Aktiv bo'yicha maksimal savdolar soniga yetildi ({self.count_for(epic)}/{max_for_epic})"
+        return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "positions": len(self._positions),
+            "pending_opens": len(self._pending_opens),
+            "closing": len(self._closing),
+            "epics": len(self._epic_counts),
+            "fresh": self.fresh(),
+            "age": round(self._clock() - self._synced_at, 1) if self._synced_at is not None else None,
+            "reconciles": self.reconciles,
+            "memory_reads": self.memory_reads,
+            "drift": self.drift,
+        }
@@ -0,0 +1,145 @@
+# resolution_resolver.py
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from candle_store import Candles
+
+logger = logging.getLogger(__name__)
+
+
+class ResolutionResolver:
+    """
+    Signal funksiyalarining resolution fallback zanjiri uchun:
+      - avval epic uchun oxirgi muvaffaqiyatli resolution (pref_ttl ichida) va undan ustun nomzodlar
+        sinaladi (ustunrog'i yana yaroqli bo'lsa afzallik unga qaytadi)
+      - bo'lmasa qolgan nomzodlar parallel so'raladi, afzallik tartibidagi birinchi yaroqli
+        natija qaytariladi va qolgan so'rovlar bekor qilinadi; hech bir resolution ikki marta so'ralmaydi
+      - o'rganilgan afzalliklar JSON faylda saqlanadi (restartdan keyin ham ishlaydi)
+    Kalit: "<tag>:<epic>" — har xil signal darajalari (min_bars) bir-birining afzalligini buzmaydi.
+    """
+
+    def __init__(self, path: Optional[str] = None, pref_ttl: float = 6 * 3600):
+        self.path = path
+        self.pref_ttl = pref_ttl
+        self._prefs: Dict[str, Dict[str, Any]] = self._load()
+        self.remembered_hits = 0
+        self.probes = 0
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except Exception as e:
+            logger.warning(f"Resolution afzalliklari o'qilmadi ({self.path}): {e}")
+            return {}
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._prefs, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+    async def _remember(self, key: str, resolution: Optional[str]):
+        current = self._prefs.get(key, {}).get("resolution")
+        if resolution is None:
+            if key not in self._prefs:
+                return
+            self._prefs.pop(key)
+        else:
+            self._prefs[key] = {"resolution": resolution, "updated": time.time()}
+            if current == resolution:
+                # faqat vaqt yangilandi — diskka har safar yozmaymiz
+                return
+        try:
+            await asyncio.to_thread(self._save)
+        except Exception as e:
+            logger.warning(f"Resolution afzalliklarini saqlashda xato: {e}")
+
+    def preferred(self, key: str) -> Optional[str]:
+        pref = self._prefs.get(key)
+        if not pref or time.time() - pref.get("updated", 0) > self.pref_ttl:
+            return None
+        return pref.get("resolution")
+
+    async def resolve(
+        self,
+        loader: Callable[[str], Awaitable[Candles]],
+        key: str,
+        resolutions: List[str],
+        accept: Callable[[Candles], bool],
+    ) -> Tuple[Optional[str], Candles]:
+        """
+        loader(resolution) -> Candles. Yaroqli birinchi (resolution, candles) ni qaytaradi;
+        hech biri yaroqsiz bo'lsa (None, oxirgi olingan shamlar).
+        Eslab qolingan resolution bo'lsa avval u va undan ustun turadiganlari so'raladi (ustunrog'i
+        yana yaroqli bo'lsa afzallik unga o'tadi); ular yaroqsiz bo'lsagina qolganlari so'raladi.
+        Har bir resolution bir marta so'raladi.
+        """
+        preferred = self.preferred(key)
+        if preferred in resolutions:
+            cut = resolutions.index(preferred) + 1
+            stages = [resolutions[:cut], resolutions[cut:]]
+        else:
+            stages = [resolutions]
+
+        result: Tuple[Optional[str], Candles] = (None, Candles.empty())
+        for stage in stages:
+            if not stage:
+                continue
+            if preferred not in stage:
+                self.probes += 1
+            res, candles = await self._probe(loader, key, stage, accept)
+            if res is not None or len(candles) or not len(result[1]):
+                result = (res, candles)
+            if res is not None:
+                break
+
+        if preferred is not None and result[0] is not None:
+            if result[0] == preferred:
+                self.remembered_hits += 1
+            else:
+                logger.debug(f"[{key}] resolution afzalligi {preferred} -> {result[0]}")
+        await self._remember(key, result[0])
+        return result
+
+    async def _probe(
+        self,
+        loader: Callable[[str], Awaitable[Candles]],
+        key: str,
+        resolutions: List[str],
+        accept: Callable[[Candles], bool],
+    ) -> Tuple[Optional[str], Candles]:
+        """Nomzodlarni parallel so'raydi; tartib bo'yicha birinchi yaroqlisi qolganlarini bekor qiladi."""
+        tasks = {res: asyncio.ensure_future(loader(res)) for res in resolutions}
+        for task in tasks.values():
+            # kutilmagan (bekor qilingan) vazifalarning xatosi logga "never retrieved" bo'lib chiqmasin
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        result: Tuple[Optional[str], Candles] = (None, Candles.empty())
+        try:
+            for res in resolutions:
+                try:
+                    candles = await tasks[res]
+                except Exception as e:
+                    logger.debug(f"[{key}] {res} shamlari olinmadi: {e}")
+                    continue
+                if accept(candles):
+                    return res, candles
+                logger.debug(f"[{key}] {res} resolutionda {len(candles)} ta ma'lumot, yetarli emas")
+                result = (None, candles)
+        finally:
+            for task in tasks.values():
+                if not task.done():
+                    task.cancel()
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        return {"remembered_hits": self.remembered_hits, "probes": self.probes, "size": len(self._prefs)}
@@ -0,0 +1,149 @@
+# risk_engine.py
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# rules(pozitsiya, narxlar, settings) -> (tur, sabab, joriy narx, foyda foizi) yoki None
+Rules = Callable[[Dict[str, Any], Dict[str, float], Dict[str, Any]], Optional[Tuple[str, str, float, float]]]
+# closer(pozitsiya, tur, sabab, joriy narx, foyda foizi) -> yopildimi
+Closer = Callable[[Dict[str, Any], str, str, float, float], Awaitable[bool]]
+
+
+def position_pnl(direction: str, open_price: float, prices: Dict[str, float]) -> Tuple[float, float]:
+    """(joriy narx, ochilish narxiga nisbatan foyda foizi). Manfiy foiz — zarar."""
+    if direction == "BUY":
+        current_price = prices.get("sell", 0)
+        price_diff = (current_price - open_price) / open_price if open_price else 0
+    else:  # SELL
+        current_price = prices.get("buy", 0)
+        price_diff = (open_price - current_price) / open_price if open_price else 0
+    return current_price, price_diff
+
+
+def stop_loss_reason(settings: Dict[str, Any], price_diff: float) -> Optional[str]:
+    """Stop loss chegarasi kesib o'tilgan bo'lsa sababni qaytaradi."""
+    if not settings.get("stop_loss_enabled", False):
+        return None
+    stop_loss_percent = settings.get("stop_loss_percent", 2.0) / 100  # 2% -> 0.02
+    loss_percent = -price_diff
+    if loss_percent >= stop_loss_percent:
+        return f"Stop Loss: {stop_loss_percent*100:.2f}% (Zarar: {loss_percent*100:.2f}%)"
+    return None
+
+
+class TickRiskEngine:
+    """
+    Ochiq pozitsiyalarni epic bo'yicha indekslaydi va har bir kotirovkada (websocket) faqat
+    shu epicdagi pozitsiyalar uchun stop loss / trailing qoidalarini tekshiradi.
+      - indeks pozitsiyalar monitori snapshotidan yangilanadi (update)
+      - bir deal uchun yopish so'rovi bir vaqtda bitta, muvaffaqiyatsiz urinishdan keyin
+        `debounce` soniya kutiladi
+      - kotirovka kelgan paytdan pozitsiya yopilguncha vaqt (tick-to-close) o'lchanadi
+    """
+
+    def __init__(self, rules: Rules, closer: Closer, debounce: float = 5.0,
+                 clock: Callable[[], float] = time.monotonic, latency_window: int = 200):
+        self.rules = rules
+        self.closer = closer
+        self.debounce = debounce
+        self._clock = clock
+        self._by_epic: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._settings: Dict[str, Any] = {}
+        self._inflight: Set[str] = set()
+        self._last_attempt: Dict[str, float] = {}
+        self._latencies: Deque[float] = deque(maxlen=latency_window)
+        self.ticks = 0
+        self.checks = 0
+        self.triggers = 0
+        self.debounced = 0
+        self.closes = 0
+        self.failures = 0
+
+    def update(self, positions: Iterable[Dict[str, Any]], settings: Dict[str, Any]):
+        """Indeksni yangi pozitsiyalar snapshoti bilan almashtiradi."""
+        by_epic: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        for pos in positions:
+            if pos.get("epic") and pos.get("deal_id"):
+                by_epic.setdefault(pos["epic"], {})[pos["deal_id"]] = pos
+        self._by_epic = by_epic
+        self._settings = settings
+        open_ids = {deal_id for deals in by_epic.values() for deal_id in deals}
+        for deal_id in list(self._last_attempt):
+            if deal_id not in open_ids:
+                del self._last_attempt[deal_id]
+
+    def remove(self, deal_id: str):
+        for deals in self._by_epic.values():
+            deals.pop(deal_id, None)
+
+    def on_quote(self, epic: str, bid: float, ask: float):
+        """CapitalComAPI kotirovka listeneri (sinxron): faqat shu epic pozitsiyalari tekshiriladi."""
+        deals = self._by_epic.get(epic)
+        if not deals:
+            return
+        received = self._clock()
+        self.ticks += 1
+        prices = {"buy": bid, "sell": ask}
+        for deal_id, pos in list(deals.items()):
+            if deal_id in self._inflight:
+                continue
+            self.checks += 1
+            try:
+                decision = self.rules(pos, prices, self._settings)
+            except Exception as e:
+                logger.error(f"[{deal_id}] tick qoidalarida xato: {e}")
+                continue
+            if decision is None:
+                continue
+            if received - self._last_attempt.get(deal_id, float("-inf")) < self.debounce:
+                self.debounced += 1
+                continue
+            self.triggers += 1
+            self._inflight.add(deal_id)
+            self._last_attempt[deal_id] = received
+            asyncio.ensure_future(self._close(pos, decision, received))
+
+    async def _close(self, pos: Dict[str, Any], decision: Tuple[str, str, float, float], received: float):
+        deal_id = pos["deal_id"]
+        kind, reason, current_price, price_diff = decision
+        try:
+            closed = await self.closer(pos, kind, reason, current_price, price_diff)
+        except Exception as e:
+            logger.error(f"[{deal_id}] tick bo'yicha yopishda xato: {e}")
+            closed = False
+        finally:
+            self._inflight.discard(deal_id)
+
+        if closed:
+            latency = self._clock() - received
+            self._latencies.append(latency)
+            self.closes += 1
+            self.remove(deal_id)
+            logger.info(f"[{deal_id}] tick bo'yicha yopildi ({kind}), tick-to-close: {latency*1000:.0f} ms")
+        else:
+            self.failures += 1
+
+    def stats(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies)
+
+        def pct(q: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1)
+
+        return {
+            "positions": sum(len(deals) for deals in self._by_epic.values()),
+            "ticks": self.ticks,
+            "checks": self.checks,
+            "triggers": self.triggers,
+            "debounced": self.debounced,
+            "closes": self.closes,
+            "failures": self.failures,
+            "latency_ms_p50": pct(0.5),
+            "latency_ms_p95": pct(0.95),
+            "latency_ms_max": round(latencies[-1] * 1000, 1) if latencies else None,
+        }
@@ -0,0 +1,277 @@
+# signal_engine.py
+import asyncio
+import logging
+import math
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, TypedDict
+
+import numpy as np
+
+from candle_store import Candles
+from resolution_resolver import ResolutionResolver
+from universe_indicators import UNIVERSE_DTYPE, compute_universe
+
+logger = logging.getLogger(__name__)
+
+# Voter: (xususiyatlar massivi, settings) -> (buy_mask, sell_mask). Massiv UNIVERSE_DTYPE qatorlari.
+Voter = Callable[[np.ndarray, Dict[str, Any]], Tuple[np.ndarray, np.ndarray]]
+
+
+class SignalScore(TypedDict):
+    epic: str
+    level: str
+    signal: Optional[str]          # "BUY" / "SELL" / None
+    buy: int
+    sell: int
+    max_possible: int
+    ratio: float
+    votes: Dict[str, int]          # voter -> +1 (BUY) / -1 (SELL) / 0
+    resolution: Optional[str]
+    bar_ts: Optional[int]          # oxirgi bar ochilish vaqti (ms)
+
+
+def candle_closes(candles: Candles) -> np.ndarray:
+    """Candles dan bid yopilish narxlari (yopilish narxi yo'q barlar tashlanadi)."""
+    closes = candles.close_bid
+    missing = np.isnan(closes)
+    return closes[~missing] if missing.any() else closes
+
+
+# --- voterlar reyestri ---
+
+VOTERS: Dict[str, Voter] = {}
+# voter ishlashi uchun NaN bo'lmasligi kerak bo'lgan maydonlar (require_all qoidalari uchun)
+VOTER_FIELDS: Dict[str, Tuple[str, ...]] = {}
+
+
+def register_voter(name: str, fields: Sequence[str]):
+    """Dekorator: yangi indikator voterini reyestrga qo'shadi."""
+    def decorator(fn: Voter) -> Voter:
+        VOTERS[name] = fn
+        VOTER_FIELDS[name] = tuple(fields)
+        return fn
+    return decorator
+
+
+@register_voter("rsi", ["rsi"])
+def _rsi_voter(v, settings):
+    return v["rsi"] < settings.get("rsi_buy_level", 35), v["rsi"] > settings.get("rsi_sell_level", 65)
+
+
+@register_voter("ema", ["ema20", "ema50"])
+def _ema_voter(v, settings):
+    return v["ema20"] > v["ema50"], v["ema20"] < v["ema50"]
+
+
+@register_voter("macd", ["macd", "macd_signal"])
+def _macd_voter(v, settings):
+    return v["macd"] > v["macd_signal"], v["macd"] < v["macd_signal"]
+
+
+@register_voter("macd_hist", ["macd_hist"])
+def _macd_hist_voter(v, settings):
+    return v["macd_hist"] > 0, v["macd_hist"] < 0
+
+
+@register_voter("bollinger", ["bb_upper", "bb_lower"])
+def _bollinger_voter(v, settings):
+    return v["last"] <= v["bb_lower"], v["last"] >= v["bb_upper"]
+
+
+@register_voter("bollinger_strict", ["bb_upper", "bb_lower"])
+def _bollinger_strict_voter(v, settings):
+    return v["last"] < v["bb_lower"], v["last"] > v["bb_upper"]
+
+
+@register_voter("trend", ["trend_short", "trend_long"])
+def _trend_voter(v, settings):
+    short_trend, long_trend = v["trend_short"], v["trend_long"]
+    return (short_trend > 0) & (long_trend > 0), (short_trend < 0) & (long_trend < 0)
+
+
+# --- daraja qoidalari ---
+
+class LevelRule(TypedDict):
+    voters: Tuple[str, ...]
+    threshold: float               # kerakli ovozlar ulushi (ceil(max_possible * threshold))
+    require_all: bool              # biror voter ma'lumoti bo'lmasa signal yo'q
+    window: int                    # indikatorlar oxirgi nechta bar bo'yicha hisoblanadi
+    resolutions: Tuple[str, ...]   # afzallik tartibida sinab ko'riladigan resolutionlar
+    num_points: int                # so'raladigan barlar soni
+    min_bars: int                  # resolution yaroqli bo'lishi uchun kerakli yopilish narxlari soni
+
+
+# MNL uchun settings["enabled_indicators"] kaliti -> voter
+MNL_INDICATOR_VOTERS = {"ema": "ema", "rsi": "rsi", "macd": "macd", "bollinger": "bollinger", "trend": "trend"}
+
+# resolutions / num_points / min_bars eski calculate_*_signals funksiyalaridagi bilan bir xil
+LEVEL_RULES: Dict[str, LevelRule] = {
+    "WEAK": {
+        "voters": ("rsi",), "threshold": 1.0, "require_all": False, "window": 50,
+        "resolutions": ("HOUR", "DAY"), "num_points": 50, "min_bars": 14,
+    },
+    "STRONG": {
+        "voters": ("rsi", "ema", "macd_hist", "bollinger_strict", "macd"),
+        "threshold": 0.8,          # 5 tadan 4 tasi
+        "require_all": True,
+        "window": 200,
+        "resolutions": ("HOUR", "HOUR_4", "DAY"), "num_points": 200, "min_bars": 50,
+    },
+    "MNL": {
+        "voters": tuple(MNL_INDICATOR_VOTERS.values()), "threshold": 0.6, "require_all": False, "window": 50,
+        "resolutions": ("HOUR", "HOUR_4", "DAY", "MINUTE"), "num_points": 50, "min_bars": 20,
+    },
+}
+
+
+def level_rule(level: str, settings: Dict[str, Any]) -> Optional[LevelRule]:
+    rule = LEVEL_RULES.get(level)
+    if rule is None or level != "MNL":
+        return rule
+    enabled = settings.get("enabled_indicators") or {key: True for key in MNL_INDICATOR_VOTERS}
+    voters = tuple(voter for key, voter in MNL_INDICATOR_VOTERS.items() if enabled.get(key, True))
+    return {**rule, "voters": voters}
+
+
+class SignalEngine:
+    """
+    Barcha signal darajalari (TEST, WEAK, MNL, STRONG) uchun yagona dvigatel.
+      - har bir daraja o'z resolutionlari, bar soni va minimal tarixi bilan shamlarni oladi
+        (LEVEL_RULES); xususiyatlar qatori (feature frame) har bir aktiv, daraja va bar uchun bir marta
+        hisoblanadi, shamlar jarayon keshidan (candle_cache) qayta ishlatiladi
+      - bir nechta aktiv bitta matritsa bilan (universe_indicators) hisoblanadi
+      - voterlar reyestri + daraja qoidalari; natija SignalScore
+    """
+
+    def __init__(self, resolver: ResolutionResolver):
+        self.resolver = resolver
+        # (epic, daraja) -> (resolution, oxirgi bar ts, bar soni, xususiyatlar qatori)
+        self._frames: Dict[Tuple[str, str], Tuple[str, int, int, np.void]] = {}
+        self.frames_built = 0
+        self.frames_reused = 0
+
+    async def _load_candles(self, api, epic: str, level: str, rule: LevelRule) -> Tuple[Optional[str], Candles]:
+        # kalit eski fetch_candles_with_fallback tegi bilan bir xil: o'rganilgan resolution saqlanib qoladi
+        return await self.resolver.resolve(
+            lambda res: api.get_candles(epic, res, rule["num_points"]),
+            f"{level}:{epic}",
+            list(rule["resolutions"]),
+            lambda candles: len(candle_closes(candles)) >= rule["min_bars"],
+        )
+
+    async def features(self, api, epics: List[str], level: str,
+                       rule: LevelRule) -> Dict[str, Tuple[str, np.void]]:
+        """
+        epic -> (resolution, oxirgi rule["window"] bar bo'yicha xususiyatlar qatori).
+        Daraja resolutionlarining hech birida yetarli tarix bo'lmagan epiclar natijaga kirmaydi.
+        """
+        window = rule["window"]
+        loaded = await asyncio.gather(*(self._load_candles(api, epic, level, rule) for epic in epics),
+                                      return_exceptions=True)
+
+        result: Dict[str, Tuple[str, np.void]] = {}
+        to_build: Dict[str, np.ndarray] = {}
+        meta: Dict[str, Tuple[str, int, int]] = {}
+        for epic, item in zip(epics, loaded):
+            if isinstance(item, Exception):
+                logger.debug(f"[{epic}] signal: shamlar olinmadi: {item}")
+                continue
+            resolution, candles = item
+            if resolution is None:
+                logger.debug(f"[{epic}] signal: yetarli tarixiy ma'lumot topilmadi")
+                continue
+            key = (resolution, int(candles.ts[-1]), len(candles))
+            cached = self._frames.get((epic, level))
+            if cached and cached[:3] == key:
+                self.frames_reused += 1
+                result[epic] = (resolution, cached[3])
+                continue
+            meta[epic] = key
+            to_build[epic] = candle_closes(candles)[-window:]
+
+        if to_build:
+            for row in compute_universe(to_build):
+                epic = str(row["epic"])
+                self._frames[(epic, level)] = meta[epic] + (row,)
+                result[epic] = (meta[epic][0], row)
+                self.frames_built += 1
+        return result
+
+    @staticmethod
+    def score_rows(rows: np.ndarray, level: str, settings: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Voterlarni butun massiv ustida bir martada ishlatadi; har bir qator uchun ball qaytaradi."""
+        rule = level_rule(level, settings)
+        if rule is None or not len(rows):
+            return [{"signal": None, "buy": 0, "sell": 0, "max_possible": 0, "ratio": 0.0, "votes": {}}
+                    for _ in range(len(rows))]
+
+        votes: Dict[str, np.ndarray] = {}
+        for name in rule["voters"]:
+            buy_mask, sell_mask = VOTERS[name](rows, settings)
+            votes[name] = np.where(buy_mask, 1, np.where(sell_mask, -1, 0))
+        max_possible = len(votes)
+
+        valid = np.ones(len(rows), dtype=bool)
+        if rule["require_all"]:
+            for name in rule["voters"]:
+                for field in VOTER_FIELDS[name]:
+                    valid &= ~np.isnan(rows[field])
+
+        stacked = np.vstack(list(votes.values())) if votes else np.zeros((0, len(rows)), dtype=int)
+        buy = (stacked == 1).sum(axis=0)
+        sell = (stacked == -1).sum(axis=0)
+        required = math.ceil(max_possible * rule["threshold"]) if max_possible else 0
+
+        scores = []
+        for i in range(len(rows)):
+            signal = None
+            if max_possible and valid[i]:
+                if buy[i] >= required:
+                    signal = "BUY"
+                elif sell[i] >= required:
+                    signal = "SELL"
+            scores.append({
+                "signal": signal,
+                "buy": int(buy[i]),
+                "sell": int(sell[i]),
+                "max_possible": max_possible,
+                "ratio": float(max(buy[i], sell[i]) / max_possible) if max_possible else 0.0,
+                "votes": {name: int(vote[i]) for name, vote in votes.items()},
+            })
+        return scores
+
+    async def evaluate_many(self, api, epics: List[str], settings: Dict[str, Any], level: str) -> Dict[str, SignalScore]:
+        """Berilgan epiclarni bitta chaqiruvda baholaydi. Ma'lumot yetmagan epic uchun signal None."""
+        if level == "TEST":
+            # TEST rejimi: ma'lumotsiz, har doim BUY
+            return {
+                epic: SignalScore(epic=epic, level=level, signal="BUY", buy=1, sell=0, max_possible=1,
+                                  ratio=1.0, votes={}, resolution=None, bar_ts=None)
+                for epic in epics
+            }
+
+        rule = level_rule(level, settings)
+        frames = await self.features(api, epics, level, rule) if rule else {}
+        scored = [epic for epic in epics if epic in frames]
+        rows = np.array([frames[epic][1] for epic in scored], dtype=UNIVERSE_DTYPE)
+        results: Dict[str, SignalScore] = {}
+        for epic, score in zip(scored, self.score_rows(rows, level, settings)):
+            resolution = frames[epic][0]
+            results[epic] = SignalScore(
+                epic=epic, level=level, resolution=resolution, bar_ts=self._frames[(epic, level)][1], **score
+            )
+            logger.info(
+                f"[{epic}] {level}: Signal nisbati: {score['ratio']:.2f} "
+                f"({score['buy']}/{score['max_possible']} BUY, {score['sell']}/{score['max_possible']} SELL) "
+                f"-> {score['signal']}"
+            )
+        for epic in epics:
+            if epic not in results:
+                results[epic] = SignalScore(epic=epic, level=level, signal=None, buy=0, sell=0, max_possible=0,
+                                            ratio=0.0, votes={}, resolution=None, bar_ts=None)
+        return results
+
+    async def evaluate(self, api, epic: str, settings: Dict[str, Any], level: str) -> SignalScore:
+        return (await self.evaluate_many(api, [epic], settings, level))[epic]
+
+    def stats(self) -> Dict[str, int]:
+        return {"frames_built": self.frames_built, "frames_reused": self.frames_reused, "size": len(self._frames)}
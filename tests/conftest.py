@@ -0,0 +1,7 @@
+# tests/conftest.py
+import os
+import sys
+
+# config.py CHAT_ID ni int() qiladi; testlarda .env bo'lmasligi mumkin
+os.environ.setdefault("CHAT_ID", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
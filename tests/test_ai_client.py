@@ -0,0 +1,114 @@
+# tests/test_ai_client.py
+import asyncio
+import time
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+import pytest
+
+from ai_client import AIClientError, CircuitBreaker, TokenBucket, parse_retry_after
+
+NOW = datetime(2025, 1, 6, 12, 0, 0, tzinfo=timezone.utc).timestamp()
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("30", 30.0),
+    ("1.5", 1.5),
+    (None, 0.0),
+    ("", 0.0),
+    ("-5", 0.0),
+    ("keyinroq", 0.0),
+])
+def test_retry_after_seconds_and_garbage(value, expected):
+    assert parse_retry_after(value, now=NOW) == expected
+
+
+def test_retry_after_http_date():
+    value = format_datetime(datetime(2025, 1, 6, 12, 0, 45, tzinfo=timezone.utc), usegmt=True)
+    assert parse_retry_after(value, now=NOW) == pytest.approx(45.0)
+    assert parse_retry_after("Mon, 06 Jan 2025 11:00:00 GMT", now=NOW) == 0.0
+
+
+# --- circuit breaker ---
+
+def make_breaker(**kwargs):
+    now = [0.0]
+    options = {"window": 10, "min_calls": 4, "error_rate": 0.5, "slow_seconds": 2.0, "open_seconds": 30.0}
+    return CircuitBreaker(clock=lambda: now[0], **{**options, **kwargs}), now
+
+
+def trip(breaker):
+    for _ in range(4):
+        breaker.record(False, 0.1)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_breaker_opens_on_error_rate():
+    breaker, _ = make_breaker()
+    for ok in (True, False, True):
+        breaker.record(ok, 0.1)
+    assert breaker.state == CircuitBreaker.CLOSED  # min_calls ga yetmagan
+    breaker.record(False, 0.1)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow() and breaker.stats()["rejected"] == 1
+
+
+def test_breaker_opens_on_slow_calls():
+    breaker, _ = make_breaker()
+    for latency in (0.1, 3.0, 3.0, 0.1):
+        breaker.record(True, latency)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_half_open_allows_one_probe_and_closes_on_success():
+    breaker, now = make_breaker()
+    trip(breaker)
+    now[0] = 29.0
+    assert not breaker.available()
+    now[0] = 30.0
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    assert not breaker.allow()  # sinov so'rovi band
+    breaker.record(True, 0.1)
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+
+@pytest.mark.parametrize("ok, latency", [(False, 0.1), (True, 5.0)])
+def test_failed_or_slow_probe_reopens(ok, latency):
+    breaker, now = make_breaker()
+    trip(breaker)
+    now[0] = 30.0
+    assert breaker.allow()
+    breaker.record(ok, latency)
+    assert breaker.state == CircuitBreaker.OPEN and breaker.stats()["trips"] == 2
+    now[0] = 60.0
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+# --- token bucket ---
+
+def test_token_bucket_burst_then_deadline():
+    async def run():
+        now = [0.0]
+        bucket = TokenBucket(rate=0.25, capacity=2, clock=lambda: now[0])
+        waits = [await bucket.acquire(deadline=10.0), await bucket.acquire(deadline=10.0)]
+        with pytest.raises(AIClientError) as error:
+            await bucket.acquire(deadline=1.0)  # keyingi token 4 s dan keyin
+        return waits, error.value.status
+
+    assert asyncio.run(run()) == ([0.0, 0.0], 429)
+
+
+def test_token_bucket_waits_for_refill_and_drain():
+    async def run():
+        bucket = TokenBucket(rate=100.0, capacity=1)
+        await bucket.acquire(deadline=time.monotonic() + 1)
+        waited = await bucket.acquire(deadline=time.monotonic() + 1)
+        bucket.drain(0.05)
+        started = time.monotonic()
+        await bucket.acquire(deadline=time.monotonic() + 1)
+        return waited, time.monotonic() - started
+
+    waited, drained = asyncio.run(run())
+    assert 0 < waited <= 0.02
+    assert drained >= 0.05
@@ -0,0 +1,107 @@
+# tests/test_ai_prompts.py
+import asyncio
+import json
+
+import numpy as np
+
+import gemini_ai
+import trading_logic
+from candle_store import COLUMNS, Candles
+
+
+def make_candles(closes: np.ndarray) -> Candles:
+    values = np.tile(closes, (len(COLUMNS), 1))
+    ts = np.arange(len(closes), dtype=np.int64) * 3_600_000
+    return Candles(ts, values)
+
+
+def realistic_indicators(bars: int = 60, seed: int = 3):
+    closes = np.cumsum(np.random.default_rng(seed).normal(0.2, 1.0, bars)) + 100.0
+    return trading_logic.calculate_indicators(make_candles(closes))
+
+
+def capture_generate(monkeypatch, reply):
+    prompts = []
+
+    async def generate(prompt, generation_config=None, deadline=None):
+        prompts.append(prompt)
+        return reply(prompt)
+
+    monkeypatch.setattr(gemini_ai.shared_ai_client, "generate", generate)
+    return prompts
+
+
+def test_build_signal_context_renders_real_indicators():
+    indicators = realistic_indicators()
+    assert indicators["macd"] is not None and indicators["bb_upper"] is not None
+    context = trading_logic.build_signal_context("Gold", "BUY", {"buy": 100.0, "sell": 100.2}, indicators)
+    assert f"RSI: {indicators['rsi']:.1f}" in context
+    assert "MACD: BULLISH" in context or "MACD: BEARISH" in context
+
+
+def test_build_signal_context_tolerates_missing_indicators():
+    # 26 bardan kam: MACD yo'q; RSI None bo'lishi ham mumkin
+    indicators = realistic_indicators(bars=22)
+    assert "macd" not in indicators
+    context = trading_logic.build_signal_context("Gold", "SELL", {"buy": 100.0, "sell": 100.2},
+                                                 dict(indicators, rsi=None))
+    assert "RSI: N/A" in context
+    assert "MACD: UNKNOWN" in context
+
+
+def test_batch_prompt_sends_enhanced_context(monkeypatch):
+    prompts = capture_generate(monkeypatch, lambda prompt: json.dumps([
+        {"id": 0, "decision": "APPROVE", "reason": "trend"},
+        {"id": 1, "decision": "REJECT", "reason": "spread"},
+    ]))
+
+    async def send_trading_status(context, message, level="info"):
+        pass
+
+    monkeypatch.setattr(trading_logic, "send_trading_status", send_trading_status)
+    candidates = [
+        {"asset": asset, "signal": signal, "prices": {"buy": 100.0, "sell": 100.2},
+         "indicators": realistic_indicators(seed=seed), "resolution": "HOUR", "ai_pending": True}
+        for asset, signal, seed in (("Gold", "BUY", 1), ("Tesla", "SELL", 2))
+    ]
+    settings = {"ai_cache_enabled": False, "ai_batch_size": 8}
+
+    approved = asyncio.run(trading_logic.approve_candidates_batch(None, candidates, settings))
+
+    assert len(prompts) == 1  # bitta batch so'rov, alohida qayta so'rovlarsiz
+    assert "id=0" in prompts[0] and "id=1" in prompts[0]
+    assert prompts[0].count("SPREAD:") == 2 and prompts[0].count("MARKET HOURS:") == 2
+    assert [candidate["asset"] for candidate in approved] == ["Gold"]
+
+
+def test_entry_prompt_reply_parses(monkeypatch):
+    reply = json.dumps({"decision": "approve", "reason": "trend va MACD mos"})
+    prompts = capture_generate(monkeypatch, lambda prompt: reply)
+
+    result = asyncio.run(trading_logic.get_ai_trade_signal_enhanced(
+        "Gold", "BUY", {"buy": 100.0, "sell": 100.2}, realistic_indicators()))
+
+    assert "PROFESSIONAL TRADING SIGNAL EVALUATION" in prompts[0] and "RSI: " in prompts[0]
+    assert result == gemini_ai.parse_decision("entry", reply) == {"decision": "APPROVE", "reason": "trend va MACD mos"}
+
+
+def test_trailing_prompt_reply_parses(monkeypatch):
+    reply = json.dumps({"action": "HOLD", "net_take_profit_percent": 1.5, "confidence": 80, "reason": "trend davom"})
+    prompts = capture_generate(monkeypatch, lambda prompt: reply)
+
+    result = asyncio.run(trading_logic.get_dynamic_ai_trailing_decision(
+        "Gold", "BUY", 100.0, 101.0, realistic_indicators(), "deal-1", {"buy": 101.0, "sell": 101.2}))
+
+    assert "DYNAMIC TRAILING STOP ANALYSIS" in prompts[0] and "MACD: " in prompts[0]
+    assert gemini_ai.parse_decision("trailing", reply)["action"] == "HOLD"
+    assert result["action"] == "HOLD" and not result.get("error")
+
+
+def test_trailing_prompt_without_indicators(monkeypatch):
+    prompts = capture_generate(monkeypatch, lambda prompt: json.dumps({"action": "CLOSE", "reason": "foyda"}))
+
+    result = asyncio.run(trading_logic.get_dynamic_ai_trailing_decision(
+        "Gold", "SELL", 100.0, 99.0, {}, "deal-1", {"buy": 99.0, "sell": 99.2}))
+
+    assert "RSI: N/A" in prompts[0]
+    assert result["action"] == "CLOSE"
@@ -0,0 +1,38 @@
+# tests/test_ai_trailing.py
+import asyncio
+
+import pytest
+
+import trading_logic
+from candle_store import Candles
+
+POSITION = {"deal_id": "D1", "deal_reference": None, "epic": "GOLD", "instrument_name": "Gold",
+            "direction": "BUY", "level": 100.0, "size": 1.0, "upl": 0.0, "leverage": None,
+            "created_date_utc": None, "bid": None, "offer": None}
+
+
+class FakeApi:
+    async def get_candles(self, epic, resolution, num_points):
+        return Candles.empty()
+
+
+def check(monkeypatch, policy: str, price_diff: float):
+    async def broken_decision(*args, **kwargs):
+        raise TypeError("prompt xato")
+
+    monkeypatch.setattr(trading_logic, "get_dynamic_ai_trailing_decision", broken_decision)
+    trading_logic.ai_trailing_positions.pop(POSITION["deal_id"], None)
+    return asyncio.run(trading_logic._check_ai_trailing(
+        FakeApi(), POSITION, 101.0, {"buy": 101.0, "sell": 101.2}, price_diff, 0.01,
+        {"ai_fallback_policy": policy},
+    ))
+
+
+@pytest.mark.parametrize("policy", ["skip", "reject"])
+def test_unexpected_error_follows_hold_policies(monkeypatch, policy):
+    assert check(monkeypatch, policy, price_diff=0.05) is None
+
+
+def test_unexpected_error_rules_policy_uses_plain_trailing(monkeypatch):
+    assert check(monkeypatch, "rules", price_diff=0.05).startswith("AI mavjud emas: Oddiy trailing")
+    assert check(monkeypatch, "rules", price_diff=0.001) is None
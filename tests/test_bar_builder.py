@@ -0,0 +1,72 @@
+# tests/test_bar_builder.py
+import numpy as np
+
+from bar_builder import BarBuilder
+from candle_store import COLUMNS, Candles
+
+MINUTE_MS = 60_000
+T0 = 1_699_999_200_000  # MINUTE bar chegarasi (ms)
+
+
+def history(n: int, end_ms: int) -> Candles:
+    ts = end_ms - np.arange(n, 0, -1, dtype=np.int64) * MINUTE_MS
+    return Candles(ts, np.full((len(COLUMNS), n), 100.0))
+
+
+def make_builder(now_ms):
+    builder = BarBuilder(capacity=100, resolutions=("MINUTE",), clock=lambda: now_ms[0] / 1000)
+    builder.set_subscribed(["GOLD"])
+    builder.seed("GOLD", "MINUTE", history(30, T0))
+    return builder
+
+
+def test_builds_ohlc_and_emits_bar_close():
+    now = [T0]
+    builder = make_builder(now)
+    closed = []
+    builder.add_listener(lambda epic, res, ts: closed.append((epic, res, ts)))
+
+    for offset, bid in ((1_000, 101.0), (20_000, 103.0), (40_000, 99.0), (59_000, 102.0)):
+        builder.on_quote("GOLD", bid, bid + 0.5, T0 + offset)
+    builder.on_quote("GOLD", 104.0, 104.5, T0 + MINUTE_MS + 1_000)
+    now[0] = T0 + MINUTE_MS + 2_000
+
+    bars = builder.get("GOLD", "MINUTE", 3)
+    assert list(bars.ts) == [T0 - MINUTE_MS, T0, T0 + MINUTE_MS]
+    bar = bars.values[:, 1]
+    assert [bar[COLUMNS.index(name)] for name in ("open_bid", "high_bid", "low_bid", "close_bid")] == \
+        [101.0, 103.0, 99.0, 102.0]
+    assert np.isnan(bar[COLUMNS.index("volume")])
+    assert closed == [("GOLD", "MINUTE", T0 - MINUTE_MS), ("GOLD", "MINUTE", T0)]
+
+
+def test_no_bars_before_first_quote_or_for_unsubscribed_epic():
+    now = [T0 + 1_000]
+    builder = make_builder(now)
+    assert builder.get("GOLD", "MINUTE", 10) is None  # seed dan keyin kotirovka yo'q
+    builder.on_quote("GOLD", 100.0, 100.5, T0 + 1_000)
+    assert len(builder.get("GOLD", "MINUTE", 10)) == 10
+    assert builder.get("TSLA", "MINUTE", 1) is None
+
+
+def test_quiet_stream_and_gaps_are_not_served():
+    now = [T0 + 1_000]
+    builder = make_builder(now)
+    builder.on_quote("GOLD", 100.0, 100.5, T0 + 1_000)
+    now[0] = T0 + 1_000 + 2 * MINUTE_MS  # bir bardan uzoq kotirovka kelmadi
+    assert builder.get("GOLD", "MINUTE", 10) is None
+
+    builder.on_quote("GOLD", 100.0, 100.5, now[0])  # uzilishdan keyingi kotirovka
+    assert builder.get("GOLD", "MINUTE", 10) is None  # oradagi barlar yo'q — REST backfill kerak
+    builder.seed("GOLD", "MINUTE", history(30, now[0] - now[0] % MINUTE_MS))
+    builder.on_quote("GOLD", 100.0, 100.5, now[0] + 1_000)
+    assert builder.get("GOLD", "MINUTE", 10) is not None
+
+
+def test_mark_stale_drops_subscriptions():
+    now = [T0 + 1_000]
+    builder = make_builder(now)
+    builder.on_quote("GOLD", 100.0, 100.5, T0 + 1_000)
+    builder.mark_stale()
+    assert not builder.streaming("GOLD")
+    assert builder.get("GOLD", "MINUTE", 10) is None
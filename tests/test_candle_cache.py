@@ -0,0 +1,81 @@
+# tests/test_candle_cache.py
+import asyncio
+
+import numpy as np
+
+import candle_cache
+from candle_cache import CandleCache
+from candle_store import COLUMNS, Candles
+
+
+def candles(n: int) -> Candles:
+    return Candles(np.arange(n, dtype=np.int64), np.ones((len(COLUMNS), n)))
+
+
+def make_loader(delay: float = 0.0, size=None):
+    calls = []
+
+    async def loader(epic, resolution, num_points):
+        calls.append((epic, resolution, num_points))
+        await asyncio.sleep(delay)
+        return candles(num_points if size is None else size)
+
+    return loader, calls
+
+
+def test_single_flight_and_stats():
+    async def run():
+        cache = CandleCache()
+        loader, calls = make_loader(delay=0.01)
+        results = await asyncio.gather(*(cache.get("GOLD", "HOUR", 50, loader) for _ in range(4)))
+        await cache.get("GOLD", "HOUR", 20, loader)
+        return cache, results, calls
+
+    cache, results, calls = asyncio.run(run())
+    assert calls == [("GOLD", "HOUR", 50)]
+    assert all(len(result) == 50 for result in results)
+    stats = cache.stats()
+    assert (stats["misses"], stats["coalesced"], stats["hits"]) == (1, 3, 1)
+    assert stats["hit_rate"] == 0.2  # kutilgan (coalesced) so'rovlar hit hisoblanmaydi
+
+
+def test_waiter_needing_more_bars_loads_itself():
+    async def run():
+        cache = CandleCache()
+        loader, calls = make_loader(delay=0.01)
+        small = asyncio.ensure_future(cache.get("GOLD", "HOUR", 20, loader))
+        await asyncio.sleep(0)
+        big = await cache.get("GOLD", "HOUR", 50, loader)
+        return cache, len(await small), len(big), calls
+
+    cache, small, big, calls = asyncio.run(run())
+    assert (small, big) == (20, 50)
+    assert [call[2] for call in calls] == [20, 50]
+    assert cache.stats()["coalesced"] == 0 and cache.stats()["misses"] == 2
+
+
+def test_entry_expires_at_the_bar_boundary(monkeypatch):
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(candle_cache.time, "time", lambda: now[0])
+
+    async def run():
+        cache = CandleCache()
+        loader, calls = make_loader()
+        await cache.get("GOLD", "MINUTE", 30, loader)
+        await cache.get("GOLD", "MINUTE", 30, loader)
+        now[0] += 61  # keyingi MINUTE bari yopildi
+        await cache.get("GOLD", "MINUTE", 30, loader)
+        return calls
+
+    assert len(asyncio.run(run())) == 2
+
+
+def test_short_result_is_not_cached():
+    async def run():
+        cache = CandleCache()
+        loader, calls = make_loader(size=5)
+        await cache.get("GOLD", "HOUR", 50, loader)
+        await cache.get("GOLD", "HOUR", 50, loader)
+        return calls
+
+    assert len(asyncio.run(run())) == 2
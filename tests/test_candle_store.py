@@ -0,0 +1,74 @@
+# tests/test_candle_store.py
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import candle_store
+from candle_store import COLUMNS, CandleStore, Candles, merge_candles, next_bar_boundary
+
+
+def candles(start: int, n: int, value: float = 1.0) -> Candles:
+    ts = (np.arange(start, start + n, dtype=np.int64)) * 3_600_000
+    return Candles(ts, np.full((len(COLUMNS), n), value))
+
+
+def test_save_and_load_round_trip(tmp_path):
+    CandleStore(str(tmp_path)).save("CS.D.EURUSD", "HOUR", candles(0, 10))
+    loaded = CandleStore(str(tmp_path)).load("CS.D.EURUSD", "HOUR")
+    assert len(loaded) == 10 and loaded.ts[-1] == 9 * 3_600_000
+    assert os.listdir(tmp_path) == ["CS.D.EURUSD_HOUR.npy"]
+
+
+def test_save_keeps_only_max_bars(tmp_path):
+    store = CandleStore(str(tmp_path), max_bars=5)
+    store.save("GOLD", "HOUR", candles(0, 8))
+    assert list(CandleStore(str(tmp_path)).load("GOLD", "HOUR").ts // 3_600_000) == [3, 4, 5, 6, 7]
+
+
+def test_failed_save_keeps_previous_file_and_no_temp(tmp_path, monkeypatch):
+    store = CandleStore(str(tmp_path))
+    store.save("GOLD", "HOUR", candles(0, 5))
+
+    def broken_save(f, data):
+        f.write(b"yarim")
+        raise OSError("disk to'ldi")
+
+    monkeypatch.setattr(candle_store.np, "save", broken_save)
+    with pytest.raises(OSError):
+        store.save("GOLD", "HOUR", candles(0, 9))
+    monkeypatch.undo()
+
+    assert os.listdir(tmp_path) == ["GOLD_HOUR.npy"]
+    assert len(CandleStore(str(tmp_path)).load("GOLD", "HOUR")) == 5
+
+
+def test_concurrent_saves_use_separate_temp_files(tmp_path):
+    store = CandleStore(str(tmp_path))
+    errors = []
+
+    def save(i):
+        try:
+            for _ in range(20):
+                store.save("GOLD", "HOUR", candles(0, 50 + i, value=float(i)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert os.listdir(tmp_path) == ["GOLD_HOUR.npy"]
+    loaded = CandleStore(str(tmp_path)).load("GOLD", "HOUR")
+    assert len(loaded) - 50 == int(loaded.close_bid[0])  # bitta yozuv to'liq, aralashmagan
+
+
+def test_merge_prefers_new_bars_and_bar_boundary():
+    merged = merge_candles(candles(0, 5, value=1.0), candles(3, 4, value=2.0))
+    assert list(merged.ts // 3_600_000) == [0, 1, 2, 3, 4, 5, 6]
+    assert list(merged.close_bid) == [1.0, 1.0, 1.0, 2.0, 2.0, 2.0, 2.0]
+    assert next_bar_boundary("HOUR", 7200.5) == 10800
@@ -0,0 +1,63 @@
+# tests/test_execution.py
+import asyncio
+
+import pytest
+
+from capital_api import CapitalAPIError
+from execution import OrderExecutor, entry_quote
+from position_book import PositionBook
+
+
+class FakeApi:
+    def __init__(self, confirmations):
+        self.confirmations = list(confirmations)
+        self.confirm_calls = 0
+        self.position_book = PositionBook()
+
+    async def open_position(self, epic, direction, size):
+        return {"success": True, "deal_id": "REF1"}
+
+    async def get_deal_confirmation(self, deal_reference):
+        self.confirm_calls += 1
+        item = self.confirmations.pop(0) if self.confirmations else CapitalAPIError(503, "hali yo'q")
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+def submit(api, direction, prices, **kwargs):
+    executor = OrderExecutor(api, confirm_timeout=kwargs.pop("confirm_timeout", 1.0), base_delay=0.01, max_delay=0.02)
+    return asyncio.run(executor.submit("GOLD", direction, 1.0, quote_price=entry_quote(direction, prices)))
+
+
+PRICES = {"buy": 100.0, "sell": 100.5}  # buy — bid, sell — offer
+
+
+def test_entry_quote_uses_offer_for_buy_and_bid_for_sell():
+    assert entry_quote("BUY", PRICES) == 100.5
+    assert entry_quote("sell", PRICES) == 100.0
+    assert entry_quote("BUY", {"buy": 100.0}) is None
+
+
+@pytest.mark.parametrize("direction, level", [("BUY", 100.5), ("SELL", 100.0)])
+def test_fill_at_the_touch_has_no_slippage(direction, level):
+    api = FakeApi([{"dealStatus": "ACCEPTED", "dealId": "D1", "level": level}])
+    fill = submit(api, direction, PRICES)
+    assert fill["status"] == "ACCEPTED"
+    assert fill["slippage_bps"] == 0.0
+
+
+def test_confirm_retries_server_errors():
+    api = FakeApi([CapitalAPIError(500, "timeout"), CapitalAPIError(502, "gateway"),
+                   {"dealStatus": "ACCEPTED", "dealId": "D1", "level": 100.6}])
+    fill = submit(api, "BUY", PRICES)
+    assert fill["status"] == "ACCEPTED" and api.confirm_calls == 3
+    assert fill["slippage"] == pytest.approx(0.1)
+
+
+@pytest.mark.parametrize("status", [401, 403, 404])
+def test_confirm_does_not_retry_client_errors(status):
+    api = FakeApi([CapitalAPIError(status, "xato")])
+    fill = submit(api, "BUY", PRICES, confirm_timeout=5.0)
+    assert fill["status"] == "UNCONFIRMED" and api.confirm_calls == 1
+    assert str(status) in fill["reason"]
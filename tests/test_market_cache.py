@@ -0,0 +1,59 @@
+# tests/test_market_cache.py
+import asyncio
+
+from market_cache import MarketInfoCache
+
+
+def make_cache(**kwargs):
+    calls = []
+
+    async def loader(epic):
+        calls.append(epic)
+        return {"instrument": {"epic": epic, "name": epic.title()},
+                "dealingRules": {"minDealSize": {"value": 1}},
+                "snapshot": {"bid": 100.0 + len(calls), "offer": 100.5 + len(calls)}}
+
+    return MarketInfoCache(loader, **kwargs), calls
+
+
+def test_max_dynamic_age_refetches_snapshot_inside_dynamic_ttl():
+    async def run():
+        cache, calls = make_cache(dynamic_ttl=30.0)
+        first = await cache.get("GOLD", include_dynamic=True)
+        cached = await cache.get("GOLD", include_dynamic=True, max_dynamic_age=5.0)
+        await asyncio.sleep(0.02)
+        fresh = await cache.get("GOLD", include_dynamic=True, max_dynamic_age=0.01)
+        return first, cached, fresh, calls
+
+    first, cached, fresh, calls = asyncio.run(run())
+    assert cached["snapshot"] == first["snapshot"]
+    assert fresh["snapshot"]["bid"] == 102.0
+    assert calls == ["GOLD", "GOLD"]
+
+
+def test_static_view_ignores_max_dynamic_age():
+    async def run():
+        cache, calls = make_cache()
+        await cache.get("GOLD")
+        await asyncio.sleep(0.02)
+        view = await cache.get("GOLD", max_dynamic_age=0.01)
+        return view, calls
+
+    view, calls = asyncio.run(run())
+    assert "snapshot" not in view
+    assert calls == ["GOLD"]
+
+
+def test_views_do_not_share_nested_dicts_with_the_cache():
+    async def run():
+        cache, _ = make_cache()
+        first = await cache.get("GOLD", include_dynamic=True)
+        first["instrument"]["name"] = "buzilgan"
+        first["dealingRules"]["minDealSize"]["value"] = 99
+        first["snapshot"]["bid"] = 0.0
+        return await cache.get("GOLD", include_dynamic=True), await cache.get("GOLD")
+
+    full, static = asyncio.run(run())
+    assert full["instrument"]["name"] == "Gold" and static["instrument"]["name"] == "Gold"
+    assert full["dealingRules"]["minDealSize"]["value"] == 1
+    assert full["snapshot"]["bid"] == 101.0
@@ -0,0 +1,98 @@
+# tests/test_position_book.py
+from position_book import PositionBook
+
+
+def position(deal_id, epic="GOLD", direction="BUY", size=1.0, deal_reference=None):
+    return {"deal_id": deal_id, "deal_reference": deal_reference, "epic": epic, "instrument_name": epic,
+            "direction": direction, "level": 100.0, "size": size, "upl": 0.0, "leverage": None,
+            "created_date_utc": None, "bid": None, "offer": None}
+
+
+def make_book():
+    now = [0.0]
+    book = PositionBook(max_age=60, pending_timeout=120, clock=lambda: now[0])
+    return book, now
+
+
+def test_reconcile_indexes_and_exposure():
+    book, _ = make_book()
+    book.reconcile([position("A"), position("B", direction="SELL", size=2.0), position("C", epic="TSLA")])
+    assert book.count() == 3 and book.fresh()
+    assert book.count_for("GOLD") == 2 and book.count_for("GOLD", "sell") == 1
+    assert book.exposure("GOLD") == {"long": 1.0, "short": 2.0, "net": -1.0}
+    assert book.limit_reason("GOLD", max_total=5, max_for_epic=2) is not None
+    assert book.limit_reason("TSLA", max_total=5, max_for_epic=2) is None
+
+
+def test_closed_deal_stays_out_while_rest_still_lists_it():
+    book, now = make_book()
+    book.reconcile([position("A"), position("B")])
+    book.note_closed("A")
+    book.reconcile([position("A"), position("B")])  # REST kechikmoqda
+    assert [pos["deal_id"] for pos in book.positions()] == ["B"]
+    assert book.closing_ids() == {"A"}
+
+    book.reconcile([position("B")])
+    assert book.closing_ids() == set()
+
+
+def test_closed_deal_comes_back_after_timeout():
+    book, now = make_book()
+    book.reconcile([position("A")])
+    book.note_closed("A")
+    now[0] = 121
+    book.reconcile([position("A")])
+    assert book.get("A") is not None and book.closing_ids() == set()
+
+
+def test_pending_open_counts_until_its_deal_appears():
+    book, now = make_book()
+    book.reconcile([position("A")])
+    book.note_opened("REF1", "GOLD", "SELL", 1.0)
+    book.note_confirmed("REF1", "N1")
+
+    book.reconcile([position("A")])  # yangi deal hali ko'rinmaydi
+    assert book.count() == 2 and book.count_for("GOLD", "SELL") == 1
+    assert not book.fresh()
+
+    book.reconcile([position("A"), position("N1", direction="SELL")])
+    assert book.count() == 2 and book.stats()["pending_opens"] == 0
+    assert book.fresh()
+
+
+def test_pending_open_matches_new_deal_by_epic_and_direction():
+    book, _ = make_book()
+    book.reconcile([position("A")])
+    book.note_opened("REF1", "TSLA", "BUY", 1.0)
+    book.reconcile([position("A"), position("B", epic="GOLD")])  # boshqa aktiv — mos emas
+    assert book.stats()["pending_opens"] == 1
+    book.reconcile([position("A"), position("B", epic="GOLD"), position("C", epic="TSLA")])
+    assert book.stats()["pending_opens"] == 0 and book.count() == 3
+
+
+def test_pending_open_expires_after_timeout():
+    book, now = make_book()
+    book.reconcile([])
+    book.note_opened("REF1", "GOLD", "BUY", 1.0)
+    now[0] = 121
+    book.reconcile([])
+    assert book.count() == 0 and book.count_for("GOLD") == 0
+
+
+def test_rejected_open_is_uncounted():
+    book, _ = make_book()
+    book.reconcile([])
+    book.note_opened("REF1", "GOLD", "BUY", 1.0)
+    book.note_rejected("REF1")
+    assert book.count() == 0 and book.count_for("GOLD", "BUY") == 0
+
+
+def test_opens_without_reference_get_distinct_keys():
+    book, _ = make_book()
+    book.reconcile([])
+    book.note_opened(None, "GOLD", "BUY", 1.0)
+    book.note_opened(None, "GOLD", "BUY", 1.0)
+    book.reconcile([position("N1")])  # birinchi kutilayotgan ochilish moslandi
+    book.note_opened(None, "GOLD", "BUY", 1.0)
+    assert book.stats()["pending_opens"] == 2
+    assert book.count() == 3 and book.count_for("GOLD", "BUY") == 3
@@ -0,0 +1,68 @@
+# tests/test_resolution_resolver.py
+import asyncio
+
+import numpy as np
+
+from candle_store import COLUMNS, Candles
+from resolution_resolver import ResolutionResolver
+
+ORDER = ["HOUR", "HOUR_4", "DAY", "MINUTE"]
+
+
+def candles(n: int) -> Candles:
+    return Candles(np.arange(n, dtype=np.int64), np.ones((len(COLUMNS), n)))
+
+
+def make_loader(sizes):
+    calls = []
+
+    async def loader(resolution):
+        calls.append(resolution)
+        size = sizes[resolution]
+        if size is None:
+            raise RuntimeError("so'rov xatosi")
+        return candles(size)
+
+    return loader, calls
+
+
+def resolve(resolver, sizes):
+    loader, calls = make_loader(sizes)
+    res, result = asyncio.run(resolver.resolve(loader, "MNL:GOLD", ORDER, lambda c: len(c) >= 20))
+    return res, len(result), calls
+
+
+def test_remembered_first_choice_is_a_single_request():
+    resolver = ResolutionResolver()
+    sizes = {"HOUR": 50, "HOUR_4": 50, "DAY": 50, "MINUTE": 50}
+    assert resolve(resolver, sizes)[0] == "HOUR"
+    res, _, calls = resolve(resolver, sizes)
+    assert res == "HOUR" and calls == ["HOUR"]
+    assert resolver.stats()["remembered_hits"] == 1
+
+
+def test_failed_preference_is_not_requested_twice():
+    resolver = ResolutionResolver()
+    assert resolve(resolver, {"HOUR": 5, "HOUR_4": 50, "DAY": 50, "MINUTE": 50})[0] == "HOUR_4"
+
+    res, _, calls = resolve(resolver, {"HOUR": 5, "HOUR_4": None, "DAY": 50, "MINUTE": 50})
+    assert res == "DAY"
+    assert len(calls) == len(set(calls))  # har bir resolution bir marta so'raladi
+
+
+def test_higher_priority_resolution_takes_the_preference_back():
+    resolver = ResolutionResolver()
+    assert resolve(resolver, {"HOUR": 5, "HOUR_4": 5, "DAY": 50, "MINUTE": 50})[0] == "DAY"
+
+    res, _, calls = resolve(resolver, {"HOUR": 50, "HOUR_4": 5, "DAY": 50, "MINUTE": 50})
+    assert res == "HOUR"
+    assert "MINUTE" not in calls
+    assert resolver.preferred("MNL:GOLD") == "HOUR"
+
+
+def test_nothing_acceptable_returns_last_fetched_and_forgets():
+    resolver = ResolutionResolver()
+    resolve(resolver, {"HOUR": 50, "HOUR_4": 50, "DAY": 50, "MINUTE": 50})
+    res, size, _ = resolve(resolver, {"HOUR": 5, "HOUR_4": None, "DAY": 3, "MINUTE": 7})
+    assert res is None and size == 7
+    assert resolver.preferred("MNL:GOLD") is None
@@ -0,0 +1,69 @@
+# tests/test_risk_engine.py
+import asyncio
+
+import pytest
+
+import trading_logic
+from risk_engine import TickRiskEngine, position_pnl, stop_loss_reason
+
+SETTINGS = {"stop_loss_enabled": True, "stop_loss_percent": 2.0, "trailing_mode": "MNL",
+            "trailing_stop_percent": 1.0, "demo_account_status": True, "real_account_status": False}
+DISABLED = {**SETTINGS, "demo_account_status": False}
+
+
+def position(deal_id="D1", direction="BUY", level=100.0):
+    # Bitcoin — bozor doim ochiq, trailing vaqtga bog'liq emas
+    return {"deal_id": deal_id, "deal_reference": None, "epic": "BTCUSD", "instrument_name": "Bitcoin",
+            "direction": direction, "level": level, "size": 1.0, "upl": 0.0, "leverage": None,
+            "created_date_utc": None, "bid": None, "offer": None}
+
+
+def quotes(settings, ticks, ok=True, debounce=5.0):
+    """Dvigatelni position_rules bilan ishlatadi; (yopish qarorlari, dvigatel) qaytaradi."""
+    closed = []
+
+    async def closer(pos, kind, reason, current_price, price_diff):
+        closed.append((pos["deal_id"], kind))
+        return ok
+
+    async def run():
+        engine = TickRiskEngine(trading_logic.position_rules, closer, debounce=debounce)
+        engine.update([position()], settings)
+        for bid, ask in ticks:
+            engine.on_quote("BTCUSD", bid, ask)
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return engine
+
+    engine = asyncio.run(run())
+    return closed, engine
+
+
+def test_position_pnl_and_stop_loss_threshold():
+    assert position_pnl("BUY", 100.0, {"buy": 96.0, "sell": 97.0}) == (97.0, pytest.approx(-0.03))
+    assert position_pnl("SELL", 100.0, {"buy": 96.0, "sell": 97.0}) == (96.0, pytest.approx(0.04))
+    assert stop_loss_reason(SETTINGS, -0.025).startswith("Stop Loss")
+    assert stop_loss_reason(SETTINGS, -0.01) is None
+    assert stop_loss_reason({**SETTINGS, "stop_loss_enabled": False}, -0.5) is None
+
+
+def test_stop_loss_closes_on_tick():
+    closed, engine = quotes(SETTINGS, [(99.0, 99.1), (96.5, 97.0)])
+    assert closed == [("D1", "stop_loss")]
+    assert engine.stats()["closes"] == 1 and engine.stats()["positions"] == 0
+
+
+def test_stop_loss_still_runs_when_accounts_are_disabled():
+    closed, _ = quotes(DISABLED, [(96.5, 97.0)])
+    assert closed == [("D1", "stop_loss")]
+
+
+def test_trailing_is_paused_when_accounts_are_disabled():
+    assert quotes(SETTINGS, [(105.0, 105.1)])[0] == [("D1", "trailing")]
+    assert quotes(DISABLED, [(105.0, 105.1)])[0] == []
+
+
+def test_failed_close_is_debounced():
+    closed, engine = quotes(SETTINGS, [(96.5, 97.0), (96.4, 96.9), (96.3, 96.8)], ok=False)
+    assert closed == [("D1", "stop_loss")]
+    assert engine.stats()["failures"] == 1 and engine.stats()["debounced"] == 2
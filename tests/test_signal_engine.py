@@ -0,0 +1,160 @@
+# tests/test_signal_engine.py
+"""
+SignalEngine / universe_indicators: TA-Lib bilan paritet va daraja qoidalari.
+Baseline funksiyalari eski calculate_weak/mnl/strong_signals mantiqining nusxasi (indicators.py, TA-Lib).
+"""
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+import talib
+
+from indicators import calculate_bollinger_bands, calculate_ema, calculate_macd, calculate_rsi
+from signal_engine import LEVEL_RULES, SignalEngine
+from universe_indicators import UNIVERSE_DTYPE, compute_universe
+
+SETTINGS = {"rsi_buy_level": 35, "rsi_sell_level": 65}
+
+
+def random_series(rng: np.random.Generator, bars: int, scale: float = 1.0) -> np.ndarray:
+    # trend (drift) va keskin oxirgi harakat — barcha ovoz kombinatsiyalari uchrashi uchun
+    closes = np.cumsum(rng.normal(rng.choice([-0.6, 0.0, 0.6]), scale, bars)) + 1000.0
+    closes[-1] += rng.normal(0, 10)
+    return closes
+
+
+# --- indikatorlar: TA-Lib bilan paritet ---
+
+@pytest.mark.parametrize("bars", [14, 15, 20, 26, 33, 34, 50, 120, 200])
+def test_universe_indicators_match_talib(bars):
+    rng = np.random.default_rng(bars)
+    series = {f"E{i}": random_series(rng, bars, scale=1 + i % 5) for i in range(8)}
+    rows = compute_universe(series)
+    for row in rows:
+        closes = series[str(row["epic"])]
+        macd, macd_signal, macd_hist = talib.MACD(closes, fastperiod=12, slowperiod=26, signalperiod=9)
+        upper, middle, lower = talib.BBANDS(closes, timeperiod=20)
+        expected = {
+            "rsi": talib.RSI(closes, timeperiod=14)[-1],
+            "ema20": talib.EMA(closes, timeperiod=20)[-1] if bars >= 20 else np.nan,
+            "ema50": talib.EMA(closes, timeperiod=50)[-1] if bars >= 50 else np.nan,
+            "macd": macd[-1], "macd_signal": macd_signal[-1], "macd_hist": macd_hist[-1],
+            "bb_upper": upper[-1], "bb_middle": middle[-1], "bb_lower": lower[-1],
+        }
+        for name, value in expected.items():
+            np.testing.assert_allclose(row[name], value, rtol=1e-7, atol=1e-7, equal_nan=True, err_msg=name)
+
+
+# --- eski signal funksiyalari (baseline) ---
+
+def _decide(votes, threshold: float):
+    # eski funksiyalar: har bir indikator BUY yoki (aks holda) SELL ovozi beradi
+    buy = sum(1 for b, _ in votes if b)
+    sell = sum(1 for b, s in votes if not b and s)
+    required = math.ceil(len(votes) * threshold)
+    if buy >= required:
+        return "BUY"
+    if sell >= required:
+        return "SELL"
+    return None
+
+
+def baseline_weak(closes: np.ndarray):
+    rsi = talib.RSI(closes, timeperiod=14)[-1]
+    if rsi < SETTINGS["rsi_buy_level"]:
+        return "BUY"
+    if rsi > SETTINGS["rsi_sell_level"]:
+        return "SELL"
+    return None
+
+
+def baseline_strong(closes: np.ndarray):
+    series = pd.Series(closes)
+    rsi, ema20, ema50 = calculate_rsi(series, 14), calculate_ema(series, 20), calculate_ema(series, 50)
+    macd, bb = calculate_macd(series), calculate_bollinger_bands(series, 20)
+    values = [rsi, ema20, ema50, macd["macd"], macd["signal"], macd["hist"], bb["upper"], bb["lower"]]
+    if any(v is None or np.isnan(v) for v in values):
+        return None
+    last = series.iloc[-1]
+    return _decide([
+        (rsi < SETTINGS["rsi_buy_level"], rsi > SETTINGS["rsi_sell_level"]),
+        (ema20 > ema50, ema20 < ema50),
+        (macd["hist"] > 0, macd["hist"] < 0),
+        (last < bb["lower"], last > bb["upper"]),
+        (macd["macd"] > macd["signal"], macd["macd"] < macd["signal"]),
+    ], 0.8)
+
+
+def baseline_mnl(closes: np.ndarray):
+    series = pd.Series(closes)
+    last = series.iloc[-1]
+    rsi, ema20, ema50 = calculate_rsi(series, 14), calculate_ema(series, 20), calculate_ema(series, 50)
+    macd, bb = calculate_macd(series), calculate_bollinger_bands(series, 20)
+    votes = [
+        (ema20 > ema50, ema20 < ema50),
+        (rsi < SETTINGS["rsi_buy_level"], rsi > SETTINGS["rsi_sell_level"]),
+        (macd["macd"] > macd["signal"], macd["macd"] < macd["signal"]),
+        (last <= bb["lower"], last >= bb["upper"]),
+    ]
+    if len(series) >= 20:
+        short_trend, long_trend = last - series.iloc[-5], last - series.iloc[-20]
+        votes.append((short_trend > 0 and long_trend > 0, short_trend < 0 and long_trend < 0))
+    else:
+        votes.append((False, False))
+    return _decide(votes, 0.6)
+
+
+BASELINES = {"WEAK": baseline_weak, "MNL": baseline_mnl, "STRONG": baseline_strong}
+
+
+@pytest.mark.parametrize("level", sorted(LEVEL_RULES))
+def test_levels_match_old_signal_functions(level):
+    rule = LEVEL_RULES[level]
+    rng = np.random.default_rng(7)
+    signals = 0
+    for i in range(400):
+        bars = int(rng.integers(rule["min_bars"], rule["num_points"] + 1))
+        closes = random_series(rng, bars, scale=1 + i % 5)
+        expected = BASELINES[level](closes)
+        rows = compute_universe({"X": closes[-rule["window"]:]})
+        assert SignalEngine.score_rows(rows, level, SETTINGS)[0]["signal"] == expected, f"{level}, {bars} bar"
+        signals += expected is not None
+    assert signals  # tasodifiy seriyalar signallarni ham qamrab olsin
+
+
+# --- daraja qoidalari ---
+
+def feature_row(**values) -> np.ndarray:
+    row = np.zeros(1, dtype=UNIVERSE_DTYPE)
+    row["epic"], row["bars"] = "X", 200
+    defaults = {"last": 90.0, "rsi": 30.0, "ema20": 101.0, "ema50": 100.0, "macd": 1.0, "macd_signal": 0.5,
+                "macd_hist": 0.5, "bb_upper": 110.0, "bb_middle": 100.0, "bb_lower": 95.0,
+                "trend_short": 1.0, "trend_long": 2.0}
+    for name, value in {**defaults, **values}.items():
+        row[name] = value
+    return row
+
+
+def test_strong_requires_every_indicator():
+    assert SignalEngine.score_rows(feature_row(), "STRONG", SETTINGS)[0]["signal"] == "BUY"
+    # 4/5 ovoz yetarli, lekin MACD signal chizig'i yo'q — require_all signalni bekor qiladi
+    score = SignalEngine.score_rows(feature_row(macd_signal=np.nan), "STRONG", SETTINGS)[0]
+    assert score["buy"] == 4 and score["signal"] is None
+
+
+def test_mnl_follows_enabled_indicators():
+    row = feature_row(rsi=50.0, ema20=99.0, macd=0.0, macd_signal=0.5, last=100.0, trend_short=-1.0)
+    assert SignalEngine.score_rows(row, "MNL", SETTINGS)[0]["signal"] is None  # 2/5 SELL
+
+    only_ema_macd = {**SETTINGS, "enabled_indicators": {"ema": True, "macd": True, "rsi": False,
+                                                        "bollinger": False, "trend": False}}
+    score = SignalEngine.score_rows(row, "MNL", only_ema_macd)[0]
+    assert score["max_possible"] == 2 and set(score["votes"]) == {"ema", "macd"}
+    assert score["signal"] == "SELL"
+
+
+def test_mnl_with_every_indicator_disabled_gives_no_signal():
+    disabled = {**SETTINGS, "enabled_indicators": {key: False for key in ("ema", "rsi", "macd", "bollinger", "trend")}}
+    score = SignalEngine.score_rows(feature_row(), "MNL", disabled)[0]
+    assert score["max_possible"] == 0 and score["signal"] is None
@@ -4,29 +4,30 @@ import logging
 import datetime
 import random
 import numpy as np
-import pandas as pd
 import pytz
-import uuid
-import re
 import talib
-import math
-import aiohttp
 import hashlib
 import time
 import json
 import traceback
-import aiohttp
-from gemini_ai import get_ai_approval
-from typing import Dict, Any, List, Optional, Tuple
+from gemini_ai import get_ai_approval, get_ai_batch_approval, get_ai_trailing_decision
+from typing import Dict, Any, List, Optional, Set, Tuple
 from telegram.ext import ContextTypes, CallbackContext
-from config import get_asset_name_by_epic
-from capital_api import CapitalComAPI
+from capital_api import CapitalComAPI, OpenPosition
 from db import InMemoryDB
 from config import (
     ACTIVE_INSTRUMENTS, stop_event, CHAT_ID,
-GEMINI_API_KEY
+RESOLUTION_PREFS_FILE, FILLS_LOG_FILE
 )
-from indicators import calculate_ema, calculate_rsi, calculate_macd, calculate_bollinger_bands
+from incremental_indicators import shared_indicator_book
+from bar_scheduler import BarCloseScheduler
+from resolution_resolver import ResolutionResolver
+from signal_engine import SignalEngine, SignalScore, candle_closes
+from candle_store import Candles
+from risk_engine import TickRiskEngine, position_pnl, stop_loss_reason
+from execution import OrderExecutor, FillRecord, entry_quote
+from ai_cache import decision_fingerprint, shared_ai_cache
+from ai_client import shared_ai_client
 
 from config import TRADING_SETTINGS
 # Loggerni sozlash
@@ -45,6 +46,15 @@ last_prices = {}
 global_db_instance = None
 global_api_instance = None
 ai_trailing_positions = {}
+tick_risk_engine: Optional[TickRiskEngine] = None
+# Signal darajasi -> qaysi bar yopilganda qayta baholanadi (settings["signal_resolution"] ustun)
+SIGNAL_RESOLUTIONS = {"TEST": "MINUTE", "WEAK": "HOUR", "MNL": "HOUR", "STRONG": "HOUR"}
+# Signal funksiyalari uchun epic bo'yicha o'rganilgan resolution (restartdan keyin ham saqlanadi)
+resolution_resolver = ResolutionResolver(RESOLUTION_PREFS_FILE)
+# Barcha signal darajalari uchun yagona dvigatel (xususiyatlar har bir barda bir marta hisoblanadi)
+signal_engine = SignalEngine(resolution_resolver)
+# Buyurtmalarni yuborish va tasdiqlash (API instance almashsa qayta yaratiladi)
+order_executor: Optional[OrderExecutor] = None
 
 # trading_logic.py - bosh qismiga (importlardan keyin)
 
@@ -97,6 +107,12 @@ def get_rsi_status(rsi: float) -> str:
     else:
         return "neutral"
 
+def format_rsi(rsi) -> str:
+    """Prompt uchun RSI: qiymat va holat ("55.0 neutral"); RSI yo'q yoki NaN bo'lsa "N/A"."""
+    if not isinstance(rsi, (int, float)) or rsi != rsi:
+        return "N/A"
+    return f"{rsi:.1f} {get_rsi_status(rsi)}"
+
 def calculate_spread(prices: Dict) -> float:
     """Spread foizini hisoblash"""
     buy = prices.get('buy', 0)
@@ -106,9 +122,11 @@ def calculate_spread(prices: Dict) -> float:
 def get_bollinger_status(prices: Dict, indicators: Dict) -> str:
     """Bollinger Bands holati"""
     current_price = prices.get('buy', 0)
-    upper = indicators.get('bb_upper', 0)
-    lower = indicators.get('bb_lower', 0)
-    
+    upper = indicators.get('bb_upper')
+    lower = indicators.get('bb_lower')
+    if upper is None or lower is None:
+        return "UNKNOWN"
+
     if current_price > upper: return "ABOVE UPPER BAND ⬆️"
     if current_price < lower: return "BELOW LOWER BAND ⬇️"
     return "WITHIN BANDS ✅"
@@ -121,11 +139,17 @@ def get_volatility_status(asset: str, indicators: Dict) -> str:
 def get_signal_strength(asset: str, signal: str, indicators: Dict) -> str:
     """Signal kuchliligi"""
     # Signal hisoblash mantiqiga asoslangan
-    return "STRONG" if indicators.get('rsi', 50) < 35 or indicators.get('rsi', 50) > 65 else "MODERATE"
+    rsi = indicators.get('rsi')
+    if rsi is None:
+        return "MODERATE"
+    return "STRONG" if rsi < 35 or rsi > 65 else "MODERATE"
 
 def get_support_resistance_status(indicators: Dict) -> str:
     """Support/Resistance holati"""
-    return "KEY SUPPORT NEARBY" if indicators.get('rsi', 50) < 35 else "KEY RESISTANCE NEARBY" if indicators.get('rsi', 50) > 65 else "NEUTRAL ZONE"
+    rsi = indicators.get('rsi')
+    if rsi is None:
+        return "NEUTRAL ZONE"
+    return "KEY SUPPORT NEARBY" if rsi < 35 else "KEY RESISTANCE NEARBY" if rsi > 65 else "NEUTRAL ZONE"
 
 def set_global_instances(db, api):
     """Global DB va API instancelarini sozlash"""
@@ -251,10 +275,8 @@ async def start_trading_loops(context: CallbackContext):
 
                 if is_auto_trading_enabled:
                     asyncio.create_task(trading_logic_loop(context))
+                    asyncio.create_task(risk_monitor_loop(context))
                     asyncio.create_task(refresh_positions_loop(context))
-                    asyncio.create_task(close_profitable_positions_loop(context))
-                    asyncio.create_task(check_trailing_stop_loop(context))
-                    asyncio.create_task(check_stop_loss_loop(context))  
                     
 
                     logger.info("Savdo looplari muvaffaqiyatli ishga tushirildi.")
@@ -275,8 +297,11 @@ async def start_trading_loops(context: CallbackContext):
 
     except Exception as e:
         logger.error(f"Bot ishga tushirishda xato: {e}")
-async def get_prices_with_retry(api, epic: str, retries: int = 3) -> Optional[Dict]:
-    """Qayta urinishlar bilan narxlarni olish"""
+async def get_prices_with_retry(api, epic: str, retries: int = 3, snapshot: Optional[Dict] = None) -> Optional[Dict]:
+    """Qayta urinishlar bilan narxlarni olish.
+    snapshot berilsa (get_markets_snapshot natijasi), websocket narxi bo'lmaganda
+    kutish o'rniga undagi bid/offer ishlatiladi.
+    """
     for attempt in range(retries):
         try:
             prices = await api.get_prices(epic)
@@ -287,6 +312,13 @@ async def get_prices_with_retry(api, epic: str, retries: int = 3) -> Optional[Di
                     "sell": float(prices["sell"]),
                     "timestamp": datetime.datetime.now().isoformat()
                 }
+            market = (snapshot or {}).get(epic)
+            if market and market.get("bid") and market.get("offer"):
+                return {
+                    "buy": float(market["bid"]),
+                    "sell": float(market["offer"]),
+                    "timestamp": datetime.datetime.now().isoformat()
+                }
             await asyncio.sleep(1)  # Qisqa kutish
         except Exception as e:
             logger.warning(f"Narxlarni olishda xato ({attempt+1}/{retries}): {e}")
@@ -334,372 +366,81 @@ async def calculate_test_signals(api, epic: str, settings: Dict) -> Optional[str
     logger.info(f"[{epic}] TEST rejimi: Har doim BUY signal")
     return "BUY"
 
-async def calculate_weak_signals(api, epic: str, settings: Dict) -> Optional[str]:
-    """Zaif signal hisoblash (faqat RSI asosida, nisbat bilan)"""
-    try:
-        # Narxlarni olish
-        prices_data = None
-        resolutions_to_try = ["HOUR", "DAY"]
-
-        for resolution in resolutions_to_try:
-            prices_data = await api.get_historical_prices(epic, resolution, 50)
-            if prices_data and len(prices_data) >= 14:
-                logger.debug(f"[{epic}] WEAK: {resolution} resolutionda yetarli ma'lumot topildi: {len(prices_data)} ta")
-                break
-            else:
-                if prices_data:
-                    logger.debug(f"[{epic}] WEAK: {resolution} resolutionda {len(prices_data)} ta ma'lumot topildi, lekin 14 tadan kam")
-                else:
-                    logger.debug(f"[{epic}] WEAK: {resolution} resolutionda ma'lumot topilmadi")
-
-        if not prices_data or len(prices_data) < 14:
-            logger.debug(f"[{epic}] WEAK: Yetarli tarixiy ma'lumot topilmadi")
-            return None
-
-        # Ma'lumotlarni to‘g‘ri qayta ishlash
-        closes = []
-        for price in prices_data:
-            if isinstance(price, dict):
-                close_price = None
-                if "closePrice" in price and isinstance(price["closePrice"], dict):
-                    close_price = price["closePrice"].get("bid")
-                elif "openPrice" in price and isinstance(price["openPrice"], dict):
-                    close_price = price["openPrice"].get("bid")
-                elif "bid" in price and "ask" in price:
-                    close_price = (float(price["bid"]) + float(price["ask"])) / 2
-
-                if close_price is not None:
-                    closes.append(float(close_price))
-
-        if len(closes) < 14:
-            logger.debug(f"[{epic}] WEAK: Yetarli yopilish narxlari topilmadi ({len(closes)} ta)")
-            return None
-
-        # Pandas Series yaratish
-        closes_series = pd.Series(closes)
 
-        # RSI hisoblash
-        rsi_values = talib.RSI(closes_series, timeperiod=14)
-        if len(rsi_values) == 0:
-            logger.debug(f"[{epic}] WEAK: RSI qiymatlari topilmadi")
-            return None
-
-        rsi = rsi_values.iloc[-1]
-
-        # Nisbati log qilish (faqat RSI -> 1 indikator)
-        buy_signals = 0
-        sell_signals = 0
-        max_possible = 1
-
-        if rsi < settings.get("rsi_buy_level", 35):
-            buy_signals += 1
-        elif rsi > settings.get("rsi_sell_level", 65):
-            sell_signals += 1
-
-        signal_ratio = max(buy_signals, sell_signals) / max_possible
-        logger.info(f"[{epic}] WEAK: Signal nisbati: {signal_ratio:.2f} ({buy_signals}/{max_possible} BUY, {sell_signals}/{max_possible} SELL)")
-
-        # Qaror
-        if buy_signals == 1:
-            logger.info(f"[{epic}] WEAK: BUY signal qabul qilindi!")
-            return "BUY"
-        elif sell_signals == 1:
-            logger.info(f"[{epic}] WEAK: SELL signal qabul qilindi!")
-            return "SELL"
-
-        logger.debug(f"[{epic}] WEAK: Signal etarli emas")
-        return None
-
-    except Exception as e:
-        logger.error(f"Weak signal hisoblashda xato: {e}")
-
-    return None
-
-
-async def calculate_strong_signals(api, epic: str, settings: Dict) -> Optional[str]:
+async def fetch_candles_with_fallback(api, epic: str, resolutions: List[str], num_points: int,
+                                      min_bars: int, tag: str = "") -> Tuple[Optional[str], Candles]:
     """
-    Kuchli signal hisoblash (bir nechta resolutionda ma'lumot olish bilan)
+    Afzallik tartibidagi birinchi yaroqli (min_bars dan ko'p yopilish narxi bor) resolutionni qaytaradi.
+    Nomzodlar parallel so'raladi; epic uchun o'rganilgan resolution diskda eslab qolinadi.
     """
+    resolution, candles = await resolution_resolver.resolve(
+        lambda res: api.get_candles(epic, res, num_points),
+        f"{tag}:{epic}",
+        resolutions,
+        lambda candles: len(candle_closes(candles)) >= min_bars,
+    )
+    if resolution:
+        logger.debug(f"[{epic}] {tag}: {resolution} resolutionda yetarli ma'lumot topildi: {len(candles)} ta")
+    return resolution, candles
+
+
+async def _engine_signal(api, epic: str, settings: Dict, level: str) -> Optional[str]:
     try:
-        prices_data = None
-        resolutions_to_try = ["HOUR", "HOUR_4", "DAY"]
-
-        for resolution in resolutions_to_try:
-            # ✅ API'dan tarixiy ma'lumotni olamiz
-            prices_data = await api.get_historical_prices(epic, resolution, 200)
-            if prices_data and len(prices_data) >= 50:
-                logger.debug(f"[{epic}] STRONG: {resolution} resolutionda yetarli ma'lumot topildi: {len(prices_data)} ta")
-                break
-            else:
-                logger.debug(f"[{epic}] STRONG: {resolution} resolutionda ma'lumot yetarli emas")
-        
-        if not prices_data or len(prices_data) < 50:
-            logger.debug(f"[{epic}] STRONG: Hech qanday resolutionda yetarli tarixiy ma'lumot topilmadi")
-            return None
-
-        # ✅ Ma'lumotlarni Pandas DataFrame'ga aylantiramiz
-        df = pd.DataFrame(prices_data)
-        
-        # Narxlar ustunini yaratamiz
-        if 'bid' in df.columns:
-            closes = (df['bid'] + df['ask']) / 2
-        elif 'closePrice' in df.columns:
-            closes = df['closePrice'].apply(lambda x: x.get('bid'))
-        else:
-            return None
+        return (await signal_engine.evaluate(api, epic, settings, level))["signal"]
+    except Exception as e:
+        logger.error(f"{level} signal hisoblashda xato: {e}")
+        return None
 
-        closes_series = pd.Series(closes)
-        
-        # ✅ Indikatorlarni hisoblash uchun yordamchi funksiyadan foydalanamiz
-        rsi_val = calculate_rsi(closes_series, 14)
-        ema_20_val = calculate_ema(closes_series, 20)
-        ema_50_val = calculate_ema(closes_series, 50)
-        macd_vals = calculate_macd(closes_series)
-        bollinger_vals = calculate_bollinger_bands(closes_series, 20)
-        
-        # Agar qandaydir indikator hisoblanmasa, signal yo'q deb hisoblaymiz
-        if any(v is None for v in [rsi_val, ema_20_val, ema_50_val, macd_vals, bollinger_vals]):
-            logger.debug(f"[{epic}] STRONG: Indikator ma'lumotlari to'liq emas.")
-            return None
 
-        buy_signals = 0
-        sell_signals = 0
-        max_possible = 5 # RSI, EMA, MACD, Bollinger Bands
-
-        # ✅ 1. RSI
-        if rsi_val < settings.get("rsi_buy_level", 35):
-            buy_signals += 1
-        elif rsi_val > settings.get("rsi_sell_level", 65):
-            sell_signals += 1
-
-        # ✅ 2. EMA kesishmasi
-        if ema_20_val > ema_50_val:
-            buy_signals += 1
-        elif ema_20_val < ema_50_val:
-            sell_signals += 1
-            
-        # ✅ 3. MACD kesishmasi
-        if macd_vals['hist'] > 0:
-            buy_signals += 1
-        elif macd_vals['hist'] < 0:
-            sell_signals += 1
-
-        # ✅ 4. Bollinger Bands
-        current_price = closes_series.iloc[-1]
-        if current_price < bollinger_vals['lower']:
-            buy_signals += 1
-        elif current_price > bollinger_vals['upper']:
-            sell_signals += 1
-
-        # ✅ 5. MACD trendi
-        if macd_vals['macd'] > macd_vals['signal']:
-            buy_signals += 1
-        elif macd_vals['macd'] < macd_vals['signal']:
-            sell_signals += 1
-            
-        max_possible = 5
-        signal_ratio = max(buy_signals, sell_signals) / max_possible
+async def calculate_weak_signals(api, epic: str, settings: Dict) -> Optional[str]:
+    """Zaif signal hisoblash (faqat RSI asosida) — SignalEngine orqali"""
+    return await _engine_signal(api, epic, settings, "WEAK")
 
-        logger.info(f"[{epic}] STRONG: Signal nisbati: {signal_ratio:.2f} ({buy_signals}/{max_possible} BUY, {sell_signals}/{max_possible} SELL)")
 
-        # Qabul qilish qoidalari
-        if buy_signals >= math.ceil(max_possible * 0.8): # 5 tadan 4 tasi mos kelsa
-            return "BUY"
-        elif sell_signals >= math.ceil(max_possible * 0.8): # 5 tadan 4 tasi mos kelsa
-            return "SELL"
+async def calculate_strong_signals(api, epic: str, settings: Dict) -> Optional[str]:
+    """Kuchli signal hisoblash (5 tadan 4 ta indikator) — SignalEngine orqali"""
+    return await _engine_signal(api, epic, settings, "STRONG")
 
-        return None
 
-    except Exception as e:
-        logger.error(f"Strong signal hisoblashda xato: {e}")
-        return None
 async def calculate_mnl_signals(capital_api, epic: str, settings: Dict, enabled_indicators: Dict) -> Optional[str]:
     """
-    Faqat yoqilgan indikatorlardan foydalanib signal hisoblaydi (MNL rejimi)
+    Faqat yoqilgan indikatorlardan foydalanib signal hisoblaydi (MNL rejimi, 60%) — SignalEngine orqali
     """
-    # enabled_indicators bo'sh bo'lsa, default qiymatlar
-    if not enabled_indicators:
-        enabled_indicators = {
-            "ema": True, "rsi": True, "macd": True, 
-            "bollinger": True, "trend": True
-        }
-    
-    # Narxlarni olish - TO'G'RI resolution formatlari bilan urinib ko'ramiz
-    prices_data = None
-    resolutions_to_try = ["HOUR", "HOUR_4", "DAY", "MINUTE"]  # ✅ TO'G'RI FORMATLAR
-    
-    for resolution in resolutions_to_try:
-        prices_data = await capital_api.get_historical_prices(epic, resolution, 50)
-        if prices_data and len(prices_data) >= 20:
-            logger.debug(f"[{epic}] {resolution} resolutionda yetarli ma'lumot topildi: {len(prices_data)} ta")
-            break
-        else:
-            if prices_data:
-                logger.debug(f"[{epic}] {resolution} resolutionda {len(prices_data)} ta ma'lumot topildi, lekin 20 tadan kam")
-            else:
-                logger.debug(f"[{epic}] {resolution} resolutionda ma'lumot topilmadi")
-    
-    if not prices_data or len(prices_data) < 20:
-        logger.debug(f"[{epic}] MNL: Hech qanday resolutionda yetarli tarixiy ma'lumot topilmadi")
-        return None
-    
-    # Ma'lumotlarni to'g'ri qayta ishlash
-    closes = []
-    for price in prices_data:
-        if isinstance(price, dict):
-            close_price = None
-            if "closePrice" in price and isinstance(price["closePrice"], dict):
-                close_price = price["closePrice"].get("bid")  # yoki ask
-            elif "openPrice" in price and isinstance(price["openPrice"], dict):
-                close_price = price["openPrice"].get("bid")
-            elif "highPrice" in price and isinstance(price["highPrice"], dict):
-                close_price = price["highPrice"].get("bid")
-            elif "lowPrice" in price and isinstance(price["lowPrice"], dict):
-                close_price = price["lowPrice"].get("bid")
-            elif "bid" in price and "ask" in price:
-                close_price = (float(price["bid"]) + float(price["ask"])) / 2
-
-            if close_price is not None:
-                closes.append(float(close_price))
-
-    
-    if len(closes) < 20:
-        logger.debug(f"[{epic}] MNL: Yetarli yopilish narxlari topilmadi ({len(closes)} ta)")
-        return None
-    
-    # Pandas seriesga o'tkazamiz
-    prices_series = pd.Series(closes)
-    last_price = prices_series.iloc[-1] if not prices_series.empty else None
-    
-    if last_price is None:
-        logger.warning(f"[{epic}] MNL: Oxirgi narx topilmadi")
-        return None
-    
-    buy_signals = 0
-    sell_signals = 0
-    max_possible = 0
-    
-    # EMA tekshirish
-    if enabled_indicators.get("ema", True):
-        max_possible += 1
-        ema20 = calculate_ema(prices_series, 20)
-        ema50 = calculate_ema(prices_series, 50)
-        if ema20 is not None and ema50 is not None:
-            if ema20 > ema50:
-                buy_signals += 1
-            elif ema20 < ema50:
-                sell_signals += 1
-    
-    # RSI tekshirish
-    if enabled_indicators.get("rsi", True):
-        max_possible += 1
-        rsi = calculate_rsi(prices_series, 14)
-        if rsi is not None:
-            if rsi < settings.get("rsi_buy_level", 35):
-                buy_signals += 1
-            elif rsi > settings.get("rsi_sell_level", 65):
-                sell_signals += 1
-    
-    # MACD tekshirish
-    if enabled_indicators.get("macd", True):
-        max_possible += 1
-        macd_data = calculate_macd(prices_series)
-        if macd_data and macd_data.get("macd") is not None and macd_data.get("signal") is not None:
-            if macd_data["macd"] > macd_data["signal"]:
-                buy_signals += 1
-            elif macd_data["macd"] < macd_data["signal"]:
-                sell_signals += 1
-    
-    # Bollinger Bands tekshirish
-    if enabled_indicators.get("bollinger", True):
-        max_possible += 1
-        bb_data = calculate_bollinger_bands(prices_series, 20)
-        if bb_data and bb_data.get("upper") is not None and bb_data.get("lower") is not None:
-            if last_price <= bb_data["lower"]:
-                buy_signals += 1
-            elif last_price >= bb_data["upper"]:
-                sell_signals += 1
-    
-    # Trend analiz tekshirish
-    if enabled_indicators.get("trend", True):
-        max_possible += 1
-        if len(prices_series) >= 20:
-            short_trend = prices_series.iloc[-1] - prices_series.iloc[-5]
-            long_trend = prices_series.iloc[-1] - prices_series.iloc[-20]
-            if short_trend > 0 and long_trend > 0:
-                buy_signals += 1
-            elif short_trend < 0 and long_trend < 0:
-                sell_signals += 1
-    
-    # Signalni qaytarish
-    if max_possible == 0:
-        logger.debug(f"[{epic}] MNL: Hech qanday indikator yoqilmagan")
-        return None
-    
-    signal_ratio = max(buy_signals, sell_signals) / max_possible
-    logger.info(f"[{epic}] MNL: Signal nisbati: {signal_ratio:.2f} ({buy_signals}/{max_possible} BUY, {sell_signals}/{max_possible} SELL)")
-    
-    if buy_signals >= math.ceil(max_possible * 0.6):
-        logger.info(f"[{epic}] MNL: BUY signal qabul qilindi!")
-        return "BUY"
-    elif sell_signals >= math.ceil(max_possible * 0.6):
-        logger.info(f"[{epic}] MNL: SELL signal qabul qilindi!")
-        return "SELL"
-    
-    logger.debug(f"[{epic}] MNL: Signal etarli emas")
-    return None
+    return await _engine_signal(capital_api, epic, {**settings, "enabled_indicators": enabled_indicators}, "MNL")
 
 
-def calculate_indicators(historical_prices: List[Dict]) -> Optional[Dict[str, Any]]:
-    """Tarixiy narxlardan indikatorlarni hisoblash (Capital.com API uchun).
+def calculate_indicators(candles: Candles, key: Optional[Tuple[str, str]] = None) -> Optional[Dict[str, Any]]:
+    """Shamlardan (Candles) indikatorlarni hisoblash (Capital.com API uchun).
     Agar yetarli ma'lumot bo'lmasa -> None qaytaradi.
+    key=(epic, resolution) berilsa indikatorlar inkremental hisoblanadi: oldingi chaqiruvdan
+    keyin yopilgan barlargina qo'shiladi (shared_indicator_book).
     """
     logger.info(">>> ENTER calculate_indicators (info)")
-    logger.debug("calculate_indicators ga kelgan ma'lumotlar len=%s", len(historical_prices) if historical_prices else 0)
+    logger.debug("calculate_indicators ga kelgan ma'lumotlar len=%s", len(candles) if candles is not None else 0)
 
     try:
-        if not historical_prices or len(historical_prices) < 20:
+        if candles is None or len(candles) < 20:
             # 20 dan kam -> indikatorlar uchun yetarli emas (MNL/WEAK talablariga qarab bu qiymatni o'zgartiring)
-            logger.debug("calculate_indicators: historical_prices yetarli emas")
+            logger.debug("calculate_indicators: shamlar yetarli emas")
             return None
 
-        # Close qiymatlarini yig'ish (robust fallback)
-        closes = []
-        for price in historical_prices:
-            if not isinstance(price, dict):
-                continue
-
-            close_price = None
-            if "closePrice" in price and isinstance(price["closePrice"], dict):
-                # prefer bid (yoki strategiyaga qarab 'ask')
-                close_price = price["closePrice"].get("bid")
-            elif "openPrice" in price and isinstance(price["openPrice"], dict):
-                close_price = price["openPrice"].get("bid")
-            elif "highPrice" in price and isinstance(price["highPrice"], dict):
-                close_price = price["highPrice"].get("bid")
-            elif "lowPrice" in price and isinstance(price["lowPrice"], dict):
-                close_price = price["lowPrice"].get("bid")
-            elif "price" in price:
-                close_price = price.get("price")
-            elif "bid" in price and "ask" in price:
-                try:
-                    close_price = (float(price["bid"]) + float(price["ask"])) / 2.0
-                except Exception:
-                    close_price = None
-
-            if close_price is not None:
-                try:
-                    closes.append(float(close_price))
-                except Exception:
-                    # ignore unparsable values
-                    continue
+        # prefer bid (yoki strategiyaga qarab 'ask')
+        closes = candles.close_bid
+        has_close = ~np.isnan(closes)
 
-        if len(closes) < 14:
-            logger.debug("calculate_indicators: yetarli closes topilmadi (%s ta)", len(closes))
+        if int(has_close.sum()) < 14:
+            logger.debug("calculate_indicators: yetarli closes topilmadi (%s ta)", int(has_close.sum()))
             return None
 
-        # numpy arrayga o'tkazish
-        closes_array = np.array(closes, dtype=float)
+        closes_array = closes[has_close] if not has_close.all() else closes
+
+        if key is not None:
+            indicators = shared_indicator_book.compute(
+                key, candles.ts[has_close], closes_array, candles.volume[has_close]
+            )
+            indicators.pop("obv", None)
+            logger.debug("calculate_indicators (inkremental) natija: %s", indicators)
+            return indicators
 
         indicators: Dict[str, Any] = {}
 
@@ -754,13 +495,13 @@ def calculate_indicators(historical_prices: List[Dict]) -> Optional[Dict[str, An
         return None
 
 # ✅ YANGI: Dynamic AI Trailing Stop funksiyalari
-import re
 
 async def get_dynamic_ai_trailing_decision(asset_name: str, direction: str, open_price: float, 
                                          current_price: float, indicators: Dict, deal_id: str,
-                                         prices: Dict) -> Dict:  # ✅ prices qo'shildi
+                                         prices: Dict, deadline: float = 30) -> Dict:  # ✅ prices qo'shildi
     """
-    Dynamic AI trailing stop - spread va costlarni hisobga oladi
+    Dynamic AI trailing stop - spread va costlarni hisobga oladi.
+    AI javob bermasa (xato, deadline yoki circuit breaker) {"action": "UNAVAILABLE", "error": True}.
     """
     # Savdo xarajatlarini hisoblash
     trading_costs = calculate_trading_costs(prices, direction)
@@ -787,9 +528,9 @@ async def get_dynamic_ai_trailing_decision(asset_name: str, direction: str, open
 - MIN PROFIT REQUIRED: {trading_costs['min_profit_required']:.2f}%
 
 📈 **TECHNICAL ANALYSIS:**
-- RSI: {indicators.get('rsi', 'N/A'):.1f} {get_rsi_status(indicators.get('rsi'))}
+- RSI: {format_rsi(indicators.get('rsi'))}
 - TREND: {get_trend_status(indicators)}
-- MACD: {get_macd_status(indicators)}
+- MACD: {get_macd_status(indicators.get('macd'), indicators.get('macd_signal'))}
 - VOLATILITY: {get_volatility_status(asset_name, indicators)}
 - SUPPORT/RESISTANCE: {get_support_resistance_status(indicators)}
 
@@ -799,37 +540,34 @@ NET profit {net_profit:+.2f}% ni hisobga olgan holda analiz qiling:
 2. Agar YOPMASLIK kerak bo'lsa, optimal NET Take Profit foizi qancha?
 3. Spread va commission xarajatlarini hisobga olgan holda qaror qiling
 
-📝 **RESPONSE FORMAT:**
-CLOSE: [Sabab - NET profit va xarajatlar asosida]
-YOKI  
-HOLD: [Taklif qilingan NET TP: X%, Ishonch: Y%, Sabab]
+📝 **RESPONSE FORMAT (JSON):**
+- action: "CLOSE" (hozir yopish) yoki "HOLD" (davom ettirish)
+- net_take_profit_percent: HOLD uchun taklif qilingan NET TP foizi
+- confidence: ishonch foizi (0-100)
+- reason: sabab - NET profit va xarajatlar asosida
 """
 
-    ai_response = await get_ai_approval(asset_name, direction, prices, indicators)
+    ai_response = await get_ai_trailing_decision(prompt, deadline=deadline)
+    if ai_response.get("error"):
+        return ai_response
     return parse_dynamic_ai_response(ai_response, current_price, open_price, direction, trading_costs)
 
 
 def parse_dynamic_ai_response(ai_response: Dict, current_price: float, open_price: float, 
                             direction: str, trading_costs: Dict) -> Dict:
     """
-    AI javobini parsing qilish - NET profit asosida
+    TRAILING_SCHEMA bo'yicha tekshirilgan AI qarorini take profit narxiga aylantirish - NET profit asosida
     """
-    text = ai_response.get('reason', '').upper()
-    
-    if "CLOSE" in text:
-        return {"action": "CLOSE", "reason": ai_response.get('reason', 'AI NET profit asosida yopishni tavsiya qiladi')}
-    elif "HOLD" in text:
-        # NET Take Profit ni extract qilish
-        tp_match = re.search(r'NET TP:\s*([\d.]+)%', text) or re.search(r'TP:\s*([\d.]+)%', text)
-        confidence_match = re.search(r'Confidence:\s*([\d.]+)%', text) or re.search(r'Ishonch:\s*([\d.]+)%', text)
-        
+    if ai_response["action"] == "CLOSE":
+        return {"action": "CLOSE", "reason": ai_response.get('reason') or 'AI NET profit asosida yopishni tavsiya qiladi'}
+    else:  # HOLD
         # NET TP ni olish yoki default
-        net_tp_percent = float(tp_match.group(1)) if tp_match else 2.0  # default 2% NET
+        net_tp_percent = float(ai_response.get("net_take_profit_percent", 2.0))  # default 2% NET
         
         # GROSS TP ni hisoblash (NET TP + costs)
         gross_tp_percent = net_tp_percent + trading_costs["total_entry_cost"]
         
-        confidence = float(confidence_match.group(1)) if confidence_match else 70.0
+        confidence = float(ai_response.get("confidence", 70.0))
         
         # Take profit narxini hisoblash (GROSS asosida)
         if direction == "BUY":
@@ -843,11 +581,8 @@ def parse_dynamic_ai_response(ai_response: Dict, current_price: float, open_pric
             "net_take_profit_percent": net_tp_percent,  # NET TP
             "take_profit_price": take_profit_price,
             "confidence": confidence,
-            "reason": ai_response.get('reason', 'AI NET profit asosida davom ettirishni tavsiya qiladi')
+            "reason": ai_response.get('reason') or 'AI NET profit asosida davom ettirishni tavsiya qiladi'
         }
-    else:
-        # Default - hozir yopmaslik
-        return {"action": "HOLD", "take_profit_percent": 3.0, "net_take_profit_percent": 2.5, "confidence": 60.0, "reason": "AI noaniq javob berdi"}
 
 
 def calculate_trading_costs(prices: Dict, direction: str) -> Dict:
@@ -876,23 +611,43 @@ def calculate_trading_costs(prices: Dict, direction: str) -> Dict:
 
 
 
-async def get_ai_trade_signal_enhanced(asset: str, signal: str, prices: Dict, indicators: Dict) -> Dict:
+async def get_ai_trade_signal_enhanced(asset: str, signal: str, prices: Dict, indicators: Dict,
+                                       deadline: float = 30) -> Dict:
     """
     Mukammal AI so'rovi - barcha kerakli ma'lumotlar bilan
     """
     prompt = f"""
 🎯 **PROFESSIONAL TRADING SIGNAL EVALUATION**
 
-📊 **TRADE OPPORTUNITY:**
+{build_signal_context(asset, signal, prices, indicators)}
+❓ **EVALUATION REQUEST:**
+Should I execute this {signal} trade for {asset} based on the current market conditions and technical setup?
+
+📝 **RESPONSE FORMAT (JSON):**
+- decision: "APPROVE" or "REJECT"
+- reason: brief reasoning - max 2 lines
+
+Focus on risk/reward ratio, technical confirmation, and market context.
+"""
+    
+    return await get_ai_approval(asset, signal, prices, indicators, deadline=deadline, prompt=prompt)
+
+
+def build_signal_context(asset: str, signal: str, prices: Dict, indicators: Dict) -> str:
+    """
+    Signal konteksti (narx, spread, indikatorlar holati, bozor soatlari, volatillik) — alohida va
+    batch AI so'rovlarida bir xil, shuning uchun ikkalasi bitta kesh kalitini ishlatadi.
+    """
+    return f"""📊 **TRADE OPPORTUNITY:**
 - ASSET: {asset}
 - PROPOSED ACTION: {signal}
 - CURRENT PRICE: {prices.get('buy' if signal == 'BUY' else 'sell', 'N/A')}
 - SPREAD: {calculate_spread(prices):.3f}%
 
 📈 **TECHNICAL ANALYSIS:**
-- RSI: {indicators.get('rsi', 'N/A'):.1f} {get_rsi_status(indicators.get('rsi'))}
+- RSI: {format_rsi(indicators.get('rsi'))}
 - TREND: {get_trend_status(indicators)}
-- MACD: {get_macd_status(indicators)}
+- MACD: {get_macd_status(indicators.get('macd'), indicators.get('macd_signal'))}
 - BOLLINGER BANDS: {get_bollinger_status(prices, indicators)}
 - SUPPORT/RESISTANCE: {get_support_resistance_status(indicators)}
 
@@ -903,21 +658,9 @@ async def get_ai_trade_signal_enhanced(asset: str, signal: str, prices: Dict, in
 
 📋 **TRADING PARAMETERS:**
 - POSITION SIZE: Medium
-- RISK LEVEL: {'LOW' if signal == 'BUY' and indicators.get('rsi', 50) < 40 else 'MEDIUM'}
+- RISK LEVEL: {'LOW' if signal == 'BUY' and (indicators.get('rsi') or 50) < 40 else 'MEDIUM'}
 - TIME FRAME: Swing Trade (1-3 days)
-
-❓ **EVALUATION REQUEST:**
-Should I execute this {signal} trade for {asset} based on the current market conditions and technical setup?
-
-📝 **RESPONSE FORMAT:**
-APPROVE: [Brief reasoning - max 2 lines]
-OR  
-REJECT: [Brief reasoning - max 2 lines]
-
-Focus on risk/reward ratio, technical confirmation, and market context.
 """
-    
-    return await get_ai_approval(asset, signal, prices, indicators)
 
 
 async def send_hourly_report(context: ContextTypes.DEFAULT_TYPE):
@@ -943,9 +686,9 @@ async def send_hourly_report(context: ContextTypes.DEFAULT_TYPE):
             except Exception as e:
                 logger.warning(f"Eski xabarni o'chirishda xato: {e}")
 
-        # Ochiq pozitsiyalarni olish
-        open_positions = await api.get_open_positions()
-        positions_count = len(open_positions) if open_positions else 0
+        # Ochiq pozitsiyalar (daftardan, P/L kotirovkalar bo'yicha jonli)
+        open_positions = await api.get_book_positions()
+        positions_count = len(open_positions)
 
         message = "🕐 **Soatlik Hisobot**\n\n"
         has_open_positions = False
@@ -954,26 +697,16 @@ async def send_hourly_report(context: ContextTypes.DEFAULT_TYPE):
         if open_positions:
             message += "🔓 **Ochiq Savdolar:**\n\n"
             
-            for i, pos in enumerate(open_positions, 1):
-                deal_id = pos.get("dealId") or pos.get("positionId")
-                if not deal_id:
-                    continue
+            for pos in open_positions:
+                asset_name = pos["instrument_name"]
+                epic = pos["epic"] or ""
+                direction = pos["direction"]
+                open_price = pos["level"]
+                leverage = pos["leverage"] or 1
+                profit_loss = pos["upl"]  # UPL - Unrealized P/L
 
-                # Pozitsiya tafsilotlarini olish
-                detail = await api.get_position_details(deal_id)
-                position = detail.get("position", {})
-                market = detail.get("market", {})
-
-                asset_name = market.get("instrumentName", "Noma'lum")
-                epic = market.get("epic", "")
-                direction = position.get("direction", "").upper()
-                open_price = position.get("level", 0)
-                size = position.get("size", 0)
-                leverage = position.get("leverage", 1)
-                profit_loss = position.get("upl", 0)  # UPL - Unrealized P/L
-                
                 # Vaqtni formatlash
-                created_date = position.get("createdDateUTC", "")
+                created_date = pos["created_date_utc"] or ""
                 open_time = "Noma'lum"
                 if created_date:
                     try:
@@ -1089,9 +822,6 @@ async def get_ai_trailing_approval(asset_name: str, direction: str, open_price:
     """
     Trailing stop uchun AI tasdiqini olish
     """
-    if not GEMINI_API_KEY:
-        return {"decision": "REJECT", "reason": "API Key not found"}
-    
     prompt = f"""
     Siz professional trader sifatida trailing stop qarori qabul qilishingiz kerak.
     
@@ -1101,113 +831,50 @@ async def get_ai_trailing_approval(asset_name: str, direction: str, open_price:
     Joriy narx: {current_price}
     Foyda/zarar: {profit_percent:.2f}%
     
-    Ushbu savdoni trailing stop orqali yopish kerakmi? Faqat "APPROVE" yoki "REJECT" qaytaring.
+    Ushbu savdoni trailing stop orqali yopish kerakmi? Yopish uchun "APPROVE", aks holda "REJECT".
     Sababini qisqacha izohlang.
     """
     
-    try:
-        # Gemini AI ga so'rov yuborish
-        api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
-        payload = {
-            "contents": [{"parts": [{"text": prompt}]}],
-            "generationConfig": {
-                "temperature": 0.1,
-                "maxOutputTokens": 100,
-            }
-        }
-        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(api_url, json=payload) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    text = result['candidates'][0]['content']['parts'][0]['text']
-                    
-                    # Javobni tahlil qilish
-                    if "APPROVE" in text.upper():
-                        return {"decision": "APPROVE", "reason": text}
-                    else:
-                        return {"decision": "REJECT", "reason": text}
-                else:
-                    return {"decision": "REJECT", "reason": "API xatosi"}
-                    
-    except Exception as e:
-        logger.error(f"AI trailing so'rovida xato: {e}")
-        return {"decision": "REJECT", "reason": f"Xato: {str(e)}"}        
-        async with aiohttp.ClientSession() as session:
-            async with session.post(api_url, json=payload) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    text = result['candidates'][0]['content']['parts'][0]['text']
-                    
-                    # Javobni tahlil qilish
-                    if "APPROVE" in text.upper():
-                        return {"decision": "APPROVE", "reason": text}
-                    else:
-                        return {"decision": "REJECT", "reason": text}
-                else:
-                    return {"decision": "REJECT", "reason": "API xatosi"}
-                    
-    except Exception as e:
-        logger.error(f"AI trailing so'rovida xato: {e}")
-        return {"decision": "REJECT", "reason": f"Xato: {str(e)}"}
+    # JSON rejimida (ENTRY_SCHEMA: decision + reason), umumiy Gemini klienti orqali
+    return await get_ai_approval(asset_name, direction, {}, {}, deadline=20, prompt=prompt)
 
-async def refresh_positions(context: ContextTypes.DEFAULT_TYPE):
-    """API'dan ochiq pozitsiyalarni olib, db.json ga yozadi."""
+async def refresh_positions(context: ContextTypes.DEFAULT_TYPE) -> List[OpenPosition]:
+    """API'dan ochiq pozitsiyalarni olib, db.json ga yozadi. Olingan snapshotni qaytaradi."""
     try:
         # ✅ Global instancelardan foydalanish
         db, api = get_global_instances()
         
         if not api or not db:
             logger.warning("refresh_positions: Global API yoki DB topilmadi.")
-            return
+            return []
 
-        open_positions = await api.get_open_positions()
+        open_positions = await api.get_position_snapshot()
         settings = await db.get_settings()
-        
-        if not open_positions:
-            settings['positions'] = {}
-            await db.save_settings(settings)
-            return
-
-        if isinstance(open_positions, dict):
-            pos_list = open_positions.get('positions') or open_positions.get('data') or open_positions.get('results') or []
-        elif isinstance(open_positions, (list, tuple)):
-            pos_list = list(open_positions)
-        else:
-            pos_list = []
 
         new_positions = {}
-
-        for pos in pos_list:
-            epic = pos.get('epic')
-            asset_name = get_asset_name_by_epic(epic)
-            
-            # deal id topish
-            deal_id = pos.get('dealId') or pos.get('positionId') or str(uuid.uuid4())
-            asset_name = pos.get('instrumentName') or pos.get('epic') or "Noma'lum"
-            direction = pos.get('direction') or pos.get('dealType') or "Noma'lum"
-            open_price = pos.get('level') or pos.get('openPrice') or 0
-            size = pos.get('size') or pos.get('dealSize') or 0
-            
+        for pos in open_positions:
+            deal_id = pos["deal_id"]
             new_positions[deal_id] = {
-                "asset_name": asset_name,
-                "direction": direction,
-                "deal_type": direction,
-                "opened_at_utc": datetime.datetime.utcnow().isoformat() + "Z",
-                "open_price": open_price,
+                "asset_name": pos["instrument_name"],
+                "direction": pos["direction"],
+                "deal_type": pos["direction"],
+                "opened_at_utc": pos["created_date_utc"] or datetime.datetime.utcnow().isoformat() + "Z",
+                "open_price": pos["level"],
                 "deal_id": deal_id,
-                "size": size,
+                "size": pos["size"],
                 "raw": pos,
-                "epic": epic,
+                "epic": pos["epic"],
             }
         
         settings['positions'] = new_positions
         await db.save_settings(settings)
         logger.info(f"Ochiq pozitsiyalar yangilandi. Jami: {len(new_positions)}")
+        return open_positions
 
     except Exception as e:
         logger.error("Pozitsiyalarni yangilashda xato: %s", e)
         traceback.print_exc()
+        return []
 
 
 # trading_logic.py da get_trailing_stop_percent funksiyasini yangilaymiz
@@ -1268,467 +935,702 @@ def get_trailing_stop_percent(settings, local_position, current_prices, indicato
         return 0.01
 
 
-async def trading_logic_loop(context: ContextTypes.DEFAULT_TYPE):
-    """Sozlamalarga mos auto savdo funksiyasi"""
-    logger.info("🔄 Auto savdo aylanmasi ishlayapti...")
-    db: InMemoryDB = context.user_data['db']
-    api: CapitalComAPI = context.user_data['capital_api']
+async def evaluate_asset(api, context, asset: str, details: Dict, settings: Dict, signal_level: str,
+                         market_snapshot: Dict, signal_scores: Dict[str, SignalScore],
+                         defer_ai: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Bitta aktivni baholaydi: filtrlar, narx, signal va (yoqilgan bo'lsa) AI tasdig'i.
+    Savdo ochish kerak bo'lsa nomzod {asset, details, signal, score, prices, signal_ts} qaytaradi, aks holda None.
+    defer_ai=True bo'lsa AI chaqirilmaydi: nomzod "ai_pending" belgisi bilan qaytadi va
+    approve_candidates_batch da boshqa aktivlar bilan birga bitta so'rovda tasdiqlanadi.
+    """
+    logger.info(f"📊 {asset} tekshirilmoqda...")
+
+    asset_settings = settings.get("buy_sell_status_per_asset", {}).get(asset, {})
+    if not asset_settings.get("active", True):
+        return None
+    if not is_market_open(asset):
+        return None
+    market = market_snapshot.get(details["id"])
+    if market and market["status"] != "TRADEABLE":
+        logger.debug(f"[{asset}] bozor holati: {market['status']}. O'tkazib yuborildi.")
+        return None
+
+    # ✅ AI uchun kerak bo'lsa, indicators ni oldindan tayyorlaymiz
+    ai_enabled = settings.get("trade_signal_ai_enabled", False)
+
+    # Agar AI yoqilmagan bo'lsa, indicators ni hisoblamaymiz
+    if ai_enabled and signal_level != "TEST":
+        # Faqat AI yoqilgan bo'lsa indicators ni hisoblaymiz
+        res, candles = await fetch_candles_with_fallback(
+            api, details['id'], ["HOUR", "DAY", "MINUTE"], 50, 20, "AI"
+        )
+        indicators = calculate_indicators(candles, key=(details['id'], res) if res else None)
+    else:
+        res = None
+        indicators = {}  # Bo'sh dict
+
+    # Narxlarni olish
+    prices = await get_prices_with_retry(api, details["id"], 3, snapshot=market_snapshot)
+    if not prices:
+        logger.warning(f"❌ [{asset}] narxlari topilmadi. O'tkazib yuborildi.")
+        return None
+
+    # Signal (SignalEngine oldindan barcha aktivlar uchun hisoblagan)
+    score = signal_scores.get(details['id'])
+    if score is None:
+        score = await signal_engine.evaluate(api, details['id'], settings, signal_level)
+    trade_signal = score["signal"]
+
+    if not trade_signal:
+        return None
+
+    logger.info(f"🎯 {asset} uchun {trade_signal} SIGNAL TOPILDI!")
+    signal_ts = time.time()
+
+    candidate = {"asset": asset, "details": details, "signal": trade_signal, "score": score, "prices": prices,
+                 "signal_ts": signal_ts}
 
-    while not stop_event.is_set():
+    # ✅ AI tasdiqlash — bozor holati (RSI bucketi, MACD ishorasi, Bollinger o'rni) bo'yicha keshlanadi,
+    # yozuv signal resolutionidagi bar yopilguncha amal qiladi
+    if ai_enabled and signal_level != "TEST":
+        candidate["indicators"] = indicators or {}
+        candidate["resolution"] = res or score.get("resolution")
+        if defer_ai:
+            candidate["ai_pending"] = True
+            return candidate
         try:
-            settings = await db.get_settings()
+            ai_approval = await shared_ai_cache.get_or_fetch(
+                _ai_cache_key(candidate),
+                lambda: get_ai_trade_signal_enhanced(asset, trade_signal, prices, indicators or {},
+                                                     deadline=ai_latency_budget(settings)),
+                resolution=candidate["resolution"],
+                force=not settings.get("ai_cache_enabled", True),
+            )
+            if ai_approval.get("cached"):
+                logger.info(f"[{asset}] AI qarori keshdan: {ai_approval.get('decision')} | {shared_ai_cache.stats()}")
+            if not await report_ai_decision(context, candidate, ai_approval, settings):
+                return None
 
-            if not settings.get("auto_trading_enabled", True):
-                logger.info("⏸️ Auto savdo o'chirilgan")
-                await asyncio.sleep(10)
-                continue
+        except Exception as e:
+            logger.error(f"AI tasdiqlashda xato: {e}")
+            # AI da xato bo'lsa, savdoni o'tkazib yuboramiz
+            return None
 
-            # Ochiq pozitsiyalarni olish
-            try:
-                open_positions = await api.get_open_positions()
-                active_trade_count = len(open_positions) if open_positions else 0
-                if active_trade_count > 0:
-                    logger.info(f"📊 Ochiq pozitsiyalar soni: {active_trade_count}")
-            except Exception as e:
-                logger.error(f"Ochiq pozitsiyalarni olishda xato: {e}")
-                active_trade_count = 0
+    return candidate
 
-            max_trades_count = settings.get("max_trades_count", 3)
-            if active_trade_count >= max_trades_count:
-                logger.info("⛔ Maksimal savdolar soniga yetildi.")
-                await asyncio.sleep(10)
-                continue
 
-            # trading_logic.py - trading_logic_loop ichida
+def _ai_cache_key(candidate: Dict[str, Any]):
+    return decision_fingerprint(candidate["asset"], candidate["signal"], candidate.get("indicators") or {},
+                                candidate["prices"])
 
-            for asset, details in ACTIVE_INSTRUMENTS.items():
-                logger.info(f"📊 {asset} tekshirilmoqda...")
 
-                asset_settings = settings.get("buy_sell_status_per_asset", {}).get(asset, {})
-                if not asset_settings.get("active", True):
-                    continue
-                if not is_market_open(asset):
-                    continue
+def ai_latency_budget(settings: Dict) -> float:
+    """Bitta AI chaqiruvi uchun qat'iy vaqt chegarasi (s)."""
+    return float(settings.get("ai_latency_budget", 8))
 
-                # ✅ AI uchun kerak bo'lsa, indicators ni oldindan tayyorlaymiz
-                ai_enabled = settings.get("trade_signal_ai_enabled", False)
-                indicators = None
-                
-                # Agar AI yoqilmagan bo'lsa, indicators ni hisoblamaymiz
-                if ai_enabled and signal_level != "TEST":
-                    # Faqat AI yoqilgan bo'lsa indicators ni hisoblaymiz
-                    historical_prices = []
-                    for res in ["HOUR", "DAY", "MINUTE"]:
-                        historical_prices = await api.get_historical_prices(details['id'], res, 50)
-                        if historical_prices and len(historical_prices) >= 20:
-                            break
-                    indicators = calculate_indicators(historical_prices or [])
-                else:
-                    indicators = {}  # Bo'sh dict
 
-                # Narxlarni olish
-                prices = await get_prices_with_retry(api, details["id"], 3)
-                if not prices:
-                    logger.warning(f"❌ [{asset}] narxlari topilmadi. O'tkazib yuborildi.")
-                    continue
+def ai_fallback_policy(settings: Dict) -> str:
+    """AI ishlamaganda (xato, deadline, circuit breaker): "skip", "rules" yoki "reject"."""
+    policy = settings.get("ai_fallback_policy", "reject")
+    return policy if policy in ("skip", "rules", "reject") else "reject"
 
-                # Signal hisoblash
-                trade_signal = None
-                signal_level = settings.get("trade_signal_level", "MNL")
-                
-                if signal_level == "MNL":
-                    enabled_indicators = settings.get("enabled_indicators", {})
-                    trade_signal = await calculate_mnl_signals(api, details['id'], settings, enabled_indicators)
-                elif signal_level == "WEAK":
-                    trade_signal = await calculate_weak_signals(api, details['id'], settings)
-                elif signal_level == "STRONG":
-                    trade_signal = await calculate_strong_signals(api, details['id'], settings)
-                elif signal_level == "TEST":
-                    trade_signal = "BUY"
-
-                if trade_signal:
-                    logger.info(f"🎯 {asset} uchun {trade_signal} SIGNAL TOPILDI!")
-                    
-                    # ✅ AI tasdiqlash - CACHEsiz
-                    if ai_enabled and signal_level != "TEST":
-                        try:
-                            # Har doim yangi AI so'rovi
-                            ai_approval = await get_ai_trade_signal_enhanced(
-                                asset, trade_signal, prices, indicators or {}
-                            )
-
-                            if ai_approval.get("decision") != "APPROVE":
-                                reason = ai_approval.get('reason', 'Noma\'lum sabab')
-                                await send_trading_status(
-                                    context, 
-                                    f"❌ [AI] {asset} {trade_signal} rad etildi\n📝 {reason}", 
-                                    "warning"
-                                )
-                                continue
-                            else:
-                                logger.info(f"[{asset}] AI tasdiqladi: {trade_signal}")
-                                await send_trading_status(
-                                    context, 
-                                    f"✅ [AI] {asset} tasdiqlandi: {trade_signal.upper()}", 
-                                    "success"
-                                )
-                                
-                        except Exception as e:
-                            logger.error(f"AI tasdiqlashda xato: {e}")
-                            # AI da xato bo'lsa, savdoni o'tkazib yuboramiz
-                            continue
-                    
-       
-                    # ✅ Savdoni TEST rejimiga o'xshatib amalga oshirish
-                    try:
-                        usd_amount = settings.get("trade_amount_per_asset", {}).get(asset, 50)
-                        price = prices["buy"] if trade_signal == "BUY" else prices["sell"]
-                        calculated_size = usd_amount / price                        
-                        # API orqali savdoni amalga oshirish
-                        order_response = await api.open_position(details['id'], trade_signal, calculated_size)
-
-                        if order_response and not order_response.get("errorCode"):
-                            # Agar javob bo'lsa va xato kodi bo'lmasa, savdo ochilgan deb hisoblash
-                            logger.info(f"✅ {asset} uchun {trade_signal} savdosi ochildi. Miqdor: {calculated_size:.4f}")
-                            await send_trading_status(
-                                context,
-                                f"✅ Savdo ochildi: {asset} ({trade_signal})\nNarx: {price:.2f} | Miqdor: {calculated_size:.4f}",
-                                "success"
-                            )
-                            # Ushbu qatorda order_response tarkibini tekshirish foydali bo'lishi mumkin
-                            if order_response.get("dealReference"):
-                                await db.add_position(asset, order_response)
-                            else:
-                                logger.warning(f"Savdo ochildi, ammo dealReference topilmadi: {order_response}")
-                                # Shuningdek, ma'lumotnomani keyinroq olish uchun logga yozishingiz mumkin
-
-                        else:
-                            # Agar javobda xato kodi bo'lsa yoki javob bo'sh bo'lsa
-                            error_msg = order_response.get("error", "Noma'lum xato") if order_response else "Javob yo'q"
-                            logger.error(f"Savdo ochishda xato: {error_msg}")
-                            await send_trading_status(context, f"❌ Savdo ochilmadi: {asset} - {error_msg}", "error")
 
-                    except Exception as e:
-                        logger.error(f"Savdo ochishda istisno: {e}")
-                        await send_trading_status(context, f"❌ Savdo ochishda xato: {asset} - {str(e)}", "error")
+async def report_ai_decision(context, candidate: Dict[str, Any], ai_approval: Dict[str, Any],
+                             settings: Dict) -> bool:
+    """
+    AI qarorini Telegramga yuboradi; savdo tasdiqlangan bo'lsa True.
+    AI javob bermagan bo'lsa (error=True) ai_fallback_policy qo'llanadi.
+    """
+    asset, trade_signal = candidate["asset"], candidate["signal"]
+    if ai_approval.get("error"):
+        policy = ai_fallback_policy(settings)
+        reason = ai_approval.get("reason", "")
+        if policy == "skip":
+            logger.info(f"[{asset}] AI mavjud emas ({reason}), {trade_signal} signali o'tkazib yuborildi")
+            return False
+        if policy == "rules":
+            logger.info(f"[{asset}] AI mavjud emas ({reason}), {trade_signal} faqat qoidalar bo'yicha ochiladi")
+            await send_trading_status(
+                context,
+                f"⚠️ [AI mavjud emas] {asset} {trade_signal.upper()} faqat qoidalar bo'yicha\n📝 {reason}",
+                "warning"
+            )
+            return True
+    if ai_approval.get("decision") != "APPROVE":
+        reason = ai_approval.get('reason', 'Noma\'lum sabab')
+        await send_trading_status(
+            context,
+            f"❌ [AI] {asset} {trade_signal} rad etildi\n📝 {reason}",
+            "warning"
+        )
+        return False
+
+    logger.info(f"[{asset}] AI tasdiqladi: {trade_signal}")
+    await send_trading_status(
+        context,
+        f"✅ [AI] {asset} tasdiqlandi: {trade_signal.upper()}",
+        "success"
+    )
+    return True
 
-            await asyncio.sleep(10)
 
+async def approve_candidates_batch(context, candidates: List[Dict[str, Any]], settings: Dict) -> List[Dict[str, Any]]:
+    """
+    "ai_pending" nomzodlarni AI bilan tasdiqlaydi: avval keshdan, qolganlari ai_batch_size
+    tadan bitta Gemini so'rovida (JSON massiv). Javobdan ajratib bo'lmagan elementlar uchungina
+    alohida get_ai_trade_signal_enhanced chaqiriladi. Tartib saqlanadi, rad etilganlar chiqariladi.
+    """
+    pending = [candidate for candidate in candidates if candidate.get("ai_pending")]
+    if not pending:
+        return candidates
+
+    force = not settings.get("ai_cache_enabled", True)
+    decisions: Dict[int, Dict[str, Any]] = {}
+    to_ask: List[int] = []
+    for idx, candidate in enumerate(pending):
+        cached = None if force else shared_ai_cache.peek(_ai_cache_key(candidate))
+        if cached:
+            logger.info(f"[{candidate['asset']}] AI qarori keshdan: {cached.get('decision')}")
+            decisions[idx] = cached
+        else:
+            to_ask.append(idx)
+
+    batch_size = max(1, int(settings.get("ai_batch_size", 8)))
+    budget = ai_latency_budget(settings)
+    chunks = [to_ask[i:i + batch_size] for i in range(0, len(to_ask), batch_size)]
+
+    async def ask(chunk: List[int]) -> List[Optional[Dict[str, Any]]]:
+        try:
+            return await get_ai_batch_approval([
+                {"asset": pending[idx]["asset"], "direction": pending[idx]["signal"],
+                 "prices": pending[idx]["prices"], "indicators": pending[idx]["indicators"],
+                 "context": build_signal_context(pending[idx]["asset"], pending[idx]["signal"],
+                                                 pending[idx]["prices"], pending[idx]["indicators"])}
+                for idx in chunk
+            ], deadline=budget)
         except Exception as e:
-            error_msg = f"Savdo jarayonida xato: {str(e)}"
-            logger.error(error_msg)
-            traceback.print_exc()
-            await send_trading_status(context, error_msg, "error")
-            await asyncio.sleep(60)
+            logger.error(f"AI batch tasdiqlashda xato: {e}")
+            return [None] * len(chunk)
 
+    async def ask_one(idx: int) -> Dict[str, Any]:
+        candidate = pending[idx]
+        try:
+            return await get_ai_trade_signal_enhanced(
+                candidate["asset"], candidate["signal"], candidate["prices"], candidate["indicators"],
+                deadline=budget,
+            )
+        except Exception as e:
+            logger.error(f"[{candidate['asset']}] AI tasdiqlashda xato: {e}")
+            return {"decision": "REJECT", "reason": str(e), "error": True}
+
+    fallback: List[int] = []
+    for chunk, results in zip(chunks, await asyncio.gather(*(ask(chunk) for chunk in chunks))):
+        for idx, decision in zip(chunk, results):
+            if decision is None:
+                fallback.append(idx)
+            else:
+                decisions[idx] = decision
 
-async def close_profitable_positions_loop(context: ContextTypes.DEFAULT_TYPE):
-    """Sozlamalarga mos ravishda trailing stop va savdo yopish funksiyasi"""
-    logger.info("✅ Trailing stop loop ishga tushdi.")
+    if fallback:
+        logger.info(f"AI batch: {len(fallback)} ta aktiv alohida so'rov bilan qayta tekshiriladi")
+        for idx, decision in zip(fallback, await asyncio.gather(*(ask_one(idx) for idx in fallback))):
+            decisions[idx] = decision
 
-    logger.info("⏳ Global instancelar sozlanishini kutish...")
-    await asyncio.sleep(10)  # 10 soniya kutish
+    for idx in to_ask:
+        shared_ai_cache.put(_ai_cache_key(pending[idx]), decisions[idx], pending[idx]["resolution"])
 
-    # ✅ YANGI: Dynamic AI trailing positions tracker
-    ai_trailing_positions = {}
+    if to_ask:
+        logger.info(
+            f"🤖 AI batch: {len(pending)} ta nomzod | keshdan {len(pending) - len(to_ask)}, "
+            f"{len(chunks)} ta batch so'rov, {len(fallback)} ta alohida so'rov"
+        )
 
-    while not stop_event.is_set():
-        try:
-            await asyncio.sleep(30)  # ⬅️ ASOSIY LOOP 30 soniyada bir
-            
-            # Global instancelarni tekshirish
-            db, api = get_global_instances()
-            if not db or not api:
-                # ✅ Contextdan ham topishga urinib ko'ramiz
-                db = context.user_data.get('db')
-                api = context.user_data.get('capital_api')
-                if db and api:
-                    logger.info("✅ Global instancelar contextdan topildi")
-                    set_global_instances(db, api)
-                else:
-                    logger.debug("⏳ Global instancelar hali topilmadi. Kutilyapti...")
-                    continue
+    rejected = set()
+    for idx, candidate in enumerate(pending):
+        candidate.pop("ai_pending", None)
+        if not await report_ai_decision(context, candidate, decisions[idx], settings):
+            rejected.add(id(candidate))
+    return [candidate for candidate in candidates if id(candidate) not in rejected]
 
-            settings = await db.get_settings()
-            
-            if not settings.get("demo_account_status", False) and not settings.get("real_account_status", False):
-                logger.info("⏸️ Hisoblar o'chirilgan. Trailing stop to'xtatildi.")
-                continue
 
-            open_positions = await api.get_open_positions()
-            
-            if not open_positions:
-                logger.debug("📭 Ochiq pozitsiyalar yo'q")
-                continue
+async def evaluate_assets_concurrently(api, context, settings: Dict, signal_level: str,
+                                       market_snapshot: Dict, signal_scores: Dict[str, SignalScore],
+                                       epics: Optional[Set[str]] = None) -> List[Dict[str, Any]]:
+    """
+    ACTIVE_INSTRUMENTS ni (epics berilsa faqat ularni) parallel baholaydi (evaluation_concurrency ta bir vaqtda, har biri
+    asset_eval_timeout soniya ichida). Aylanma vaqti eng sekin aktiv bilan chegaralanadi.
+    ai_batch_enabled bo'lsa AI tasdiqlari barcha aktivlar baholangandan keyin bitta batch so'rovda olinadi.
+    Nomzodlar aniq tartibda qaytadi: avval asset_priority ro'yxati, keyin ACTIVE_INSTRUMENTS tartibi.
+    """
+    defer_ai = settings.get("ai_batch_enabled", True)
+    limit = asyncio.Semaphore(max(1, int(settings.get("evaluation_concurrency", 4))))
+    timeout = float(settings.get("asset_eval_timeout", 30))
 
-            logger.info(f"📋 {len(open_positions)} ta pozitsiya tekshirilmoqda...")
-            for i, pos in enumerate(open_positions):
-                deal_id = pos.get("dealId") or pos.get("positionId")
-                if not deal_id:
-                    continue
+    async def run(asset: str, details: Dict) -> Optional[Dict[str, Any]]:
+        async with limit:
+            try:
+                return await asyncio.wait_for(
+                    evaluate_asset(api, context, asset, details, settings, signal_level,
+                                   market_snapshot, signal_scores, defer_ai=defer_ai),
+                    timeout=timeout,
+                )
+            except asyncio.TimeoutError:
+                logger.warning(f"⏱️ [{asset}] baholash {timeout:.0f}s ichida tugamadi. O'tkazib yuborildi.")
+            except Exception as e:
+                logger.error(f"[{asset}] baholashda xato: {e}")
+            return None
 
-                # ✅ LOG: Har bir pozitsiya uchun
-                logger.debug(f"🔎 {i+1}-pozitsiya tekshirilmoqda: {deal_id}")
-                
-                detail = await api.get_position_details(deal_id)
-                position = detail.get("position", {})
-                market = detail.get("market", {})
+    assets = [(asset, details) for asset, details in ACTIVE_INSTRUMENTS.items()
+              if epics is None or details["id"] in epics]
+    results = await asyncio.gather(*(run(asset, details) for asset, details in assets))
 
-                asset_name = market.get("instrumentName", "Noma'lum")
-                epic = market.get("epic", None)
-                
-                # ✅ LOG: Aktiv nomi
-                logger.debug(f"📊 Aktiv: {asset_name}")
-                
-                # Bozor ochiq/yopiqligini tekshirish
-                if not is_market_open(asset_name):
-                    logger.debug(f"⏸️ {asset_name} bozori yopiq")
+    priority = {asset: i for i, asset in enumerate(settings.get("asset_priority", []))}
+    ordered = [(i, result) for i, result in enumerate(results) if result]
+    ordered.sort(key=lambda item: (priority.get(item[1]["asset"], len(priority)), item[0]))
+    return await approve_candidates_batch(context, [result for _, result in ordered], settings)
+
+
+def trade_limit_reason(api, asset: str, settings: Dict, check_total: bool = True) -> Optional[str]:
+    """
+    Maksimal savdolar tekshiruvi (avto va manual savdo uchun yagona joy): umumiy max_trades_count
+    va aktiv bo'yicha max_trades_per_asset pozitsiyalar daftaridan O(1) da tekshiriladi.
+    Limitdan oshsa sababni qaytaradi.
+    """
+    epic = ACTIVE_INSTRUMENTS.get(asset, {}).get("id", asset)
+    return api.position_book.limit_reason(
+        epic,
+        max_total=settings.get("max_trades_count", 3) if check_total else None,
+        max_for_epic=settings.get("max_trades_per_asset", {}).get(asset),
+    )
+
+
+def get_order_executor(api) -> OrderExecutor:
+    global order_executor
+    if order_executor is None or order_executor.api is not api:
+        order_executor = OrderExecutor(api, FILLS_LOG_FILE)
+    return order_executor
+
+
+async def place_signal_order(api, db, context, candidate: Dict[str, Any], settings: Dict) -> bool:
+    """Tasdiqlangan nomzod bo'yicha savdo ochadi va tasdiqni kutadi. Savdo ochilsa (yoki holati noma'lum bo'lsa) True."""
+    asset = candidate["asset"]
+    details = candidate["details"]
+    trade_signal = candidate["signal"]
+    prices = candidate["prices"]
+
+    try:
+        usd_amount = settings.get("trade_amount_per_asset", {}).get(asset, 50)
+        price = prices["buy"] if trade_signal == "BUY" else prices["sell"]
+        calculated_size = usd_amount / price
+        fill: FillRecord = await get_order_executor(api).submit(
+            details['id'], trade_signal, calculated_size,
+            quote_price=entry_quote(trade_signal, prices), asset=asset, signal_ts=candidate.get("signal_ts"),
+        )
+
+        if fill["status"] == "ACCEPTED":
+            slippage = f" | Slippage: {fill['slippage_bps']:+.1f} bps" if fill["slippage_bps"] is not None else ""
+            logger.info(f"✅ {asset} uchun {trade_signal} savdosi ochildi. Miqdor: {fill['size']:.4f}")
+            await send_trading_status(
+                context,
+                f"✅ Savdo ochildi: {asset} ({trade_signal})\n"
+                f"Narx: {fill['fill_level'] or price:.2f} | Miqdor: {fill['size']:.4f}{slippage}",
+                "success"
+            )
+            return True
+
+        if fill["status"] == "UNCONFIRMED":
+            # buyurtma yuborilgan, lekin tasdiq kelmadi — pozitsiyalar daftari REST bilan aniqlaydi
+            await send_trading_status(
+                context, f"⚠️ {asset} ({trade_signal}) buyurtmasi yuborildi, tasdiq kutilmoqda: {fill['deal_reference']}", "warning"
+            )
+            return True
+
+        error_msg = fill["reason"] or "Noma'lum xato"
+        logger.error(f"Savdo ochishda xato: {error_msg}")
+        await send_trading_status(context, f"❌ Savdo ochilmadi: {asset} - {error_msg}", "error")
+
+    except Exception as e:
+        logger.error(f"Savdo ochishda istisno: {e}")
+        await send_trading_status(context, f"❌ Savdo ochishda xato: {asset} - {str(e)}", "error")
+    return False
+
+
+async def trading_logic_loop(context: ContextTypes.DEFAULT_TYPE):
+    """Sozlamalarga mos auto savdo funksiyasi (bar yopilishida uyg'onadi)"""
+    logger.info("🔄 Auto savdo aylanmasi ishlayapti...")
+    db: InMemoryDB = context.user_data['db']
+    api: CapitalComAPI = context.user_data['capital_api']
+
+    scheduler = BarCloseScheduler()
+    api.bar_builder.add_listener(scheduler.on_bar_close)
+    api.add_quote_listener(scheduler.on_quote)
+    armed_triggers: Dict[str, Any] = {}
+
+    # loop qayta ishga tushganda (akkaunt almashishi) eski scheduler api da qolib ketmasin
+    try:
+        while not stop_event.is_set() and context.user_data.get('capital_api') is api:
+            due: Set[str] = set()
+            try:
+                settings = await db.get_settings()
+                signal_level = settings.get("trade_signal_level", "MNL")
+                resolution = settings.get("signal_resolution") or SIGNAL_RESOLUTIONS.get(signal_level, "HOUR")
+
+                # Ixtiyoriy bar ichidagi triggerlar: {"asset": {"above": x, "below": y}}
+                for asset, trigger in settings.get("intrabar_triggers", {}).items():
+                    details = ACTIVE_INSTRUMENTS.get(asset)
+                    if details and armed_triggers.get(asset) != trigger:
+                        scheduler.set_price_trigger(details["id"], trigger.get("above"), trigger.get("below"))
+                        armed_triggers[asset] = trigger
+
+                due = await scheduler.wait_due([details["id"] for details in ACTIVE_INSTRUMENTS.values()], resolution)
+                settings = await db.get_settings()
+
+                if not settings.get("auto_trading_enabled", True):
+                    logger.info("⏸️ Auto savdo o'chirilgan")
+                    scheduler.defer(due)
+                    await asyncio.sleep(10)
                     continue
-                
-                direction = position.get("direction", "").upper()
-                open_price = position.get("level", 0)
-                size = position.get("size", 0)
-
-                # ✅ LOG: Narxlarni olish
-                current_prices = await api.get_prices(epic)
-                if not current_prices:
-                    logger.debug(f"❌ {asset_name} uchun narx topilmadi")
+
+                # Ochiq pozitsiyalar soni xotiradagi daftardan (eskirgan bo'lsa REST bilan solishtiriladi)
+                try:
+                    await api.get_book_positions()
+                    active_trade_count = api.position_book.count()
+                    if active_trade_count > 0:
+                        logger.info(f"📊 Ochiq pozitsiyalar soni: {active_trade_count}")
+                except Exception as e:
+                    logger.error(f"Ochiq pozitsiyalarni olishda xato: {e}")
+                    active_trade_count = 0
+
+                max_trades_count = settings.get("max_trades_count", 3)
+                if active_trade_count >= max_trades_count:
+                    logger.info("⛔ Maksimal savdolar soniga yetildi.")
+                    scheduler.defer(due)
+                    await asyncio.sleep(10)
                     continue
 
-                # Trailing mode ni aniqlash
-                trailing_mode = settings.get("trailing_mode", "MNL")
-                use_ai_trailing = settings.get("use_ai_trailing_stop", False)
+                # Navbatdagi aktivlar holatini bitta /markets?epics= so'rovi bilan olamiz
+                market_snapshot = {}
+                try:
+                    market_snapshot = await api.get_markets_snapshot(list(due))
+                except Exception as e:
+                    logger.warning(f"Market snapshot olinmadi: {e}")
+
+                # Barcha navbatdagi aktivlar signal dvigatelida bitta vektorlashgan hisob bilan baholanadi
+                per_asset = settings.get("buy_sell_status_per_asset", {})
+                signal_scores = await signal_engine.evaluate_many(
+                    api,
+                    [details["id"] for asset, details in ACTIVE_INSTRUMENTS.items()
+                     if details["id"] in due and per_asset.get(asset, {}).get("active", True) and is_market_open(asset)],
+                    settings,
+                    signal_level,
+                )
+
+                # Aktivlar parallel baholanadi, buyurtmalar esa aniq ustuvorlik tartibida beriladi
+                candidates = await evaluate_assets_concurrently(
+                    api, context, settings, signal_level, market_snapshot, signal_scores, epics=due
+                )
+                for candidate in candidates:
+                    # har bir ochilgan savdo daftarga darhol yoziladi, limitlar shu bo'yicha tekshiriladi
+                    if api.position_book.count() >= max_trades_count:
+                        logger.info("⛔ Maksimal savdolar soniga yetildi, qolgan signallar keyingi aylanmaga qoldi.")
+                        break
+                    reason = trade_limit_reason(api, candidate["asset"], settings)
+                    if reason:
+                        logger.info(f"⛔ {candidate['asset']}: {reason}")
+                        continue
+                    await place_signal_order(api, db, context, candidate, settings)
 
-                # Trailing stop foizini olish
-                trailing_percent = get_trailing_stop_percent(settings, position, current_prices)
+                stats = scheduler.stats()
+                logger.info(
+                    f"📅 {resolution}: {len(due)} ta aktiv baholandi | jami {stats['evaluations']}, "
+                    f"o'tkazib yuborilgan {stats['skipped']} | uyg'onishlar {stats['wakeups']}"
+                )
 
-                # Yo'nalishga qarab narxni aniqlash va foyda foizini hisoblash
-                if direction == "BUY":
-                    current_price = current_prices.get("sell", 0)
-                    price_diff = (current_price - open_price) / open_price if open_price else 0
-                elif direction == "SELL":
-                    current_price = current_prices.get("buy", 0)
-                    price_diff = (open_price - current_price) / open_price if open_price else 0
-                else:
-                    continue
+            except Exception as e:
+                error_msg = f"Savdo jarayonida xato: {str(e)}"
+                logger.error(error_msg)
+                traceback.print_exc()
+                await send_trading_status(context, error_msg, "error")
+                scheduler.defer(due)
+                await asyncio.sleep(60)
+    finally:
+        api.bar_builder.remove_listener(scheduler.on_bar_close)
+        api.remove_quote_listener(scheduler.on_quote)
+
+
+# --- pozitsiyalar monitori: trailing stop, stop loss va AI trailing bitta aylanmada ---
+
+# deal_id -> yopish qulfi (bitta deal bir vaqtda faqat bir marta yopiladi)
+_deal_locks: Dict[str, asyncio.Lock] = {}
+# shu jarayonda yopilgan deallar (snapshot eskirgan bo'lsa ham qayta yopilmaydi)
+_closed_deals: Set[str] = set()
+
+
+async def close_position_once(api, deal_id: str, direction: str, epic: Optional[str], size: float) -> Dict[str, Any]:
+    """Pozitsiyani yopadi; bir deal uchun yopish so'rovlari navbatma-navbat va faqat bir marta yuboriladi."""
+    lock = _deal_locks.setdefault(deal_id, asyncio.Lock())
+    async with lock:
+        if deal_id in _closed_deals:
+            logger.info(f"[{deal_id}] pozitsiya allaqachon yopilgan, qayta yopilmaydi")
+            return {"success": False, "error": "already_closed"}
+        result = await api.close_position(deal_id=deal_id, direction=direction, epic=epic, size=size)
+        if result.get("success"):
+            _closed_deals.add(deal_id)
+        return result
+
+
+def _forget_closed_deals(open_deal_ids: Set[str]):
+    """Snapshotda yo'q deallar uchun qulf va AI trailing holatini tozalaydi."""
+    for deal_id in list(_deal_locks):
+        if deal_id not in open_deal_ids and not _deal_locks[deal_id].locked():
+            del _deal_locks[deal_id]
+    _closed_deals.intersection_update(open_deal_ids)
+    for deal_id in list(ai_trailing_positions):
+        if deal_id not in open_deal_ids:
+            del ai_trailing_positions[deal_id]
+
+
+async def _position_prices(api, pos: OpenPosition) -> Optional[Dict[str, float]]:
+    """Websocket narxi, bo'lmasa pozitsiyalar snapshotidagi bid/offer."""
+    epic = pos["epic"]
+    prices = await api.get_prices(epic) if epic else {}
+    if prices and prices.get("buy") and prices.get("sell"):
+        return prices
+    if pos["bid"] and pos["offer"]:
+        return {"buy": pos["bid"], "sell": pos["offer"]}
+    return None
 
-                # Trailing stop shartini tekshirish
-                should_close = False
-                close_reason = ""
 
-                logger.info(f"🔧 DEBUG: {asset_name} | Mode: {trailing_mode} | AI Trailing: {use_ai_trailing}")
+def _uses_ai_trailing(settings: Dict) -> bool:
+    return settings.get("trailing_mode", "MNL") == "AI" and settings.get("use_ai_trailing_stop", False)
 
-                # ✅ YANGI: Dynamic AI trailing stop (spread bilan)
-                if trailing_mode == "AI" and use_ai_trailing:
-                    logger.info(f"🎯 AI TRAILING BLOKIGA KIRDI: {asset_name}")
 
-                    current_time = time.time()
+def _accounts_active(settings: Dict) -> bool:
+    """Demo yoki real hisob yoqilganmi. O'chirilgan bo'lsa pozitsiyalar uchun faqat stop loss ishlaydi."""
+    return bool(settings.get("demo_account_status", False) or settings.get("real_account_status", False))
 
 
-                    
-                    # Har 2 daqiqada bir AI so'rovi
-                    last_ai_check = ai_trailing_positions.get(deal_id, {}).get('last_ai_check', 0)
+def position_rules(pos: OpenPosition, prices: Dict[str, float], settings: Dict) -> Optional[Tuple[str, str, float, float]]:
+    """
+    Sinxron qoidalar (har bir tickda ham ishlaydi): stop loss, keyin oddiy trailing stop
+    (hisoblar o'chirilgan bo'lsa faqat stop loss). Natija: (tur, sabab, joriy narx, foyda foizi) yoki None. AI trailing bu yerda emas.
+    """
+    if pos["direction"] not in ("BUY", "SELL") or not pos["level"]:
+        return None
+    current_price, price_diff = position_pnl(pos["direction"], pos["level"], prices)
+    if not current_price:
+        return None
 
-                    logger.info(f"⏰ DEBUG: {asset_name} | Last check: {last_ai_check} | Current: {current_time} | Diff: {current_time - last_ai_check}")
-                    if current_time - last_ai_check < 120:
-                        logger.info(f"⏰ {asset_name} - 2 daqiqa o'tmagan, keyingi loopda")
-                        continue
+    reason = stop_loss_reason(settings, price_diff)
+    if reason:
+        return "stop_loss", reason, current_price, price_diff
 
-                    logger.info(f"🚀 {asset_name} - AI SO'ROVI BOSHLANMOQDA...")
-                    
-                    net_profit = 0
-                    should_close = False
-                    close_reason = ""
-                    ai_decision = {} 
+    if not _accounts_active(settings) or _uses_ai_trailing(settings) or not is_market_open(pos["instrument_name"]):
+        return None
+    trailing_percent = get_trailing_stop_percent(settings, pos, prices)
+    if price_diff >= trailing_percent:
+        mode = settings.get("trailing_mode", "MNL")
+        return "trailing", f"Trailing stop [{mode}]: {trailing_percent*100:.2f}%", current_price, price_diff
+    return None
 
 
-                    try:
-                        # Indicators ni olish
-                        historical_prices = await api.get_historical_prices(epic, "MINUTE", 30)
-                        indicators = calculate_indicators(historical_prices) if historical_prices else {}
-                        
-                        # Savdo xarajatlarini hisoblash
-                        trading_costs = calculate_trading_costs(current_prices, direction)
-                        
-                        # NET profit hisoblash
-                        current_profit = (current_price - open_price) / open_price if direction == "BUY" else (open_price - current_price) / open_price
-                        net_profit = current_profit - trading_costs["total_entry_cost"]
-                        
-                        # Dynamic AI qarori
-                        ai_decision = await get_dynamic_ai_trailing_decision(
-                            asset_name, direction, open_price, current_price, indicators, deal_id, current_prices
-                        )
-                        
-                        # Position ma'lumotlarini yangilash
-                        ai_trailing_positions[deal_id] = {
-                            'last_ai_check': current_time,
-                            'current_tp': ai_decision.get('take_profit_price'),
-                            'net_tp': ai_decision.get('net_take_profit_percent'),
-                            'confidence': ai_decision.get('confidence')
-                        }
-                        
-                        # AI qarorni bajarish
-                        if ai_decision.get("action") == "CLOSE":
-                            should_close = True
-                            close_reason = f"AI Dynamic: {ai_decision.get('reason', '')}"
-                            logger.info(f"🤖 AI CLOSE: {asset_name} | NET: {net_profit*100:+.2f}%")
-                        else:
-                            should_close = False
-                            gross_tp = ai_decision.get('take_profit_percent', 0)
-                            net_tp = ai_decision.get('net_take_profit_percent', 0)
-                            confidence = ai_decision.get('confidence', 0)
-                            logger.info(f"🤖 AI HOLD: {asset_name} | Joriy NET: {net_profit*100:+.2f}% | TP: {gross_tp:.1f}% (NET: {net_tp:.1f}%) | Ishonch: {confidence:.0f}%")
-                            
-                    except Exception as e:
-                        logger.error(f"🤖 Dynamic AI trailing xato: {e}")
-                        ai_decision = {"action": "FALLBACK"}
-                        should_close = price_diff >= trailing_percent
-                        close_reason = f"AI xato: Oddiy trailing {trailing_percent*100:.2f}%"
-                        logger.info(f"🤖 AI FALLBACK: {asset_name} | Oddiy trailing: {should_close}")
+def _ai_trailing_fallback(settings: Dict, asset_name: str, price_diff: float, trailing_percent: float,
+                         reason: str) -> Optional[str]:
+    """AI javob bermaganda: "rules" siyosatida oddiy trailing, aks holda pozitsiya ushlab turiladi."""
+    if ai_fallback_policy(settings) != "rules":
+        logger.info(f"🤖 AI mavjud emas ({reason}): {asset_name} AI trailing tekshiruvi o'tkazib yuborildi")
+        return None
+    should_close = price_diff >= trailing_percent
+    logger.info(f"🤖 AI FALLBACK: {asset_name} | Oddiy trailing: {should_close} ({reason})")
+    return f"AI mavjud emas: Oddiy trailing {trailing_percent*100:.2f}%" if should_close else None
+
+
+async def _check_ai_trailing(api, pos: OpenPosition, current_price: float, current_prices: Dict,
+                             price_diff: float, trailing_percent: float, settings: Dict) -> Optional[str]:
+    """AI trailing qarori (har 2 daqiqada bir so'rov). Yopish kerak bo'lsa sababni qaytaradi."""
+    deal_id = pos["deal_id"]
+    asset_name = pos["instrument_name"]
+    epic = pos["epic"]
+    direction = pos["direction"]
+    open_price = pos["level"]
+    current_time = time.time()
+    last_ai_check = ai_trailing_positions.get(deal_id, {}).get('last_ai_check', 0)
+    if current_time - last_ai_check < 120:
+        logger.debug(f"⏰ {asset_name} - 2 daqiqa o'tmagan, keyingi aylanmada")
+        return None
+    if not shared_ai_client.available():
+        return _ai_trailing_fallback(settings, asset_name, price_diff, trailing_percent, "circuit breaker ochiq")
 
-                # ✅ ODDIY TRAILING STOP (MNL/AUTO/TEST) - AVVALGIDEK O'ZGARMASIN
-                else:
-                    should_close = price_diff >= trailing_percent
-                    close_reason = f"Trailing stop: {trailing_percent*100:.2f}%"
+    try:
+        candles = await api.get_candles(epic, "MINUTE", 30)
+        indicators = calculate_indicators(candles, key=(epic, "MINUTE")) or {}
 
-                # ✅ YANGI LOG - NET profit bilan
-                if trailing_mode == "AI" and use_ai_trailing:
-                    logger.info(f"📊 {asset_name} - Trailing AI: Joriy NET {net_profit*100:+.2f}%")
-                    
-                    if ai_decision.get("action") == "CLOSE":
-                        logger.info(f"🤖 AI CLOSE: {asset_name} | NET: {net_profit*100:+.2f}%")
-                    else:
-                        gross_tp = ai_decision.get('take_profit_percent', 0)
-                        net_tp = ai_decision.get('net_take_profit_percent', 0)
-                        logger.info(f"🤖 AI HOLD: {asset_name} | Joriy NET: {net_profit*100:+.2f}% | TP: {gross_tp:.1f}% (NET: {net_tp:.1f}%)")
-
-                # ✅ SAVDO YOPISH - AVVALGIDEK
-                if should_close:
-                    logger.info(f"🚨 TRAILING STOP TRIGGERED [{trailing_mode}]")
-                    logger.info(f"   📊 Aktiv: {asset_name}")
-                    logger.info(f"   📈 Joriy foiz: {price_diff*100:.2f}%")
-                    logger.info(f"   🔔 Sabab: {close_reason}")
-
-                    # Pozitsiyani yopish
-                    result = await api.close_position(deal_id=deal_id, direction=direction, epic=epic, size=size)
-                    
-                    # ✅ YANGI: Foyda/zarar bilan xabar yuborish
-                    if result.get("success"):
-                        try:
-                            # Foyda/zarar hisoblash
-                            if direction == "BUY":
-                                profit_loss = (current_price - open_price) * size
-                            else:  # SELL
-                                profit_loss = (open_price - current_price) * size
-                            
-                            # Formatlash
-                            if profit_loss >= 0:
-                                profit_text = f"+{profit_loss:.2f} USD"
-                            else:
-                                profit_text = f"{profit_loss:.2f} USD"
-                                
-                            logger.info(f"✅ {asset_name} pozitsiyasi {profit_text} trailing stop bilan yopildi!")
-                            await send_trading_status(
-                                context, 
-                                f"✅ {asset_name} pozitsiyasi {profit_text} trailing stop bilan yopildi!", 
-                                "success"
-                            )
-                        except Exception as e:
-                            logger.error(f"Foyda hisoblashda xato: {e}")
-                            # Fallback
-                            logger.info(f"✅ {asset_name} pozitsiyasi trailing stop bilan yopildi!")
-                            await send_trading_status(
-                                context, 
-                                f"✅ {asset_name} pozitsiyasi trailing stop bilan yopildi!", 
-                                "success"
-                            )
+        trading_costs = calculate_trading_costs(current_prices, direction)
+        net_profit = price_diff - trading_costs["total_entry_cost"]
 
-        except Exception as e:
-            logger.error(f"Trailing stop loop error: {e}")
-            await asyncio.sleep(60)
+        ai_decision = await get_dynamic_ai_trailing_decision(
+            asset_name, direction, open_price, current_price, indicators, deal_id, current_prices,
+            deadline=ai_latency_budget(settings),
+        )
+        if ai_decision.get("error"):
+            return _ai_trailing_fallback(settings, asset_name, price_diff, trailing_percent, ai_decision["reason"])
+        ai_trailing_positions[deal_id] = {
+            'last_ai_check': current_time,
+            'current_tp': ai_decision.get('take_profit_price'),
+            'net_tp': ai_decision.get('net_take_profit_percent'),
+            'confidence': ai_decision.get('confidence')
+        }
 
+        if ai_decision.get("action") == "CLOSE":
+            logger.info(f"🤖 AI CLOSE: {asset_name} | NET: {net_profit*100:+.2f}%")
+            return f"AI Dynamic: {ai_decision.get('reason', '')}"
 
-# trading_logic.py - close_profitable_positions_loop ga qo'shamiz
+        gross_tp = ai_decision.get('take_profit_percent', 0)
+        net_tp = ai_decision.get('net_take_profit_percent', 0)
+        confidence = ai_decision.get('confidence', 0)
+        logger.info(f"🤖 AI HOLD: {asset_name} | Joriy NET: {net_profit*100:+.2f}% | TP: {gross_tp:.1f}% (NET: {net_tp:.1f}%) | Ishonch: {confidence:.0f}%")
+        return None
 
-async def check_stop_loss_loop(context: ContextTypes.DEFAULT_TYPE):
-    """Stop Loss ni tekshirish loopi"""
-    logger.info("✅ Stop Loss loop ishga tushdi.")
-    
-    while not stop_event.is_set():
-        try:
-            await asyncio.sleep(30)  # Har 30 soniyada tekshiramiz
-            
-            db, api = get_global_instances()
-            if not db or not api:
-                continue
-                
-            settings = await db.get_settings()
-            
-            # Stop Loss o'chiq bo'lsa, ishlamaymiz
-            if not settings.get("stop_loss_enabled", False):
-                continue
-                
-            stop_loss_percent = settings.get("stop_loss_percent", 2.0) / 100  # 2% -> 0.02
-            
-            open_positions = await api.get_open_positions()
-            if not open_positions:
-                continue
+    except Exception as e:
+        logger.error(f"🤖 Dynamic AI trailing xato: {e}")
+        return _ai_trailing_fallback(settings, asset_name, price_diff, trailing_percent, f"AI xato: {e}")
+
+
+async def close_and_notify(api, context, pos: OpenPosition, kind: str, reason: str,
+                           current_price: float, price_diff: float) -> bool:
+    """Pozitsiyani yopadi (deal qulfi bilan) va natijani Telegramga yuboradi."""
+    asset_name = pos["instrument_name"]
+    logger.info(f"🚨 {asset_name} yopilmoqda | Joriy foiz: {price_diff*100:.2f}% | Sabab: {reason}")
+    result = await close_position_once(api, pos["deal_id"], pos["direction"], pos["epic"], pos["size"])
+    if not result.get("success"):
+        return False
+
+    if pos["direction"] == "BUY":
+        profit_loss = (current_price - pos["level"]) * pos["size"]
+    else:  # SELL
+        profit_loss = (pos["level"] - current_price) * pos["size"]
+    profit_text = f"{profit_loss:+.2f} USD"
+
+    if kind == "stop_loss":
+        logger.info(f"✅ {asset_name} pozitsiyasi Stop Loss bilan yopildi! ({profit_text})")
+        await send_trading_status(
+            context,
+            f"🛑 {asset_name} pozitsiyasi {profit_text} Stop Loss bilan yopildi! ({reason})",
+            "warning"
+        )
+    else:
+        logger.info(f"✅ {asset_name} pozitsiyasi {profit_text} trailing stop bilan yopildi!")
+        await send_trading_status(
+            context,
+            f"✅ {asset_name} pozitsiyasi {profit_text} trailing stop bilan yopildi!",
+            "success"
+        )
+    return True
 
-            for pos in open_positions:
-                deal_id = pos.get("dealId") or pos.get("positionId")
-                if not deal_id:
-                    continue
 
-                detail = await api.get_position_details(deal_id)
-                position = detail.get("position", {})
-                market = detail.get("market", {})
+async def _monitor_position(api, context, pos: OpenPosition, settings: Dict):
+    """Bitta pozitsiya uchun barcha qoidalar: stop loss va trailing (oddiy yoki AI)."""
+    current_prices = await _position_prices(api, pos)
+    if not current_prices:
+        logger.debug(f"❌ {pos['instrument_name']} uchun narx topilmadi")
+        return
+
+    decision = position_rules(pos, current_prices, settings)
+    if (decision is None and _accounts_active(settings) and _uses_ai_trailing(settings)
+            and pos["direction"] in ("BUY", "SELL")):
+        if not is_market_open(pos["instrument_name"]):
+            logger.debug(f"⏸️ {pos['instrument_name']} bozori yopiq")
+            return
+        current_price, price_diff = position_pnl(pos["direction"], pos["level"], current_prices)
+        trailing_percent = get_trailing_stop_percent(settings, pos, current_prices)
+        reason = await _check_ai_trailing(api, pos, current_price, current_prices, price_diff, trailing_percent,
+                                          settings)
+        if reason:
+            decision = ("trailing", reason, current_price, price_diff)
+
+    if decision is not None:
+        await close_and_notify(api, context, pos, *decision)
+
 
-                asset_name = market.get("instrumentName", "Noma'lum")
-                epic = market.get("epic", None)
-                direction = position.get("direction", "").upper()
-                open_price = position.get("level", 0)
-                size = position.get("size", 0)
+def _detach_tick_engine(api, engine: Optional[TickRiskEngine]):
+    """Dvigatelni api kotirovka listenerlaridan olib tashlaydi va global havolani tozalaydi."""
+    global tick_risk_engine
+    if api is not None and engine is not None:
+        api.remove_quote_listener(engine.on_quote)
+    if tick_risk_engine is engine:
+        tick_risk_engine = None
 
-                current_prices = await api.get_prices(epic)
-                if not current_prices:
+
+async def risk_monitor_loop(context: ContextTypes.DEFAULT_TYPE, interval: float = 30.0):
+    """
+    Ochiq pozitsiyalar monitori (eski trailing stop va stop loss looplari o'rniga).
+    Har aylanmada pozitsiyalar xotiradagi daftardan olinadi (eskirgan bo'lsa bitta REST so'rovi) va
+    stop loss, trailing stop va AI trailing qoidalari shu umumiy snapshot ustida bir marta
+    tekshiriladi. Yopish deal bo'yicha qulf bilan.
+    Snapshot tick risk dvigateliga ham beriladi: stop loss va oddiy trailing har bir kotirovkada
+    tekshiriladi, bu aylanma esa zaxira va AI trailing uchun.
+    Hisoblar o'chirilgan bo'lsa trailing to'xtaydi, stop loss esa ishlashda davom etadi.
+    """
+    global tick_risk_engine
+    logger.info("✅ Pozitsiyalar monitori ishga tushdi.")
+    await asyncio.sleep(10)  # global instancelar sozlanishini kutish
+    engine_api = None
+    engine: Optional[TickRiskEngine] = None
+
+    # loop qayta ishga tushganda eski dvigatel kotirovkalarni olishda davom etmasin
+    try:
+        while not stop_event.is_set():
+            try:
+                await asyncio.sleep(interval)
+
+                db, api = get_global_instances()
+                if not db or not api:
+                    db = context.user_data.get('db')
+                    api = context.user_data.get('capital_api')
+                    if db and api:
+                        logger.info("✅ Global instancelar contextdan topildi")
+                        set_global_instances(db, api)
+                    else:
+                        logger.debug("⏳ Global instancelar hali topilmadi. Kutilyapti...")
+                        continue
+
+                if engine_api is not api:
+                    # api almashgan: eski dvigatel eski api kotirovkalaridan uziladi
+                    _detach_tick_engine(engine_api, engine)
+                    engine_api = api
+                    engine = tick_risk_engine = TickRiskEngine(
+                        position_rules,
+                        lambda pos, *decision, api=api: close_and_notify(api, context, pos, *decision),
+                    )
+                    api.add_quote_listener(engine.on_quote)
+
+                settings = await db.get_settings()
+                if not _accounts_active(settings):
+                    # eski stop loss loopi kabi: hisoblar o'chirilgan bo'lsa ham stop loss ishlaydi
+                    logger.debug("⏸️ Hisoblar o'chirilgan. Faqat stop loss tekshiriladi.")
+
+                snapshot = await api.get_book_positions()
+                # REST hali ko'rsatayotgan yopilgan deallar uchun ikki marta yopish himoyasi saqlanadi
+                _forget_closed_deals({pos["deal_id"] for pos in snapshot} | api.position_book.closing_ids())
+                engine.update([pos for pos in snapshot if pos["deal_id"] not in _closed_deals], settings)
+                if not snapshot:
+                    logger.debug("📭 Ochiq pozitsiyalar yo'q")
                     continue
 
-                # Zarar foizini hisoblash
-                if direction == "BUY":
-                    current_price = current_prices.get("sell", 0)
-                    loss_percent = (open_price - current_price) / open_price if open_price else 0
-                else:  # SELL
-                    current_price = current_prices.get("buy", 0)
-                    loss_percent = (current_price - open_price) / open_price if open_price else 0
-
-                # Stop Loss shartini tekshirish
-                if loss_percent >= stop_loss_percent:
-                    logger.info(f"🛑 STOP LOSS TRIGGERED: {asset_name}")
-                    logger.info(f"   📊 Aktiv: {asset_name}")
-                    logger.info(f"   📉 Zarar foizi: {loss_percent*100:.2f}%")
-                    logger.info(f"   🎯 Stop Loss: {stop_loss_percent*100:.2f}%")
-
-                    # Pozitsiyani yopish
-                    result = await api.close_position(deal_id=deal_id, direction=direction, epic=epic, size=size)
-                    if result.get("success"):
-                        # Foyda/zarar miqdorini hisoblaymiz
-                        if direction == "BUY":
-                            profit_loss = (current_price - open_price) * size
-                        else:  # SELL
-                            profit_loss = (open_price - current_price) * size
-                        
-                        profit_text = f"{profit_loss:+.2f} USD"
-                        
-                        logger.info(f"✅ {asset_name} pozitsiyasi Stop Loss bilan yopildi! ({profit_text})")
-                        await send_trading_status(
-                            context, 
-                            f"🛑 {asset_name} pozitsiyasi {profit_text} Stop Loss bilan yopildi! (Zarar: {loss_percent*100:.2f}%)", 
-                            "warning"
-                        )
+                logger.info(f"📋 {len(snapshot)} ta pozitsiya tekshirilmoqda...")
+                for pos in snapshot:
+                    try:
+                        await _monitor_position(api, context, pos, settings)
+                    except Exception as e:
+                        logger.error(f"[{pos['deal_id']}] pozitsiyani tekshirishda xato: {e}")
+                logger.debug(f"Tick risk dvigateli: {engine.stats()}")
 
-        except Exception as e:
-            logger.error(f"Stop Loss loop error: {e}")
-            await asyncio.sleep(60)
+            except Exception as e:
+                logger.error(f"Pozitsiyalar monitori xatosi: {e}")
+                await asyncio.sleep(60)
+    finally:
+        _detach_tick_engine(engine_api, engine)
 
 
 async def save_position(context, asset_name, asset_id, direction, size, result):
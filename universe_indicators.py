@@ -0,0 +1,158 @@
+# universe_indicators.py
+"""
+Bir nechta aktiv uchun indikatorlarni bitta (aktivlar x barlar) matritsa ustida hisoblaydi.
+
+EMA, Wilder RSI va MACD chiziqli rekursiyalar, shuning uchun ularning qiymati yopilish narxlarining
+og'irlikli yig'indisi: og'irliklar bar soni va davr bo'yicha bir marta hisoblanadi (kesh), keyin
+barcha aktivlar uchun bitta matritsa ko'paytmasi yetadi. Seed va formulalar TA-Lib bilan bir xil.
+"""
+import logging
+from functools import lru_cache
+from typing import Dict, Mapping
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+UNIVERSE_DTYPE = np.dtype([
+    ("epic", "U32"),
+    ("bars", "i4"),
+    ("last", "f8"),
+    ("rsi", "f8"),
+    ("ema20", "f8"),
+    ("ema50", "f8"),
+    ("macd", "f8"),
+    ("macd_signal", "f8"),
+    ("macd_hist", "f8"),
+    ("bb_upper", "f8"),
+    ("bb_middle", "f8"),
+    ("bb_lower", "f8"),
+    ("trend_short", "f8"),
+    ("trend_long", "f8"),
+])
+
+
+@lru_cache(maxsize=64)
+def _ema_weights(n: int, period: int, start: int, alpha: float) -> np.ndarray:
+    """
+    Shape (n, n) matritsa: W[t] @ x — x[start:] bo'yicha EMA ning t-bardagi qiymati.
+    Seed: x[start:start+period] ning o'rtachasi (t = start+period-1), keyin ema = ema + alpha*(x-ema).
+    Seed dan oldingi qatorlar NaN.
+    """
+    w = np.full((n, n), np.nan)
+    seed = start + period - 1
+    if seed >= n:
+        return w
+    row = np.zeros(n)
+    row[start:seed + 1] = 1.0 / period
+    w[seed] = row
+    decay = 1.0 - alpha
+    for t in range(seed + 1, n):
+        row = row * decay
+        row[t] = alpha
+        w[t] = row
+    w.setflags(write=False)
+    return w
+
+
+def _ema_series(x: np.ndarray, period: int, start: int = 0, alpha: float = None) -> np.ndarray:
+    """x (aktivlar x n) bo'yicha EMA seriyasi, shape (aktivlar, n)."""
+    n = x.shape[1]
+    alpha = 2.0 / (period + 1) if alpha is None else alpha
+    return x @ _ema_weights(n, period, start, alpha).T
+
+
+def _last_ema(x: np.ndarray, period: int, start: int = 0, alpha: float = None) -> np.ndarray:
+    n = x.shape[1]
+    alpha = 2.0 / (period + 1) if alpha is None else alpha
+    weights = _ema_weights(n, period, start, alpha)[n - 1]
+    if np.isnan(weights).any():
+        return np.full(x.shape[0], np.nan)
+    return x @ weights
+
+
+def _last_rsi(x: np.ndarray, period: int = 14) -> np.ndarray:
+    if x.shape[1] <= period:
+        return np.full(x.shape[0], np.nan)
+    diff = np.diff(x, axis=1)
+    # Wilder silliqlashi = alpha 1/period bo'lgan, SMA bilan seed qilingan EMA
+    avg_gain = _last_ema(np.clip(diff, 0.0, None), period, alpha=1.0 / period)
+    avg_loss = _last_ema(np.clip(-diff, 0.0, None), period, alpha=1.0 / period)
+    total = avg_gain + avg_loss
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(total > 1e-14, 100.0 * avg_gain / total, 0.0)
+
+
+def _last_macd(x: np.ndarray, fast: int = 12, slow: int = 26, signal: int = 9):
+    n = x.shape[1]
+    nan = np.full(x.shape[0], np.nan)
+    if n < slow + signal - 1:
+        return nan, nan, nan
+    # TA-Lib: tez EMA ham sekin EMA seed qilinadigan barda (slow-1) boshlanadi
+    line = (_ema_series(x, fast, start=slow - fast) - _ema_series(x, slow))[:, slow - 1:]
+    macd = line[:, -1]
+    macd_signal = _last_ema(line, signal)
+    return macd, macd_signal, macd - macd_signal
+
+
+def _last_bbands(x: np.ndarray, period: int = 20, nbdev: float = 2.0):
+    if x.shape[1] < period:
+        nan = np.full(x.shape[0], np.nan)
+        return nan, nan, nan
+    window = x[:, -period:]
+    middle = window.mean(axis=1)
+    dev = nbdev * window.std(axis=1)
+    return middle + dev, middle, middle - dev
+
+
+def _trend(x: np.ndarray, lag: int) -> np.ndarray:
+    if x.shape[1] < lag:
+        return np.full(x.shape[0], np.nan)
+    return x[:, -1] - x[:, -lag]
+
+
+def compute_matrix(closes: np.ndarray) -> Dict[str, np.ndarray]:
+    """(aktivlar x barlar) matritsa uchun oxirgi indikator qiymatlari (har biri shape (aktivlar,))."""
+    macd, macd_signal, macd_hist = _last_macd(closes)
+    bb_upper, bb_middle, bb_lower = _last_bbands(closes)
+    return {
+        "last": closes[:, -1],
+        "rsi": _last_rsi(closes),
+        "ema20": _last_ema(closes, 20),
+        "ema50": _last_ema(closes, 50),
+        "macd": macd,
+        "macd_signal": macd_signal,
+        "macd_hist": macd_hist,
+        "bb_upper": bb_upper,
+        "bb_middle": bb_middle,
+        "bb_lower": bb_lower,
+        "trend_short": _trend(closes, 5),
+        "trend_long": _trend(closes, 20),
+    }
+
+
+def compute_universe(series: Mapping[str, np.ndarray]) -> np.ndarray:
+    """
+    epic -> yopilish narxlari. Bir xil uzunlikdagi seriyalar bitta matritsaga yig'iladi
+    (odatda hammasi bir guruh), shuning uchun natija har bir aktiv uchun alohida
+    TA-Lib hisobiga teng. NaN li yoki bo'sh seriyalar natijaga kirmaydi.
+    Qaytaradi: UNIVERSE_DTYPE strukturali massiv, kirish tartibida.
+    """
+    groups: Dict[int, list] = {}
+    for epic, closes in series.items():
+        closes = np.asarray(closes, dtype=np.float64)
+        if not len(closes) or np.isnan(closes).any():
+            logger.debug(f"[{epic}] universe: seriya bo'sh yoki NaN bor, o'tkazib yuborildi")
+            continue
+        groups.setdefault(len(closes), []).append((epic, closes))
+
+    order = {epic: i for i, epic in enumerate(series)}
+    rows = []
+    for n, items in groups.items():
+        matrix = np.vstack([closes for _, closes in items])
+        values = compute_matrix(matrix)
+        for i, (epic, _) in enumerate(items):
+            rows.append((epic, n) + tuple(float(values[name][i]) for name in UNIVERSE_DTYPE.names[2:]))
+
+    rows.sort(key=lambda row: order[row[0]])
+    return np.array(rows, dtype=UNIVERSE_DTYPE)